@@ -1,4 +1,9 @@
-import shutil
+"""
+The actions that can be undone and redone.
+
+Every action can be converted to a tuple with 'to_tuple()' and back with
+'action_from_tuple()', so that the history can be stored in a session file.
+"""
 
 __author__ = "Fernando Sanchez Villaamil"
 __copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
@@ -16,18 +21,44 @@ class DeletionAction():
         self.filename = filename
         self.pos = pos
 
+    def to_tuple(self):
+        return ('deletion', self.path, self.filename, self.pos)
+
     def undo(self, viewport_size):
-        shutil.move(self.path + '/discarded/' + self.filename,
-                    self.path + '/' + self.filename)
-        self.internal_state.add_image(self.path, self.filename,
-                                     self.pos, viewport_size)
+        self.internal_state.restore_image(self.path, self.filename,
+                                          self.pos, viewport_size)
         self.internal_state.jump_to_image(self.pos, viewport_size)
 
     def redo(self, viewport_size):
         assert self.internal_state.pos == self.pos
         self.internal_state.discard_current_image(viewport_size)
-        shutil.move(self.path + '/discarded/' + self.filename,
-                    self.path + '/' + self.filename)
+
+class GroupDeletionAction():
+    def __init__(self, internal_state, deletions, pos):
+        """Keyword Arguments:
+        deletions -- The tuples (path, filename, pos) returned by
+                     'InternalState.discard_images()'.
+        pos -- The position of the current image after the deletion.
+        """
+        self.internal_state = internal_state
+        self.deletions = deletions
+        self.pos = pos
+
+    def to_tuple(self):
+        return ('group_deletion', self.deletions, self.pos)
+
+    def undo(self, viewport_size):
+        old_pos = self.pos
+        for (path, filename, pos) in reversed(self.deletions):
+            self.internal_state.restore_image(path, filename, pos,
+                                              viewport_size)
+            if pos <= old_pos:
+                old_pos += 1
+        self.internal_state.jump_to_image(old_pos, viewport_size)
+
+    def redo(self, viewport_size):
+        images = [(path, filename) for (path, filename, _) in self.deletions]
+        self.internal_state.discard_images(images, viewport_size)
 
 class RotationAction():
     def __init__(self, internal_state, degrees, pos):
@@ -36,6 +67,9 @@ class RotationAction():
         self.pos = pos
         self.old_pos = None
 
+    def to_tuple(self):
+        return ('rotation', self.degrees, self.pos, self.old_pos)
+
     def undo(self, viewport_size):
         self.old_pos = self.internal_state.pos
         self.internal_state.jump_to_image(self.pos, viewport_size)
@@ -56,6 +90,9 @@ class JumpAction():
         self.pos = pos
         self.old_pos = None
 
+    def to_tuple(self):
+        return ('jump', self.pos, self.old_pos)
+
     def undo(self, viewport_size):
         self.old_pos = self.internal_state.pos
         self.internal_state.jump_to_image(self.pos, viewport_size)
@@ -63,3 +100,23 @@ class JumpAction():
     def redo(self, viewport_size):
         assert self.internal_state.pos == self.pos
         self.internal_state.jump_to_image(self.old_pos, viewport_size)
+
+def action_from_tuple(internal_state, data):
+    """Return the action that was converted to a tuple with 'to_tuple()'."""
+    kind = data[0]
+    if kind == 'deletion':
+        (_, path, filename, pos) = data
+        return DeletionAction(internal_state, path, filename, pos)
+    elif kind == 'group_deletion':
+        (_, deletions, pos) = data
+        return GroupDeletionAction(internal_state, deletions, pos)
+    elif kind == 'rotation':
+        (_, degrees, pos, old_pos) = data
+        action = RotationAction(internal_state, degrees, pos)
+    elif kind == 'jump':
+        (_, pos, old_pos) = data
+        action = JumpAction(internal_state, pos)
+    else:
+        raise ValueError('Unknown action: ' + str(kind))
+    action.old_pos = old_pos
+    return action
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Batch jobs over whole directory trees, without the GUI.
+
+    python Batch.py [options] JOB DIRECTORY...
+
+The jobs are:
+
+orient -- Rotate the pixels of every image as its Exif orientation says and
+          reset the orientation to normal, for programs that ignore it. This
+          decodes and encodes the pixels again, which is not lossless for
+          JPEG files, so it is only done with --reencode or --quality.
+          Otherwise the images keep their pixels and their Exif orientation,
+          which is the lossless way to rotate them, and the images that would
+          be re-encoded are only counted. JPEG files are encoded with the
+          quality they were saved with unless --quality says otherwise.
+previews -- Store the preview of every image in the 'PreviewCache', so that
+            the GUI finds them when the images are browsed for the first time.
+            The previews are made for one size of the image area of the
+            window, given with --size.
+apply-log -- Move the images of the 'DecisionLog' of the directories into
+             their discarded directories, like 'Apply Discards' in the GUI.
+             The GUI must not have the same directories open meanwhile.
+
+The images are found with the same scan as in the GUI and handed to a process
+pool as they are found, so every core decodes images while the tree is still
+being scanned. The progress is written to stderr while the job runs and a
+summary with the throughput at the end. The exit status is 1 if some image
+failed.
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+from PyQt4 import QtGui, QtCore
+
+from DecisionLog import DecisionLog, decision_log_file
+from DirectoryScanner import scan_images
+from FileOperations import DirectoryDiscardJob
+from Headless import init_worker_process, parse_size
+from ImageLoader import ImageLoader, orientation_matrix, save_transformed
+from PreviewCache import enable_preview_cache, get_preview_cache
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+# Left to the Exif orientation, because re-encoding was not asked for.
+LOSSLESS = 'lossless'
+
+PREVIEW_CACHE_SIZE = 2 * 1024 * 1024 * 1024 # In bytes.
+# How many images a worker process gets at once.
+CHUNK_SIZE = 4
+
+# The options of the job in the worker processes.
+OPTIONS = None
+
+def init_worker(options):
+    global OPTIONS
+    init_worker_process('photoChooser-batch')
+    OPTIONS = options
+    if options.job == 'previews':
+        enable_preview_cache(options.cache_size)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def orient_image(image):
+    """Apply the Exif orientation of an image to its pixels."""
+    path = image[0] + '/' + image[1]
+    if orientation_matrix(path).isIdentity():
+        return [(SKIPPED, path, 0)]
+    if not OPTIONS.reencode:
+        # The Exif orientation already rotates the image losslessly.
+        return [(LOSSLESS, path, 0)]
+    quality = -1 if OPTIONS.quality is None else OPTIONS.quality
+    if not save_transformed(path, QtGui.QMatrix(), quality):
+        return [(FAILED, path, 0)]
+    return [(DONE, path, file_size(path))]
+
+def make_preview(image):
+    """Store the preview of an image, if it is not stored yet."""
+    path = image[0] + '/' + image[1]
+    if get_preview_cache().contains(path, OPTIONS.size):
+        return [(SKIPPED, path, 0)]
+    # The same loader as in the GUI, which stores what it decodes.
+    loader = ImageLoader(path, OPTIONS.size)
+    loader.run()
+    if loader.image_scaled is None or loader.image_scaled.isNull():
+        return [(FAILED, path, 0)]
+    return [(DONE, path, file_size(path))]
+
+def discard_directory(task):
+    """Move the discarded images of a directory."""
+    (directory, filenames) = task
+    sizes = dict([(f, file_size(directory + '/' + f)) for f in filenames])
+    job = DirectoryDiscardJob(directory, filenames)
+    job.run()
+    failed = set([f for (_, f) in job.failed])
+    return [(FAILED if f in failed else DONE, directory + '/' + f,
+             0 if f in failed else sizes[f]) for f in filenames]
+
+class Progress:
+    """Counts the results of a job and writes them to a stream as they
+    come."""
+    def __init__(self, job, total=None, stream=sys.stderr):
+        self.job = job
+        self.total = total
+        self.stream = stream
+        # Rewrite a single line on a terminal, otherwise write a line from
+        # time to time.
+        self.tty = stream.isatty()
+        self.interval = 0.5 if self.tty else 5.0
+        self.counts = {DONE: 0, SKIPPED: 0, FAILED: 0, LOSSLESS: 0}
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def count(self):
+        return sum(self.counts.values())
+
+    def add(self, status, path, num_bytes):
+        self.counts[status] += 1
+        self.bytes += num_bytes
+        if status == FAILED:
+            self.write_line('failed: ' + path)
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def rate(self, now):
+        return self.count() / max(now - self.start, 1e-6)
+
+    def report(self, now):
+        if self.total is None:
+            done = '%d images' % self.count()
+        else:
+            done = '%d/%d images' % (self.count(), self.total)
+        line = '%s: %s, %d failed, %.1f images/s' % (
+            self.job, done, self.counts[FAILED], self.rate(now))
+        if self.tty:
+            self.stream.write('\r' + line.ljust(79)[:79])
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def write_line(self, line):
+        if self.tty:
+            self.stream.write('\r' + ' ' * 79 + '\r')
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def summary(self):
+        now = time.time()
+        seconds = now - self.start
+        self.write_line(
+            '%s: %d images in %.1f s (%.1f images/s, %.1f MB/s), '
+            '%d done, %d skipped, %d failed'
+            % (self.job, self.count(), seconds, self.rate(now),
+               self.bytes / max(seconds, 1e-6) / (1024 * 1024),
+               self.counts[DONE], self.counts[SKIPPED],
+               self.counts[FAILED]))
+        if self.counts[LOSSLESS] > 0:
+            self.write_line(
+                '%s: %d images are only rotated by their Exif orientation, '
+                'use --reencode to rotate their pixels'
+                % (self.job, self.counts[LOSSLESS]))
+
+def scanned_images(roots):
+    for root in roots:
+        for image in scan_images(root):
+            yield image
+
+def run_pool(options, function, tasks, progress):
+    """Run 'function' on every task in a process pool, feeding the results
+    to 'progress'."""
+    pool = multiprocessing.Pool(options.processes, init_worker, (options,))
+    try:
+        results = pool.imap_unordered(function, tasks, CHUNK_SIZE)
+        while True:
+            # Waiting without a timeout can not be interrupted with Ctrl+C.
+            try:
+                batch = results.next(1)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            for (status, path, num_bytes) in batch:
+                progress.add(status, path, num_bytes)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def apply_log(options):
+    log = DecisionLog(decision_log_file(options.directories))
+    by_directory = {}
+    for (d, f) in log.discarded():
+        by_directory.setdefault(d, []).append(f)
+    # The biggest directories first, so that no core waits for one at the
+    # end.
+    tasks = sorted(by_directory.items(), key=lambda x: -len(x[1]))
+
+    progress = Progress(options.job, log.pending_count())
+    try:
+        run_pool(options, discard_directory, tasks, progress)
+    finally:
+        # The images that were not moved stay in the log, also when the job
+        # is interrupted.
+        log.compact([(d, f) for (d, f) in log.discarded()
+                     if os.path.exists(d + '/' + f)])
+        log.close()
+    return progress
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Run batch jobs over directory trees of images.')
+    parser.add_argument('job', choices=['orient', 'previews', 'apply-log'])
+    parser.add_argument('directories', nargs='+', metavar='DIRECTORY')
+    parser.add_argument('-j', '--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='how many processes to use (default is one '
+                        'per core)')
+    parser.add_argument('--size', type=parse_size,
+                        help='the size of the image area of the window the '
+                        'previews are made for, as WIDTHxHEIGHT')
+    parser.add_argument('--cache-size', type=int, default=PREVIEW_CACHE_SIZE,
+                        help='the size of the preview cache in bytes')
+    parser.add_argument('--reencode', action='store_true',
+                        help='let the orient job encode the rotated pixels '
+                        'again, which is not lossless for JPEG files')
+    parser.add_argument('--quality', type=int,
+                        help='the quality the oriented images are encoded '
+                        'with, implies --reencode (default is the quality '
+                        'of every JPEG file and the default of the other '
+                        'formats)')
+    options = parser.parse_args(argv)
+    if options.quality is not None:
+        options.reencode = True
+    if options.job == 'previews':
+        if options.size is None:
+            parser.error('the previews job needs --size')
+        options.size = QtCore.QSize(*options.size)
+    options.directories = [os.path.abspath(x) for x in options.directories]
+    return options
+
+def main(argv):
+    options = parse_arguments(argv)
+    try:
+        if options.job == 'apply-log':
+            progress = apply_log(options)
+        else:
+            function = {'orient': orient_image,
+                        'previews': make_preview}[options.job]
+            progress = Progress(options.job)
+            run_pool(options, function, scanned_images(options.directories),
+                     progress)
+            if options.job == 'previews':
+                # Every process only evicted what it knew about.
+                enable_preview_cache(options.cache_size).trim()
+    except KeyboardInterrupt:
+        sys.stderr.write('\n%s: interrupted\n' % options.job)
+        return 130
+    progress.summary()
+    return 1 if progress.counts[FAILED] > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
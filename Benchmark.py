@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+"""
+A reproducible benchmark of the operations that make culling fast or slow.
+
+    python Benchmark.py [options]
+    python Benchmark.py --compare OLD.json NEW.json
+
+A synthetic corpus of photos is generated first: JPEG files of several sizes
+with all eight Exif orientations, in nested directories, some of them inside
+'discarded' directories that the scan must skip. The corpus only depends on
+the options and the seed, so two runs with the same options time the same
+work. Then these are timed, each one many times:
+
+scan -- 'InternalState.get_images_list()' over the whole corpus.
+loader_* -- 'ImageLoader.run()' without preview cache, with a preview cache
+            that does not have the image yet and with one that has it.
+scale_and_rotate_image -- Of the full resolution images.
+throughput_* -- How long a pool of loaders takes to decode all the images of
+                the sample at once, with the loaders decoding in their
+                threads and in the worker processes of the 'ProcessDecoder'.
+                The images per second of the fastest round are also written
+                under 'throughput'.
+next_image, previous_image -- The call alone and followed by
+                              'get_images()', which is what the user waits
+                              for when browsing.
+rotate_current_image -- Also alone and followed by 'get_images()'.
+save_lossless, save_reencode -- 'SaveJob.run()' rewriting the Exif
+                                orientation and encoding the pixels.
+discard_current_image -- The call, and 'discard_move' how long the move of
+                         the file takes in the background.
+
+The results are written as JSON with the count, mean, minimum, maximum and the
+percentiles 50, 90 and 99 of every operation in milliseconds, with the commit
+and the versions they were measured with. '--compare' prints how the
+percentiles of two such files differ.
+
+The worker processes are forked before the QApplication is created, like in
+the GUI.
+
+Qt 4 has no offscreen platform and QPixmap needs a display, so without one
+the benchmark runs itself again under 'xvfb-run'. The caches of the user are
+never touched, everything lives in a temporary directory.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+from PyQt4 import QtGui, QtCore
+import pyexiv2
+
+from ImageCollection import ImageCollection
+from ImageLoader import ImageLoader, scale_and_rotate_image, \
+     set_decode_backend
+from Headless import parse_size
+from InternalState import InternalState
+from PreviewCache import enable_preview_cache
+from ProcessDecoder import ProcessDecoder
+from SaveQueue import SaveJob
+from WorkerPool import WorkerPool
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+DEFAULT_SIZES = [(640, 480), (2048, 1536), (4000, 3000)]
+DEFAULT_VIEWPORT = (1600, 1000)
+PERCENTILES = [50, 90, 99]
+
+# Set by main() once it is known that there is a display.
+APP = None
+# The worker processes for the throughput, None if they are not measured.
+DECODER = None
+
+def percentile(samples, p):
+    """Return the percentile 'p' of a sorted list, interpolating linearly."""
+    if len(samples) == 1:
+        return samples[0]
+    rank = (len(samples) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(samples) - 1)
+    return samples[low] + (samples[high] - samples[low]) * (rank - low)
+
+class Timings:
+    """The durations of every operation, in milliseconds."""
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds * 1000.0)
+
+    def time(self, name, function, *args):
+        start = time.time()
+        result = function(*args)
+        self.add(name, time.time() - start)
+        return result
+
+    def summary(self):
+        result = {}
+        for (name, samples) in self.samples.items():
+            samples = sorted(samples)
+            stats = {'count': len(samples),
+                     'mean': sum(samples) / len(samples),
+                     'min': samples[0],
+                     'max': samples[-1]}
+            for p in PERCENTILES:
+                stats['p%d' % p] = percentile(samples, p)
+            result[name] = stats
+        return result
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+def make_photo(width, height, rng):
+    """Return a QImage with shapes and gradients, so that it compresses like
+    a photo and not like a flat color."""
+    image = QtGui.QImage(width, height, QtGui.QImage.Format_RGB32)
+    painter = QtGui.QPainter(image)
+    gradient = QtGui.QLinearGradient(0, 0, width, height)
+    gradient.setColorAt(0, QtGui.QColor(rng.randint(0, 255),
+                                        rng.randint(0, 255),
+                                        rng.randint(0, 255)))
+    gradient.setColorAt(1, QtGui.QColor(rng.randint(0, 255),
+                                        rng.randint(0, 255),
+                                        rng.randint(0, 255)))
+    painter.fillRect(0, 0, width, height, QtGui.QBrush(gradient))
+    painter.setRenderHint(QtGui.QPainter.Antialiasing)
+    for _ in range(64):
+        painter.setBrush(QtGui.QColor(rng.randint(0, 255), rng.randint(0, 255),
+                                      rng.randint(0, 255),
+                                      rng.randint(64, 255)))
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.drawEllipse(rng.randint(-width // 4, width),
+                            rng.randint(-height // 4, height),
+                            rng.randint(width // 20, width // 2),
+                            rng.randint(height // 20, height // 2))
+    painter.end()
+    return image
+
+def set_orientation(path, orientation):
+    metadata = pyexiv2.metadata.ImageMetadata(path)
+    metadata.read()
+    metadata['Exif.Image.Orientation'] = orientation
+    metadata.write()
+
+def make_corpus(root, num_images, sizes, depth, seed):
+    """Generate the synthetic photos, return how many are outside of the
+    discarded directories.
+
+    Every tenth image goes into a 'discarded' directory. The images cycle
+    through the sizes and the eight orientations.
+    """
+    rng = random.Random(seed)
+    # Encoding is the slow part, so every size is only painted a few times.
+    photos = dict([(size, [make_photo(size[0], size[1], rng)
+                           for _ in range(4)]) for size in sizes])
+    visible = 0
+    for i in range(num_images):
+        parts = ['dir%d' % (i % (3 ** (level + 1)) // (3 ** level))
+                 for level in range(depth)]
+        if i % 10 == 9:
+            parts.append('discarded')
+        else:
+            visible += 1
+        directory = os.path.join(root, *parts)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = sizes[i % len(sizes)]
+        path = os.path.join(directory, 'IMG_%05d.jpg' % i)
+        photos[size][i % 4].save(path, 'JPG', 90)
+        set_orientation(path, i % 8 + 1)
+    return visible
+
+def images_of(internal_state):
+    return [d + '/' + f for (d, f) in internal_state.images_list]
+
+def bench_scan(timings, internal_state, root, repeat):
+    for _ in range(repeat):
+        internal_state.images_list = ImageCollection()
+        timings.time('scan', internal_state.get_images_list, root)
+
+def bench_decode(timings, paths, viewport, cache_directory):
+    for path in paths:
+        timings.time('loader_uncached', ImageLoader(path, viewport).run)
+    enable_preview_cache(1024 ** 3, cache_directory)
+    for path in paths:
+        timings.time('loader_cache_miss', ImageLoader(path, viewport).run)
+    for path in paths:
+        timings.time('loader_cache_hit', ImageLoader(path, viewport).run)
+
+    for path in paths:
+        image = QtGui.QImage(path)
+        timings.time('scale_and_rotate_image', scale_and_rotate_image, image,
+                     path, viewport)
+
+def bench_throughput(timings, paths, viewport, rounds):
+    """Decode all the images at once with a pool of loaders, first in the
+    loader threads and then in the worker processes."""
+    backends = [('threads', None)]
+    if DECODER is not None:
+        backends.append(('processes', DECODER))
+    pool = WorkerPool()
+    throughput = {}
+    try:
+        for (name, backend) in backends:
+            set_decode_backend(backend)
+            best = None
+            for _ in range(rounds):
+                loaders = [ImageLoader(path, viewport) for path in paths]
+                start = time.time()
+                for loader in loaders:
+                    pool.submit(loader, 0)
+                for loader in loaders:
+                    loader.wait()
+                seconds = time.time() - start
+                timings.add('throughput_' + name, seconds)
+                best = seconds if best is None else min(best, seconds)
+            throughput[name] = {'images': len(paths),
+                                'seconds': best,
+                                'images_per_second': len(paths) / best}
+    finally:
+        set_decode_backend(None)
+        pool.shutdown()
+    return throughput
+
+def bench_navigation(timings, internal_state, viewport, delay):
+    """Browse forward through all the images and back again."""
+    def step(name, move):
+        timings.time(name, move, viewport)
+        start = time.time()
+        internal_state.current_pic.get_images()
+        timings.add(name + '_get_images', time.time() - start)
+        # The time the user looks at the image, in which the pre-fetching
+        # goes on.
+        end = time.time() + delay
+        while True:
+            APP.processEvents()
+            if time.time() >= end:
+                break
+            time.sleep(0.001)
+
+    internal_state.jump_to_image(0, viewport)
+    internal_state.current_pic.get_images()
+    for _ in range(len(internal_state.images_list) - 1):
+        step('next_image', internal_state.next_image)
+    for _ in range(len(internal_state.images_list) - 1):
+        step('previous_image', internal_state.previous_image)
+
+def bench_rotation(timings, internal_state, viewport, repeat):
+    for i in range(min(repeat, len(internal_state.images_list))):
+        internal_state.jump_to_image(i, viewport)
+        internal_state.current_pic.get_images()
+        timings.time('rotate_current_image',
+                     internal_state.rotate_current_image, 90, viewport)
+        start = time.time()
+        internal_state.current_pic.get_images()
+        timings.add('rotate_current_image_get_images', time.time() - start)
+    internal_state.transformations = {}
+
+def bench_save(timings, paths):
+    rotation = QtGui.QMatrix()
+    rotation.rotate(90)
+    for path in paths:
+        timings.time('save_lossless', SaveJob(path, rotation, True).run)
+    for path in paths:
+        timings.time('save_reencode', SaveJob(path, rotation, False).run)
+
+def bench_discard(timings, internal_state, viewport, repeat):
+    for _ in range(min(repeat, len(internal_state.images_list))):
+        internal_state.jump_to_image(0, viewport)
+        internal_state.current_pic.get_images()
+        timings.time('discard_current_image',
+                     internal_state.discard_current_image, viewport)
+        timings.time('discard_move', internal_state.file_operations.flush)
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(options, work_directory):
+    viewport = QtCore.QSize(*options.viewport)
+    corpus = os.path.join(work_directory, 'corpus')
+    log('Generating %d images in %s' % (options.images, corpus))
+    visible = make_corpus(corpus, options.images, options.sizes,
+                          options.depth, options.seed)
+
+    timings = Timings()
+    internal_state = InternalState(options.prefetch_ahead,
+                                   options.prefetch_behind,
+                                   options.cache_size)
+    log('Scanning')
+    bench_scan(timings, internal_state, corpus, options.repeat)
+    paths = images_of(internal_state)
+    if len(paths) != visible:
+        log('The scan found %d images instead of %d' % (len(paths), visible))
+    sample = paths[:options.repeat]
+
+    # Before the preview cache is enabled, so that every round decodes.
+    log('Decoding in parallel')
+    throughput = bench_throughput(timings, sample, viewport,
+                                  options.throughput_rounds)
+    log('Decoding')
+    bench_decode(timings, sample, viewport,
+                 os.path.join(work_directory, 'previews'))
+    log('Browsing')
+    bench_navigation(timings, internal_state, viewport,
+                     options.delay / 1000.0)
+    log('Rotating')
+    bench_rotation(timings, internal_state, viewport, options.repeat)
+    # These change the corpus, so they come last.
+    log('Saving')
+    bench_save(timings, sample)
+    log('Discarding')
+    bench_discard(timings, internal_state, viewport, options.repeat)
+
+    return {'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'qt': QtCore.QT_VERSION_STR,
+            'pyqt': QtCore.PYQT_VERSION_STR,
+            'machine': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'options': {'images': options.images,
+                        'sizes': options.sizes,
+                        'depth': options.depth,
+                        'seed': options.seed,
+                        'repeat': options.repeat,
+                        'viewport': options.viewport,
+                        'delay': options.delay,
+                        'prefetch_ahead': options.prefetch_ahead,
+                        'prefetch_behind': options.prefetch_behind,
+                        'cache_size': options.cache_size,
+                        'decode_processes': options.decode_processes,
+                        'throughput_rounds': options.throughput_rounds},
+            'scanned_images': len(paths),
+            'unit': 'ms',
+            'results': timings.summary(),
+            'throughput': throughput}
+
+def compare(old_path, new_path):
+    """Print how the results of two runs differ."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print '%-34s %9s %9s %9s %9s' % ('operation', 'old p50', 'new p50',
+                                      'p50', 'p90')
+    for name in sorted(set(old['results']) | set(new['results'])):
+        if name not in old['results'] or name not in new['results']:
+            print '%-34s only in one of the runs' % name
+            continue
+        (a, b) = (old['results'][name], new['results'][name])
+        changes = ['%+8.1f%%' % ((b[p] - a[p]) / max(a[p], 1e-6) * 100)
+                   for p in ('p50', 'p90')]
+        print '%-34s %9.2f %9.2f %s' % (name, a['p50'], b['p50'],
+                                        ' '.join(changes))
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Time scanning, decoding, browsing, saving and '
+        'discarding on a synthetic corpus.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare the results of two runs and exit')
+    parser.add_argument('-o', '--output',
+                        help='where to write the results (default is stdout)')
+    parser.add_argument('--images', type=int, default=200,
+                        help='how many images the corpus has')
+    parser.add_argument('--sizes', type=parse_size, nargs='+',
+                        default=DEFAULT_SIZES, metavar='WIDTHxHEIGHT',
+                        help='the sizes of the images')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='how deep the directories are nested')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='how many times the operations that are not '
+                        'done for every image are timed')
+    parser.add_argument('--viewport', type=parse_size,
+                        default=DEFAULT_VIEWPORT, metavar='WIDTHxHEIGHT',
+                        help='the size of the image area of the window')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='how many milliseconds every image is looked '
+                        'at while browsing')
+    parser.add_argument('--prefetch-ahead', type=int, default=5)
+    parser.add_argument('--prefetch-behind', type=int, default=2)
+    parser.add_argument('--cache-size', type=int, default=512 * 1024 * 1024,
+                        help='the size of the image cache in bytes')
+    parser.add_argument('--decode-processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='how many worker processes decode for the '
+                        'throughput, 0 to only measure the threads (default '
+                        'is one per core)')
+    parser.add_argument('--throughput-rounds', type=int, default=3,
+                        help='how many times every backend decodes the '
+                        'sample')
+    parser.add_argument('--keep', action='store_true',
+                        help='do not delete the corpus')
+    return parser.parse_args(argv)
+
+def main(argv):
+    global APP, DECODER
+    options = parse_arguments(argv)
+    if options.compare:
+        compare(*options.compare)
+        return 0
+
+    if sys.platform.startswith('linux') and not os.environ.get('DISPLAY') \
+           and not os.environ.get('BENCHMARK_UNDER_XVFB'):
+        environment = dict(os.environ, BENCHMARK_UNDER_XVFB='1')
+        try:
+            return subprocess.call(['xvfb-run', '-a', sys.executable,
+                                    os.path.abspath(__file__)] + argv,
+                                   env=environment)
+        except OSError:
+            log('There is no display and xvfb-run was not found.')
+            return 1
+
+    work_directory = tempfile.mkdtemp(prefix='photoChooser-benchmark-')
+    # Sessions, logs and previews go to the temporary directory too.
+    os.environ['XDG_CACHE_HOME'] = os.path.join(work_directory, 'cache')
+    if options.decode_processes > 0:
+        DECODER = ProcessDecoder(options.decode_processes)
+    APP = QtGui.QApplication(sys.argv[:1])
+    try:
+        results = run(options, work_directory)
+    finally:
+        if DECODER is not None:
+            DECODER.shutdown()
+        if options.keep:
+            log('The corpus is in ' + work_directory)
+        else:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output is None:
+        print text
+    else:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+A log of the images that were discarded but not moved yet.
+
+In the deferred discard mode discarding an image does not move it. The
+decision is only appended to the 'DecisionLog' of the chosen directories and
+all the images are moved at once when the user applies the decisions. Undoing
+a discard appends that the image is kept after all, so the log is never
+rewritten while browsing. The last decision about an image is the one that
+counts.
+
+Writes are buffered and the file is synced to disk only every 'batch_size'
+decisions or when 'sync()' is called, so discarding an image never waits for
+the disk. The log lives in the cache directory of the user, there is one per
+set of root directories like for the session files. Every record is made of
+three strings terminated by '\\0': the kind of decision, the directory and the
+filename. A record that was cut by a crash is ignored.
+"""
+
+import os
+import hashlib
+
+from PreviewCache import default_cache_directory
+from Session import normalize_roots
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+DISCARD = 'D'
+KEEP = 'K'
+
+def decision_log_file(roots, directory=None):
+    """Return the path of the decision log of a set of root directories.
+
+    Keyword Arguments:
+    roots -- The directories that were chosen by the user.
+    directory -- Where the logs are stored (default is the user cache
+                 directory)
+    """
+    if directory is None:
+        directory = os.path.join(default_cache_directory(), 'decisions')
+    key = '\0'.join(normalize_roots(roots))
+    return os.path.join(directory, hashlib.sha1(key).hexdigest() + '.log')
+
+def encode_record(kind, directory, filename):
+    return kind + '\0' + directory + '\0' + filename + '\0'
+
+class DecisionLog:
+    """The discard decisions that were not applied yet."""
+    def __init__(self, path, batch_size=64):
+        """Open a log, reading the decisions it already contains.
+
+        Keyword Arguments:
+        path -- The file of the log, it is created if it does not exist.
+        batch_size -- After how many decisions the file is synced to disk
+                      (default is 64)
+        """
+        self.path = path
+        self.batch_size = batch_size
+        # The images whose last decision was to discard them.
+        self.discarded_images = set()
+        self.unsynced = 0
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.f = open(path, 'ab')
+        if not self.read():
+            # New records would be appended to the cut one.
+            self.compact()
+
+    def read(self):
+        """Read the decisions of the file, return False if it ends in a
+        record that was cut."""
+        try:
+            with open(self.path, 'rb') as f:
+                fields = f.read().split('\0')
+        except IOError:
+            return True
+        # The last field is empty or the rest of a record cut by a crash.
+        for i in range(0, len(fields) - 3, 3):
+            (kind, directory, filename) = fields[i:i + 3]
+            if kind == DISCARD:
+                self.discarded_images.add((directory, filename))
+            elif kind == KEEP:
+                self.discarded_images.discard((directory, filename))
+        return (len(fields) - 1) % 3 == 0 and fields[-1] == ''
+
+    def append(self, kind, directory, filename):
+        self.f.write(encode_record(kind, directory, filename))
+        self.unsynced += 1
+        if self.unsynced >= self.batch_size:
+            self.sync()
+
+    def discard(self, directory, filename):
+        self.discarded_images.add((directory, filename))
+        self.append(DISCARD, directory, filename)
+
+    def keep(self, directory, filename):
+        self.discarded_images.discard((directory, filename))
+        self.append(KEEP, directory, filename)
+
+    def is_discarded(self, directory, filename):
+        return (directory, filename) in self.discarded_images
+
+    def discarded(self):
+        """Return a sorted list of tuples (directory, filename)."""
+        return sorted(self.discarded_images)
+
+    def pending_count(self):
+        return len(self.discarded_images)
+
+    def sync(self):
+        """Write the buffered decisions to disk."""
+        if self.unsynced == 0:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def compact(self, images=None):
+        """Rewrite the log so that it only contains the discarded images.
+
+        Keyword Arguments:
+        images -- If it is not None, these images replace the discarded
+                  images, e.g. the ones that could not be moved when the
+                  decisions were applied (default is None)
+        """
+        if images is not None:
+            self.discarded_images = set(images)
+        self.f.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(''.join([encode_record(DISCARD, d, x)
+                             for (d, x) in sorted(self.discarded_images)]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.f = open(self.path, 'ab')
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.f.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+A scanner that looks for images in directory trees.
+
+'scan_images()' is a generator that walks a directory tree and yields a tuple
+(directory, filename) for every image it finds, as soon as it finds it. It uses
+'scandir' when it is available (it is part of 'os' since python 3.5 and there
+is a backport for older versions), which gets the type of every entry from the
+directory listing itself instead of calling 'stat' on it. Directories named
+'discarded' are skipped, since that is where the discarded images are moved to.
+
+'DirectoryScanner' runs 'scan_images()' in a background thread. The images are
+handed over in batches with the signal 'imagesFound(PyQt_PyObject)', which
+receives a list of tuples (directory, filename). The directories that were
+scanned are handed over with the signal 'directoriesFound(PyQt_PyObject)'. When
+the whole tree was scanned the signal 'scanFinished()' is emitted.
+"""
+
+import os
+import time
+from threading import Thread, Event
+
+from PyQt4 import QtCore
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+# I got this list from the Qt documentation of QImage:
+#http://doc.qt.nokia.com/4.7/qimage.html#reading-and-writing-image-files
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.bmp', '.gif', '.png',
+                    '.ppm', '.pmb', '.pgm', '.xbm', '.xpm')
+
+def is_image(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+def is_ignored_directory(name):
+    return name.endswith('discarded')
+
+def list_directory(directory):
+    """Return two lists, the names of the subdirectories and of the files."""
+    directories = []
+    files = []
+
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir():
+                directories.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+        return (directories, files)
+
+    for name in os.listdir(directory):
+        path = directory + '/' + name
+        if os.path.isdir(path):
+            directories.append(name)
+        elif os.path.isfile(path):
+            files.append(name)
+    return (directories, files)
+
+def scan_images(directory, scanned_directories=None):
+    """Yield a tuple (directory, filename) for every image in a tree.
+
+    The images of a directory come before the ones of its subdirectories.
+
+    Keyword Arguments:
+    directory -- The root of the tree.
+    scanned_directories -- If it is a list, every directory that is scanned
+                           is appended to it once all its images were
+                           yielded (default is None)
+    """
+    pending = [str(directory)]
+    while len(pending) > 0:
+        current = pending.pop()
+        try:
+            (directories, files) = list_directory(current)
+        except OSError:
+            continue
+        for f in files:
+            if is_image(f):
+                yield (current, f)
+        # Only now the directory can be watched, otherwise a change in it
+        # would report the images that were not handed over yet as added.
+        if scanned_directories is not None:
+            scanned_directories.append(current)
+
+        subdirectories = [current + '/' + x for x in directories
+                          if not is_ignored_directory(x)]
+        subdirectories.reverse()
+        pending.extend(subdirectories)
+
+class DirectoryScanner(QtCore.QObject):
+    """Scans directory trees in a background thread."""
+    # How many images are handed over at most in a single batch and how many
+    # seconds to wait at most before handing over what was found.
+    BATCH_SIZE = 512
+    BATCH_INTERVAL = 0.1
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        # Every scan gets a new number, batches of older scans are ignored.
+        self.generation = 0
+        self.stop_event = Event()
+        self.scanning = False
+        self.connect(self, QtCore.SIGNAL('batchScanned(PyQt_PyObject)'),
+                     self.batch_scanned)
+
+    def scan(self, directories):
+        """Stop the running scan, if any, and start scanning 'directories'."""
+        self.stop()
+        self.generation += 1
+        self.stop_event = Event()
+        self.scanning = True
+        thread = Thread(target=self.run, args=(self.generation,
+                                               self.stop_event,
+                                               [str(x) for x in directories]))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.scanning = False
+
+    def is_scanning(self):
+        return self.scanning
+
+    def run(self, generation, stop_event, directories):
+        batch = []
+        scanned_directories = []
+        last_emit = time.time()
+        first = True
+        for directory in directories:
+            for image in scan_images(directory, scanned_directories):
+                if stop_event.is_set():
+                    return
+                batch.append(image)
+                now = time.time()
+                # The first image is handed over right away, so that it can be
+                # shown as soon as possible.
+                if first or len(batch) >= self.BATCH_SIZE \
+                       or now - last_emit >= self.BATCH_INTERVAL:
+                    # The generator keeps appending to the same list.
+                    self.emit(QtCore.SIGNAL('batchScanned(PyQt_PyObject)'),
+                              (generation, batch, scanned_directories[:]))
+                    batch = []
+                    del scanned_directories[:]
+                    last_emit = now
+                    first = False
+
+        if stop_event.is_set():
+            return
+        if len(batch) > 0 or len(scanned_directories) > 0:
+            self.emit(QtCore.SIGNAL('batchScanned(PyQt_PyObject)'),
+                      (generation, batch, scanned_directories))
+        self.emit(QtCore.SIGNAL('batchScanned(PyQt_PyObject)'),
+                  (generation, None, None))
+
+    def batch_scanned(self, scanned):
+        (generation, batch, scanned_directories) = scanned
+        if generation != self.generation:
+            return
+        if batch is None:
+            self.scanning = False
+            self.emit(QtCore.SIGNAL('scanFinished()'))
+            return
+        if len(scanned_directories) > 0:
+            self.emit(QtCore.SIGNAL('directoriesFound(PyQt_PyObject)'),
+                      scanned_directories)
+        if len(batch) > 0:
+            self.emit(QtCore.SIGNAL('imagesFound(PyQt_PyObject)'), batch)
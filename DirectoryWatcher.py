@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Watches the scanned directories for images that are added or removed.
+
+The watcher uses a 'QFileSystemWatcher' (inotify on Linux) on every directory
+that was scanned. It remembers which images every directory contains. When a
+directory changes only that directory is listed again and compared to what is
+remembered, the rest of the tree is never scanned again. New subdirectories are
+scanned and watched too.
+
+Changes are collected for a short time before they are handled, so copying
+a lot of files into a directory does not list it once per file. The results
+are emitted with the signals 'imagesAdded(PyQt_PyObject)' and
+'imagesRemoved(PyQt_PyObject)', both with a list of tuples
+(directory, filename). A renamed image is removed and added.
+
+The program itself moves images around (e.g. when discarding them). It has to
+tell the watcher with 'add_images()' and 'forget_images()', so that it does not
+report these changes back.
+"""
+
+import os
+
+from PyQt4 import QtCore
+
+from DirectoryScanner import list_directory, scan_images, is_image, \
+     is_ignored_directory
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+class DirectoryWatcher(QtCore.QObject):
+    """Reports images added to or removed from the watched directories."""
+    def __init__(self, delay=300, parent=None):
+        """Keyword Arguments:
+        delay -- How many milliseconds to collect changes before handling
+                 them (default is 300)
+        """
+        QtCore.QObject.__init__(self, parent)
+        # Maps every watched directory to the set of images it contains.
+        self.contents = {}
+        # Directories that changed and were not handled yet.
+        self.changed = set()
+
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.connect(self.watcher, QtCore.SIGNAL('directoryChanged(QString)'),
+                     self.directory_changed)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.connect(self.timer, QtCore.SIGNAL('timeout()'),
+                     self.handle_changes)
+
+    def reset(self):
+        """Stop watching all directories."""
+        directories = self.watcher.directories()
+        if len(directories) > 0:
+            self.watcher.removePaths(directories)
+        self.contents = {}
+        self.changed = set()
+        self.timer.stop()
+
+    def add_directories(self, directories):
+        new = [x for x in directories if x not in self.contents]
+        for d in new:
+            self.contents[d] = set()
+        if len(new) > 0:
+            self.watcher.addPaths(new)
+
+    def add_images(self, images):
+        for (d, f) in images:
+            self.contents.setdefault(d, set()).add(f)
+
+    def forget_images(self, images):
+        for (d, f) in images:
+            if d in self.contents:
+                self.contents[d].discard(f)
+
+    def directory_changed(self, directory):
+        self.changed.add(str(directory))
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def handle_changes(self):
+        added = []
+        removed = []
+        for directory in self.changed:
+            if directory not in self.contents:
+                continue
+            (new_added, new_removed) = self.update_directory(directory)
+            added.extend(new_added)
+            removed.extend(new_removed)
+        self.changed = set()
+
+        if len(removed) > 0:
+            self.emit(QtCore.SIGNAL('imagesRemoved(PyQt_PyObject)'), removed)
+        if len(added) > 0:
+            self.emit(QtCore.SIGNAL('imagesAdded(PyQt_PyObject)'), added)
+
+    def update_directory(self, directory):
+        """List a directory again and return the images (added, removed)."""
+        if not os.path.isdir(directory):
+            return ([], self.remove_directory(directory))
+
+        try:
+            (directories, files) = list_directory(directory)
+        except OSError:
+            return ([], [])
+
+        known = self.contents[directory]
+        current = set([x for x in files if is_image(x)])
+        added = [(directory, x) for x in sorted(current - known)]
+        removed = [(directory, x) for x in known - current]
+        self.contents[directory] = current
+
+        # Directories that were created after they were scanned.
+        for d in directories:
+            path = directory + '/' + d
+            if is_ignored_directory(d) or path in self.contents:
+                continue
+            scanned_directories = []
+            new_images = list(scan_images(path, scanned_directories))
+            self.add_directories(scanned_directories)
+            self.add_images(new_images)
+            added.extend(new_images)
+
+        return (added, removed)
+
+    def remove_directory(self, directory):
+        """Stop watching a directory that was deleted and its subdirectories.
+
+        Returns the images that were in them.
+        """
+        removed = []
+        prefix = directory + '/'
+        for d in [x for x in self.contents
+                  if x == directory or x.startswith(prefix)]:
+            removed.extend([(d, x) for x in self.contents.pop(d)])
+            self.watcher.removePath(d)
+        return removed
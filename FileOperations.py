@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Moves files in the background.
+
+Discarding an image means moving it into the directory 'discarded' next to it.
+When that directory is on a different device or behind a slow network share a
+move is a full copy plus a delete, so it is not done in the main thread.
+'FileOperationQueue' runs the moves one after the other in a background thread,
+in the same order they were requested. That way undoing a discard while the
+discard is still running is correct: the file is moved back after it was moved
+away.
+
+Moves within the same device are done with a plain 'os.rename'.
+
+When a move finished the queue emits 'operationFinished(PyQt_PyObject)' with
+the 'MoveJob' as argument and if it failed also 'operationFailed(QString)'
+with a message that can be shown to the user. 'pendingChanged(int)' tells how
+many moves are still waiting.
+
+'discard_all()' moves many images at once, e.g. when the decisions of a
+'DecisionLog' are applied. The directories are handled in parallel, the images
+of a single directory one after the other. 'bulkProgress(int, int)' tells how
+many of the images were handled so far and how many there are in total, and
+'bulkFinished(PyQt_PyObject)' hands over the list of the images that could not
+be moved.
+"""
+
+import os
+import shutil
+
+from PyQt4 import QtCore
+
+from InternalException import InternalException
+from Tracing import span
+from WorkerPool import Job, WorkerPool
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+DISCARDED_DIRECTORY = 'discarded'
+
+def discarded_path(directory, filename):
+    return directory + '/' + DISCARDED_DIRECTORY + '/' + filename
+
+def same_device(src, dst):
+    """Return True if 'src' can be renamed into the directory of 'dst'."""
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+    except OSError:
+        return False
+
+def move_file(src, dst):
+    """Move a file, with a rename if possible.
+
+    The directory of 'dst' is created if it does not exist.
+    """
+    dst_dir = os.path.dirname(dst)
+    if not os.path.exists(dst_dir):
+        os.mkdir(dst_dir)
+    if not os.path.isdir(dst_dir):
+        raise InternalException('A file named ' + dst_dir + ' was found. '
+                                + 'A folder of that name to move the photos '
+                                + 'to could not be created.')
+
+    if same_device(src, dst):
+        os.rename(src, dst)
+    else:
+        shutil.move(src, dst)
+
+class MoveJob(Job):
+    """Move an image into or out of the discarded directory."""
+    DISCARD = 'discard'
+    RESTORE = 'restore'
+
+    def __init__(self, kind, directory, filename):
+        Job.__init__(self)
+        self.kind = kind
+        self.directory = directory
+        self.filename = filename
+        if kind == MoveJob.DISCARD:
+            self.src = directory + '/' + filename
+            self.dst = discarded_path(directory, filename)
+        else:
+            self.src = discarded_path(directory, filename)
+            self.dst = directory + '/' + filename
+
+    def run(self):
+        with span('move_file', {'src': self.src, 'dst': self.dst}):
+            move_file(self.src, self.dst)
+
+class DirectoryDiscardJob(Job):
+    """Move some images of a single directory into its discarded directory.
+    """
+    def __init__(self, directory, filenames):
+        Job.__init__(self)
+        self.directory = directory
+        self.filenames = filenames
+        self.failed = []
+
+    def run(self):
+        for f in self.filenames:
+            try:
+                with span('move_file', {'src': self.directory + '/' + f}):
+                    move_file(self.directory + '/' + f,
+                              discarded_path(self.directory, f))
+            except (IOError, OSError, InternalException):
+                self.failed.append((self.directory, f))
+
+class FileOperationQueue(QtCore.QObject):
+    """Moves images in a background thread, in the order requested."""
+    def __init__(self, bulk_workers=4, parent=None):
+        """Keyword Arguments:
+        bulk_workers -- How many directories 'discard_all()' handles in
+                        parallel (default is 4)
+        """
+        QtCore.QObject.__init__(self, parent)
+        # A single worker keeps the moves in order.
+        self.pool = WorkerPool(1)
+        self.connect(self.pool, QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                     self.job_finished)
+        self.pending = []
+
+        self.bulk_pool = WorkerPool(bulk_workers)
+        self.connect(self.bulk_pool,
+                     QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                     self.bulk_job_finished)
+        self.bulk_jobs = []
+        self.bulk_failed = []
+        self.bulk_total = 0
+        self.bulk_done = 0
+
+    def discard(self, directory, filename):
+        """Move an image into the discarded directory next to it."""
+        return self.submit(MoveJob(MoveJob.DISCARD, directory, filename))
+
+    def restore(self, directory, filename):
+        """Move a discarded image back to its directory."""
+        return self.submit(MoveJob(MoveJob.RESTORE, directory, filename))
+
+    def submit(self, job):
+        self.pending.append(job)
+        # Same priority for all, so the pool keeps them in FIFO order.
+        self.pool.submit(job, 0)
+        self.emit(QtCore.SIGNAL('pendingChanged(int)'), len(self.pending))
+        return job
+
+    def pending_count(self):
+        return len(self.pending)
+
+    def job_finished(self, job):
+        if job not in self.pending:
+            # Already handled by flush().
+            return
+        self.pending.remove(job)
+        self.emit(QtCore.SIGNAL('pendingChanged(int)'), len(self.pending))
+        self.emit(QtCore.SIGNAL('operationFinished(PyQt_PyObject)'), job)
+        if job.error is not None:
+            self.emit(QtCore.SIGNAL('operationFailed(QString)'),
+                      'It was not possible to move ' + job.src + ' to '
+                      + job.dst + ': ' + str(job.error))
+
+    def flush(self):
+        """Wait until all the pending single moves are done."""
+        for job in list(self.pending):
+            job.wait()
+            self.job_finished(job)
+
+    def flush_bulk(self):
+        """Wait until 'discard_all()' is done."""
+        for job in list(self.bulk_jobs):
+            job.wait()
+            self.bulk_job_finished(job)
+
+    def discard_all(self, images):
+        """Move many images into their discarded directories.
+
+        The single moves that are still pending are done first, so that the
+        images end up where the user saw them last.
+        """
+        self.flush()
+        by_directory = {}
+        for (d, f) in images:
+            by_directory.setdefault(d, []).append(f)
+
+        self.bulk_failed = []
+        self.bulk_total = len(images)
+        self.bulk_done = 0
+        if self.bulk_total == 0:
+            self.emit(QtCore.SIGNAL('bulkFinished(PyQt_PyObject)'), [])
+            return
+        self.emit(QtCore.SIGNAL('bulkProgress(int, int)'), 0, self.bulk_total)
+        for (d, filenames) in by_directory.items():
+            job = DirectoryDiscardJob(d, filenames)
+            self.bulk_jobs.append(job)
+            # Big directories first, so that they do not finish last.
+            self.bulk_pool.submit(job, -len(filenames))
+
+    def is_applying(self):
+        return len(self.bulk_jobs) > 0
+
+    def bulk_job_finished(self, job):
+        if job not in self.bulk_jobs:
+            return
+        self.bulk_jobs.remove(job)
+        if job.error is not None:
+            self.bulk_failed.extend([(job.directory, x)
+                                     for x in job.filenames])
+        else:
+            self.bulk_failed.extend(job.failed)
+        self.bulk_done += len(job.filenames)
+        self.emit(QtCore.SIGNAL('bulkProgress(int, int)'), self.bulk_done,
+                  self.bulk_total)
+        if len(self.bulk_jobs) == 0:
+            self.emit(QtCore.SIGNAL('bulkFinished(PyQt_PyObject)'),
+                      self.bulk_failed)
+
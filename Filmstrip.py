@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+A strip (or grid) of thumbnails of all the images in the list.
+
+'ThumbnailModel' is a Qt item model over the list of images of
+'InternalState'. Qt views only ask the model for the items they are showing, so
+a thumbnail is only made for the tiles that are on screen, no matter how many
+images the list has. Until a thumbnail is ready a placeholder is shown. When
+the list changes only the rows that were inserted or removed are told to the
+view, from the journal of the 'ImageCollection', so the view keeps its scroll
+position and does not lay out every tile again.
+
+The thumbnails are made by 'ThumbnailJob's in a 'WorkerPool' of their own, so
+that they never delay the loaders of the images that are browsed. The preview
+embedded in the file is used if there is one, otherwise the image is decoded at
+the size of the thumbnail. The most recently requested tiles are done first and
+requests for tiles that were scrolled away are cancelled once there are too
+many of them. The thumbnails are kept in an 'ImageCache'.
+
+'Filmstrip' is the view. When a tile is clicked it emits
+'imageActivated(int)' with the position of the image in the list.
+"""
+
+from PyQt4 import QtGui, QtCore
+
+from ImageCache import ImageCache, make_key
+from ImageCollection import INSERTED
+from ImageLoader import load_scaled_image, load_embedded_preview
+from WorkerPool import Job, WorkerPool
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+class ThumbnailJob(Job):
+    """Make the thumbnail of an image in a background thread."""
+    def __init__(self, path, size, matrix):
+        Job.__init__(self)
+        self.path = path
+        self.size = size
+        self.matrix = matrix
+        self.key = make_key(path, size, matrix)
+        self.image = None
+
+    def run(self):
+        self.image = load_embedded_preview(self.path, self.size, self.matrix)
+        if self.image is None:
+            self.image = load_scaled_image(self.path, self.size, self.matrix)
+
+class ThumbnailModel(QtCore.QAbstractListModel):
+    """The images of an 'InternalState' as a list model with thumbnails."""
+    # How many requests may wait at most. The oldest ones are for tiles that
+    # were most likely scrolled away already.
+    MAX_PENDING = 256
+
+    def __init__(self, internal_state, thumbnail_size=QtCore.QSize(96, 96),
+                 cache_size=64 * 1024 * 1024, num_workers=1, parent=None):
+        """Keyword Arguments:
+        internal_state -- Where the list of images comes from.
+        thumbnail_size -- The size of the thumbnails (default is 96x96)
+        cache_size -- How many bytes of thumbnails are kept in memory
+                      (default is 64MB)
+        num_workers -- How many threads make thumbnails (default is 1)
+        """
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.internal_state = internal_state
+        self.thumbnail_size = QtCore.QSize(thumbnail_size)
+        self.cache = ImageCache(cache_size)
+        self.placeholder = QtGui.QPixmap(self.thumbnail_size)
+        self.placeholder.fill(QtCore.Qt.lightGray)
+
+        self.pool = WorkerPool(num_workers)
+        self.connect(self.pool, QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                     self.job_finished)
+        # Maps the cache key of every requested thumbnail to its job.
+        self.pending = {}
+        # Newer requests get a lower number, so they run first.
+        self.next_priority = 0
+
+        # The collection and its number of modifications the model shows.
+        self.images_list = None
+        self.modifications = None
+        # The number of rows the view knows about, which lags behind the
+        # collection while the changes are told to the view.
+        self.rows = 0
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.rows
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        # The collection may have changed since the last 'update()'.
+        if not index.isValid() or index.row() >= self.rowCount() \
+               or index.row() >= len(self.images_list):
+            return QtCore.QVariant()
+        (d, f) = self.images_list[index.row()]
+        if role == QtCore.Qt.DecorationRole:
+            return QtCore.QVariant(self.thumbnail(d + '/' + f))
+        elif role == QtCore.Qt.ToolTipRole:
+            return QtCore.QVariant(d + '/' + f)
+        return QtCore.QVariant()
+
+    def thumbnail(self, path):
+        """Return the thumbnail of an image or a placeholder.
+
+        If the thumbnail is not in the cache it is requested.
+        """
+        matrix = self.internal_state.get_transformation(path)
+        if matrix is None:
+            matrix = QtGui.QMatrix()
+        key = make_key(path, self.thumbnail_size, matrix)
+        images = self.cache.get(key)
+        if images is not None:
+            return images[0]
+        self.request(path, matrix, key)
+        return self.placeholder
+
+    def request(self, path, matrix, key):
+        self.next_priority -= 1
+        job = self.pending.get(key)
+        if job is not None:
+            self.pool.set_priority(job, self.next_priority)
+            return
+        job = ThumbnailJob(path, self.thumbnail_size, matrix)
+        self.pending[key] = job
+        self.pool.submit(job, self.next_priority)
+
+        if len(self.pending) > self.MAX_PENDING:
+            oldest = sorted(self.pending.values(),
+                            key=lambda x: x.priority, reverse=True)
+            for job in oldest[:len(self.pending) - self.MAX_PENDING]:
+                self.pool.cancel(job)
+                if not job.taken:
+                    del self.pending[job.key]
+
+    def job_finished(self, job):
+        if self.pending.get(job.key) is not job:
+            return
+        del self.pending[job.key]
+        if job.image is None or job.image.isNull():
+            return
+        self.cache.put(job.key, (QtGui.QPixmap.fromImage(job.image),))
+
+        (d, f) = job.path.rsplit('/', 1)
+        row = self.internal_state.index_of(d, f)
+        if row != -1 and row < self.rows:
+            index = self.index(row)
+            self.emit(QtCore.SIGNAL(
+                'dataChanged(const QModelIndex &, const QModelIndex &)'),
+                      index, index)
+
+    def update(self):
+        """Show the current list of images, if it changed."""
+        images_list = self.internal_state.images_list
+        changes = None
+        if images_list is self.images_list:
+            changes = images_list.changes_since(self.modifications)
+        if changes is None:
+            self.beginResetModel()
+            self.images_list = images_list
+            self.modifications = images_list.modifications
+            self.rows = len(images_list)
+            self.endResetModel()
+            return
+
+        self.modifications = images_list.modifications
+        root = QtCore.QModelIndex()
+        for (kind, pos, count) in changes:
+            if count == 0:
+                continue
+            if kind == INSERTED:
+                self.beginInsertRows(root, pos, pos + count - 1)
+                self.rows += count
+                self.endInsertRows()
+            else:
+                self.beginRemoveRows(root, pos, pos + count - 1)
+                self.rows -= count
+                self.endRemoveRows()
+
+    def invalidate_path(self, path):
+        """Forget the thumbnails of an image, e.g. because it was saved."""
+        self.cache.invalidate_path(path)
+
+class Filmstrip(QtGui.QListView):
+    """A view of a 'ThumbnailModel' as a strip or as a grid."""
+    def __init__(self, model, grid=False, parent=None):
+        """Keyword Arguments:
+        model -- The ThumbnailModel to show.
+        grid -- If True the thumbnails wrap into several rows, otherwise they
+                are shown in a single row (default is False)
+        """
+        QtGui.QListView.__init__(self, parent)
+        self.setModel(model)
+        # The list mode lays out the tiles by their position alone, the icon
+        # mode keeps a rectangle for every tile.
+        self.setViewMode(QtGui.QListView.ListMode)
+        self.setFlow(QtGui.QListView.LeftToRight)
+        self.setWrapping(grid)
+        self.setMovement(QtGui.QListView.Static)
+        self.setResizeMode(QtGui.QListView.Adjust)
+        # All the tiles have the same size, so the view does not need to ask
+        # the model about every tile to lay them out.
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QtGui.QListView.Batched)
+        self.setIconSize(model.thumbnail_size)
+        self.setGridSize(model.thumbnail_size + QtCore.QSize(8, 8))
+        self.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
+        # The keys have to reach the shortcuts of the main window.
+        self.setFocusPolicy(QtCore.Qt.NoFocus)
+        if not grid:
+            self.setHorizontalScrollMode(
+                QtGui.QAbstractItemView.ScrollPerPixel)
+            scroll_bar = self.horizontalScrollBar().sizeHint().height()
+            self.setFixedHeight(self.gridSize().height() + scroll_bar
+                                + 2 * self.frameWidth())
+
+        self.connect(self, QtCore.SIGNAL('clicked(const QModelIndex &)'),
+                     self.tile_clicked)
+
+    def tile_clicked(self, index):
+        self.emit(QtCore.SIGNAL('imageActivated(int)'), index.row())
+
+    def set_current(self, pos):
+        """Select the tile of the image at 'pos' and scroll to it."""
+        if pos < 0 or pos >= self.model().rowCount():
+            self.clearSelection()
+            return
+        index = self.model().index(pos)
+        if self.currentIndex() != index:
+            self.setCurrentIndex(index)
+        self.scrollTo(index, QtGui.QAbstractItemView.PositionAtCenter)
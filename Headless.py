@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Helpers for the code that runs without the GUI.
+
+'init_worker_process()' prepares a process of a multiprocessing pool to decode
+images, it is used by the batch jobs and by the 'ProcessDecoder'.
+'parse_size()' reads the sizes given on the command line of the tools.
+"""
+
+import signal
+import argparse
+
+from PyQt4 import QtCore
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+# The application of a worker process, set by init_worker_process().
+APP = None
+
+def init_worker_process(name):
+    """Prepare a worker process of a pool, call it from the initializer.
+
+    Ctrl+C is left to the main process, which stops the pool. Without an
+    application Qt may not find the plugins of the image formats, so a
+    QCoreApplication is created, which needs no display.
+    """
+    global APP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    APP = QtCore.QCoreApplication([name])
+
+def parse_size(text):
+    """Return a tuple (width, height) from a size like '1600x1000'."""
+    try:
+        (width, height) = [int(x) for x in text.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected WIDTHxHEIGHT, not %r'
+                                         % text)
+    return (width, height)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+A memory bounded LRU cache for decoded images.
+
+The cache keeps the pixmaps that were decoded by 'ImageLoader' so that going
+back and forth over a set of images does not decode them again from disk.
+Entries are keyed by the path of the image, the size of the viewport it was
+scaled to and the transformation matrix that was applied to it. The cache is
+bounded by the number of bytes the images use and not by the number of
+entries, since a single 50MP image weighs as much as hundreds of small ones.
+"""
+
+from collections import OrderedDict
+
+from PyQt4 import QtGui
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+def image_size_in_bytes(image):
+    """Return the approximate number of bytes used by a QImage or QPixmap."""
+    if image is None or image.isNull():
+        return 0
+    return image.width() * image.height() * max(image.depth(), 8) // 8
+
+def matrix_key(matrix):
+    """Return a hashable representation of a transformation matrix."""
+    return (matrix.m11(), matrix.m12(), matrix.m21(), matrix.m22(),
+            matrix.dx(), matrix.dy())
+
+def make_key(path, viewport_size, matrix=QtGui.QMatrix()):
+    """Return the key used to store an image in an 'ImageCache'.
+
+    Keyword Arguments:
+    path -- The file path to the image.
+    viewport_size -- The size the image was scaled to.
+    matrix -- The transformation matrix applied to the image
+              (default is identity)
+    """
+    return (str(path), viewport_size.width(), viewport_size.height(),
+            matrix_key(matrix))
+
+class ImageCache:
+    """A LRU cache of images that evicts entries by a byte budget."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps a key to a tuple (images, size in bytes). The most recently
+        # used entries are at the end.
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Return the images stored for 'key' or None."""
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        (images, _) = entry
+        return images
+
+    def put(self, key, images):
+        """Store a tuple of images under 'key'.
+
+        If the entry is bigger than the whole budget it is not stored at all.
+        """
+        size = sum([image_size_in_bytes(x) for x in images])
+        self.remove(key)
+
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = (images, size)
+        self.used_bytes += size
+        self.shrink(self.max_bytes)
+
+    def remove(self, key):
+        if key in self.entries:
+            (_, size) = self.entries.pop(key)
+            self.used_bytes -= size
+
+    def invalidate_path(self, path):
+        """Remove all the entries that belong to the file 'path'."""
+        path = str(path)
+        for key in [x for x in self.entries if x[0] == path]:
+            self.remove(key)
+
+    def shrink(self, max_bytes):
+        """Evict the least recently used entries until 'max_bytes' is met."""
+        while self.used_bytes > max_bytes and len(self.entries) > 0:
+            (_, (_, size)) = self.entries.popitem(last=False)
+            self.used_bytes -= size
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
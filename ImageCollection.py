@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+A compact, list-like collection of images for very big libraries.
+
+'ImageCollection' behaves like the list of tuples (directory, filename) that
+'InternalState' used before, but it scales to millions of images:
+- Every directory is stored only once. The images keep the id of their
+  directory in an array instead of a reference to a string.
+- The images are stored in chunks of at most a couple of thousand images. A
+  Fenwick tree over the sizes of the chunks finds the chunk of a position in
+  O(log n), so accessing, inserting and deleting at any position costs
+  O(log n) plus the size of a chunk instead of O(n).
+- Every directory knows in which chunks it has images, so an image can be
+  found without looking at the whole collection.
+
+The last changes are kept in a journal, so that views can update only the rows
+that changed ('changes_since()') instead of showing everything again.
+
+'dump()' and 'load()' convert the collection to and from a compact form made
+only of strings, which is what is stored in the session files.
+"""
+
+from array import array
+from collections import deque
+
+# Kinds of changes in the journal.
+INSERTED = 'inserted'
+REMOVED = 'removed'
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+class Chunk:
+    """A consecutive part of the collection."""
+    def __init__(self):
+        self.dirs = array('i')
+        self.names = []
+        # Position of the chunk in ImageCollection.chunks.
+        self.index = 0
+        # Maps the id of every directory in the chunk to how many of its
+        # images are in the chunk.
+        self.dir_counts = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def insert(self, offset, dir_id, name):
+        self.dirs.insert(offset, dir_id)
+        self.names.insert(offset, name)
+        self.dir_counts[dir_id] = self.dir_counts.get(dir_id, 0) + 1
+
+    def append(self, dir_id, name):
+        self.dirs.append(dir_id)
+        self.names.append(name)
+        self.dir_counts[dir_id] = self.dir_counts.get(dir_id, 0) + 1
+
+    def delete(self, offset):
+        """Delete an image and return the id of its directory."""
+        dir_id = self.dirs[offset]
+        del self.dirs[offset]
+        del self.names[offset]
+        self.dir_counts[dir_id] -= 1
+        if self.dir_counts[dir_id] == 0:
+            del self.dir_counts[dir_id]
+        return dir_id
+
+    def split(self):
+        """Move the second half of the chunk into a new chunk."""
+        half = len(self) // 2
+        other = Chunk()
+        for i in range(half, len(self)):
+            other.append(self.dirs[i], self.names[i])
+        for i in range(len(self) - 1, half - 1, -1):
+            self.delete(i)
+        return other
+
+class ImageCollection:
+    """A list of tuples (directory, filename) optimized for size."""
+    CHUNK_SIZE = 1024
+    # How many changes the journal keeps.
+    MAX_CHANGES = 1024
+
+    def __init__(self, images=()):
+        # Interned directories.
+        self.directories = []
+        self.directory_ids = {}
+        # Maps the id of every directory to the set of chunks with its images.
+        self.directory_chunks = {}
+
+        self.chunks = []
+        # Fenwick tree over the sizes of the chunks, 1-based.
+        self.tree = [0]
+        self.length = 0
+        # Grows every time the collection changes, so that views can tell if
+        # they are up to date.
+        self.modifications = 0
+        # Tuples (modifications, kind, position, count) of the last changes.
+        self.changes = deque(maxlen=self.MAX_CHANGES)
+
+        self.extend(images)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for i in range(len(chunk)):
+                yield (self.directories[chunk.dirs[i]], chunk.names[i])
+
+    def __getitem__(self, pos):
+        (chunk, offset) = self.find(pos)
+        return (self.directories[chunk.dirs[offset]], chunk.names[offset])
+
+    def __delitem__(self, pos):
+        (chunk, offset) = self.find(pos)
+        dir_id = chunk.delete(offset)
+        if dir_id not in chunk.dir_counts:
+            self.directory_chunks[dir_id].discard(chunk)
+        self.length -= 1
+        self.modifications += 1
+        self.changes.append((self.modifications, REMOVED, pos, 1))
+
+        if len(chunk) == 0:
+            del self.chunks[chunk.index]
+            self.rebuild()
+        else:
+            self.add(chunk.index, -1)
+
+    def insert(self, pos, image):
+        if pos < 0:
+            pos = max(0, pos + self.length)
+        pos = min(pos, self.length)
+        (directory, name) = image
+        dir_id = self.intern(directory)
+
+        if len(self.chunks) == 0:
+            self.chunks.append(Chunk())
+            self.rebuild()
+        if pos == self.length:
+            chunk = self.chunks[-1]
+            offset = len(chunk)
+        else:
+            (chunk, offset) = self.find(pos)
+
+        chunk.insert(offset, dir_id, name)
+        self.directory_chunks[dir_id].add(chunk)
+        self.length += 1
+        self.modifications += 1
+        self.changes.append((self.modifications, INSERTED, pos, 1))
+
+        if len(chunk) > 2 * self.CHUNK_SIZE:
+            self.split(chunk)
+        else:
+            self.add(chunk.index, 1)
+
+    def append(self, image):
+        self.insert(self.length, image)
+
+    def extend(self, images):
+        """Append many images, rebuilding the index only once."""
+        start = self.length
+        if len(self.chunks) == 0:
+            self.chunks.append(Chunk())
+        chunk = self.chunks[-1]
+        for (directory, name) in images:
+            if len(chunk) >= self.CHUNK_SIZE:
+                chunk = Chunk()
+                self.chunks.append(chunk)
+            dir_id = self.intern(directory)
+            chunk.append(dir_id, name)
+            self.directory_chunks[dir_id].add(chunk)
+            self.length += 1
+        self.modifications += 1
+        self.changes.append((self.modifications, INSERTED, start,
+                             self.length - start))
+        self.rebuild()
+
+    def index(self, image):
+        """Return the position of an image. Raises ValueError like a list."""
+        (directory, name) = image
+        dir_id = self.directory_ids.get(directory)
+        if dir_id is not None:
+            for chunk in sorted(self.directory_chunks[dir_id],
+                                key=lambda x: x.index):
+                for i in range(len(chunk)):
+                    if chunk.dirs[i] == dir_id and chunk.names[i] == name:
+                        return self.prefix(chunk.index) + i
+        raise ValueError(str(image) + ' is not in the collection')
+
+    def last_index_of_directory(self, directory):
+        """Return the position of the last image of a directory or -1."""
+        dir_id = self.directory_ids.get(directory)
+        if dir_id is None or len(self.directory_chunks[dir_id]) == 0:
+            return -1
+        chunk = max(self.directory_chunks[dir_id], key=lambda x: x.index)
+        for i in range(len(chunk) - 1, -1, -1):
+            if chunk.dirs[i] == dir_id:
+                return self.prefix(chunk.index) + i
+        return -1
+
+    def dump(self):
+        """Return the collection as a tuple of three strings.
+
+        The first one has all the directories, the second one the id of the
+        directory of every image and the third one the filenames.
+        """
+        dirs = array('i')
+        names = []
+        for chunk in self.chunks:
+            dirs.extend(chunk.dirs)
+            names.extend(chunk.names)
+        return ('\0'.join(self.directories), dirs.tostring(),
+                '\0'.join(names))
+
+    def load(self, dumped):
+        """Replace the contents of the collection with a dumped collection."""
+        (directories, dirs_string, names) = dumped
+        dirs = array('i')
+        dirs.fromstring(dirs_string)
+        directories = directories.split('\0')
+        if len(dirs) == 0:
+            names = []
+        else:
+            names = names.split('\0')
+
+        # The journal starts again, views have to show everything again.
+        modifications = self.modifications + 1
+        self.__init__()
+        self.modifications = modifications
+        self.extend([(directories[dirs[i]], names[i])
+                     for i in range(len(dirs))])
+
+    def changes_since(self, modifications):
+        """Return the changes made after the collection had 'modifications'
+        as a list of tuples (kind, position, count), in order, or None if the
+        journal does not reach back that far."""
+        if modifications > self.modifications:
+            return None
+        changes = [x[1:] for x in self.changes if x[0] > modifications]
+        if len(changes) != self.modifications - modifications:
+            return None
+        return changes
+
+    def intern(self, directory):
+        """Return the id of a directory, adding it if it is new."""
+        dir_id = self.directory_ids.get(directory)
+        if dir_id is None:
+            dir_id = len(self.directories)
+            self.directories.append(directory)
+            self.directory_ids[directory] = dir_id
+            self.directory_chunks[dir_id] = set()
+        return dir_id
+
+    def find(self, pos):
+        """Return the chunk that contains a position and the offset in it."""
+        if pos < 0:
+            pos += self.length
+        if pos < 0 or pos >= self.length:
+            raise IndexError('ImageCollection index out of range')
+
+        n = len(self.chunks)
+        index = 0
+        bit = 1
+        while bit * 2 <= n:
+            bit *= 2
+        while bit > 0:
+            candidate = index + bit
+            if candidate <= n and self.tree[candidate] <= pos:
+                index = candidate
+                pos -= self.tree[candidate]
+            bit //= 2
+        return (self.chunks[index], pos)
+
+    def prefix(self, chunk_index):
+        """Return how many images are in the chunks before 'chunk_index'."""
+        total = 0
+        i = chunk_index
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def add(self, chunk_index, delta):
+        i = chunk_index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def split(self, chunk):
+        other = chunk.split()
+        for dir_id in other.dir_counts:
+            self.directory_chunks[dir_id].add(other)
+            if dir_id not in chunk.dir_counts:
+                self.directory_chunks[dir_id].discard(chunk)
+        self.chunks.insert(chunk.index + 1, other)
+        self.rebuild()
+
+    def rebuild(self):
+        """Build the Fenwick tree and the chunk indices again in O(chunks)."""
+        n = len(self.chunks)
+        self.tree = [0] * (n + 1)
+        for (i, chunk) in enumerate(self.chunks):
+            chunk.index = i
+            self.tree[i + 1] += len(chunk)
+            parent = (i + 1) + ((i + 1) & -(i + 1))
+            if parent <= n:
+                self.tree[parent] += self.tree[i + 1]
@@ -2,15 +2,31 @@
 """
 A threaded ImageLoader.
 
-A threaded image loader. It will do two things:
-1. Load a 'QImage' into 'self.image' that is the exact image that was read from
-   the filname given in the constructor.
-2. It will make a copy of the read 'self.image', attempt to read the Exif
-   metadata of the image file, get the orientation from the metadata, rotate the
-   image accordingly and finaly scale it the size of the viewport. The size of
-   the viewport must also be passed as an argument to the constructor. The
-   transformed image will be put in 'self.scaledImage'. A transformation matrix
-   can be passed and it will be used too.
+An image loader that is run by a 'WorkerPool'. It will attempt to read the
+Exif metadata of the image file, get the orientation from the metadata and
+compute the size the image will have once it is rotated accordingly and scaled
+to the size of the viewport. The size of the viewport must also be passed as an
+argument to the constructor. A transformation matrix can be passed and it will
+be used too. The decoder is then asked directly for an image of that size,
+which for JPEG files means that only a reduced version of the image is decoded
+(DCT scaling) instead of the full resolution image. The transformed image will
+be put in 'self.image_scaled'.
+
+Before decoding anything the loader looks for the image in the persistent
+'PreviewCache'. If it is there it is used as the scaled image, otherwise the
+decoded image is stored there for the next time.
+
+The full resolution image is not loaded by the ImageLoader. Browsing only needs
+the scaled image, the full resolution one is loaded lazily by whoever needs it
+(e.g. to zoom or to save the image) and 'self.image' stays None.
+
+The loader is a 'Job', so it is not a thread by itself. It has to be submitted
+to a 'WorkerPool', which decides when it runs and can cancel it before it
+does.
+
+The decoding itself can be done somewhere else by a decode backend, e.g. the
+worker processes of the 'ProcessDecoder' (see 'set_decode_backend()'). The
+loader still runs in the thread of the pool, which waits for the backend.
 
 The reason why QImage is used and not QPixmap ---even though it may have to be
 converted later to QPixmap to be shown--- is that QPixmap can not be used
@@ -20,11 +36,17 @@ Some of the functions that ImageLoader uses are useful in other places aswell.
 Thus these functions are not part of the ImageLoader, but are global functions.
 """
 
-from threading import Thread
+import os
+import struct
 
 from PyQt4 import QtGui, QtCore
 import pyexiv2
 
+from MetadataCache import get_metadata, METADATA_CACHE
+from PreviewCache import get_preview_cache
+from Tracing import span
+from WorkerPool import Job
+
 __author__ = "Fernando Sanchez Villaamil"
 __copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
 __credits__ = ["Fernando Sanchez Villaamil"]
@@ -34,6 +56,17 @@ __maintainer__ = "Fernando Sanchez Villaamil"
 __email__ = "nano@moomug.com"
 __status__ = "Just for fun!"
 
+# Decodes the images of the loaders instead of the loaders themselves. None
+# means that the loaders decode in their own thread.
+DECODE_BACKEND = None
+
+def set_decode_backend(backend):
+    """Make the loaders decode through 'backend', an object with a method
+    'decode(loader)' that returns the scaled image of the loader. None makes
+    them decode in their own thread again."""
+    global DECODE_BACKEND
+    DECODE_BACKEND = backend
+
 def scale_and_rotate_image(to_scale, filename, maximum_viewport_size,
                            matrix=QtGui.QMatrix()):
     """Returns a scaled and rotated version of an image.
@@ -44,9 +77,102 @@ def scale_and_rotate_image(to_scale, filename, maximum_viewport_size,
     maximum_viewport_size -- The size to which the image has to be scaled.
     matrix -- A transformation matrix (default is identity)
     """
-    to_scale = rotate_image(to_scale, filename, matrix)
-    
-    return to_scale.scaled(maximum_viewport_size, QtCore.Qt.KeepAspectRatio)
+    with span('scale_and_rotate_image'):
+        to_scale = rotate_image(to_scale, filename, matrix)
+
+        return to_scale.scaled(maximum_viewport_size,
+                               QtCore.Qt.KeepAspectRatio)
+
+def oriented_size(filename, matrix=QtGui.QMatrix()):
+    """Return the size of an image once it is rotated, without decoding it.
+
+    Returns an invalid QSize if the size can not be read.
+
+    Keyword Arguments:
+    filename -- The file path to the image.
+    matrix -- A transformation matrix (default is identity)
+    """
+    full_size = QtGui.QImageReader(filename).size()
+    if not full_size.isValid():
+        return full_size
+    rect = QtCore.QRectF(0, 0, full_size.width(), full_size.height())
+    rotated = (orientation_matrix(filename) * matrix).mapRect(rect)
+    return rotated.toRect().size()
+
+def load_scaled_image(filename, maximum_viewport_size,
+                      matrix=QtGui.QMatrix()):
+    """Read an image from disk already rotated and scaled to the viewport.
+
+    The decoder is asked for the final size up front, so the full resolution
+    image is never decoded when the format supports reduced decoding.
+
+    Keyword Arguments:
+    filename -- The file path to the image.
+    maximum_viewport_size -- The size to which the image has to be scaled.
+    matrix -- A transformation matrix (default is identity)
+    """
+    reader = QtGui.QImageReader(filename)
+    full_size = reader.size()
+    pre_matrix = orientation_matrix(filename)
+
+    if full_size.isValid():
+        rect = QtCore.QRectF(0, 0, full_size.width(), full_size.height())
+        rotated_size = (pre_matrix * matrix).mapRect(rect).size()
+        factor = min(maximum_viewport_size.width() / rotated_size.width(),
+                     maximum_viewport_size.height() / rotated_size.height())
+        if factor < 1:
+            reader.setScaledSize(
+                QtCore.QSize(max(1, int(round(full_size.width() * factor))),
+                             max(1, int(round(full_size.height() * factor)))))
+
+    image = reader.read()
+    if not pre_matrix.isIdentity():
+        image = image.transformed(pre_matrix)
+    if not matrix.isIdentity():
+        image = image.transformed(matrix)
+
+    return image.scaled(maximum_viewport_size, QtCore.Qt.KeepAspectRatio)
+
+def load_embedded_preview(filename, maximum_viewport_size,
+                          matrix=QtGui.QMatrix()):
+    """Return the preview embedded in the metadata of an image or None.
+
+    Most camera JPEGs and RAW files carry a preview that can be extracted much
+    faster than the image can be decoded. Of all the previews the smallest one
+    that covers the viewport is used, or the biggest one if none does. It is
+    rotated and scaled like the image itself would be.
+
+    Keyword Arguments:
+    filename -- The file path to the image.
+    maximum_viewport_size -- The size to which the preview has to be scaled.
+    matrix -- A transformation matrix (default is identity)
+    """
+    if get_metadata(filename).num_previews == 0:
+        return None
+
+    metadata = pyexiv2.metadata.ImageMetadata(str(filename))
+    try:
+        metadata.read()
+    except IOError:
+        return None
+    previews = sorted(metadata.previews,
+                      key=lambda x: x.dimensions[0] * x.dimensions[1])
+    if len(previews) == 0:
+        return None
+
+    chosen = previews[-1]
+    for preview in previews:
+        (width, height) = preview.dimensions
+        if max(width, height) >= max(maximum_viewport_size.width(),
+                                     maximum_viewport_size.height()):
+            chosen = preview
+            break
+
+    image = QtGui.QImage.fromData(chosen.data)
+    if image.isNull():
+        return None
+    return scale_and_rotate_image(image, filename, maximum_viewport_size,
+                                  matrix)
 
 def rotate_image(to_rotate, filename, matrix=QtGui.QMatrix()):
     """Return a rotated version of an image.
@@ -58,63 +184,287 @@ def rotate_image(to_rotate, filename, matrix=QtGui.QMatrix()):
     filename -- The file path to the image.
     matrix -- A transformation matrix (default is identity)
     """
-    metadata = pyexiv2.metadata.ImageMetadata(str(filename))
-    metadata.read()
-    
-    if 'Exif.Image.Orientation' in metadata.exif_keys:
-        orientation = metadata['Exif.Image.Orientation'].raw_value
-        orientation = int(orientation)
-        pre_matrix = QtGui.QMatrix()
-            
-        if 1 <= orientation <= 2:
-            if orientation == 2:
-                pre_matrix.scale(-1, 1)
-        elif 7 <= orientation <= 8:
-            pre_matrix.rotate(-90)
-            if orientation == 7:
-                pre_matrix.scale(-1, 1)
-        elif 3 <= orientation <= 4:
-            pre_matrix.rotate(180)
-            if orientation == 4:
-                pre_matrix.scale(-1, 1)
-        elif 5 <= orientation <= 6:
-            pre_matrix.rotate(90)
-            if orientation == 5:
-                pre_matrix.scale(-1, 1)
-
-        if (orientation > 8):
-            print Exception('The value for \'Exif.Image.Orientation\' '
-                            + 'is greater than 8, which should never be '
-                            + 'the case. The Orientation shown may be '
-                            + 'wrong.')
-                
-        if not pre_matrix.isIdentity():
-            to_rotate = to_rotate.transformed(pre_matrix)
+    with span('orientation_matrix'):
+        pre_matrix = orientation_matrix(filename)
+    if not pre_matrix.isIdentity():
+        to_rotate = to_rotate.transformed(pre_matrix)
                 
     if not matrix.isIdentity():
         to_rotate = to_rotate.transformed(matrix)
 
     return to_rotate
 
-class ImageLoader(Thread):
+def orientation_matrix(filename):
+    """Return the matrix that rotates an image as its Exif metadata says.
+
+    The metadata is taken from the shared 'MetadataCache', so the file is only
+    parsed again if it changed.
+
+    Keyword Arguments:
+    filename -- The file path to the image.
+    """
+    orientation = get_metadata(filename).orientation
+    if orientation is None:
+        return QtGui.QMatrix()
+    return orientation_to_matrix(orientation)
+
+def orientation_to_matrix(orientation):
+    """Return the matrix that corresponds to a value of the Exif orientation.
+
+    Keyword Arguments:
+    orientation -- The value of 'Exif.Image.Orientation'.
+    """
+    pre_matrix = QtGui.QMatrix()
+
+    if 1 <= orientation <= 2:
+        if orientation == 2:
+            pre_matrix.scale(-1, 1)
+    elif 7 <= orientation <= 8:
+        pre_matrix.rotate(-90)
+        if orientation == 7:
+            pre_matrix.scale(-1, 1)
+    elif 3 <= orientation <= 4:
+        pre_matrix.rotate(180)
+        if orientation == 4:
+            pre_matrix.scale(-1, 1)
+    elif 5 <= orientation <= 6:
+        pre_matrix.rotate(90)
+        if orientation == 5:
+            pre_matrix.scale(-1, 1)
+
+    if (orientation > 8):
+        print Exception('The value for \'Exif.Image.Orientation\' '
+                        + 'is greater than 8, which should never be '
+                        + 'the case. The Orientation shown may be '
+                        + 'wrong.')
+
+    return pre_matrix
+
+def matrix_to_orientation(matrix):
+    """Return the value of the Exif orientation that corresponds to a matrix.
+
+    Returns None if the matrix is not a combination of rotations by multiples
+    of 90 degrees and mirroring, which can not be expressed as an orientation.
+
+    Keyword Arguments:
+    matrix -- A transformation matrix.
+    """
+    def entries(m):
+        return (m.m11(), m.m12(), m.m21(), m.m22())
+
+    for orientation in range(1, 9):
+        candidate = orientation_to_matrix(orientation)
+        differences = [abs(x - y) for (x, y) in zip(entries(candidate),
+                                                     entries(matrix))]
+        if max(differences) < 1e-6:
+            return orientation
+    return None
+
+def save_orientation(filename, matrix):
+    """Apply a transformation to an image by rewriting its Exif orientation.
+
+    No pixel is decoded or encoded again, so this is fast and lossless.
+    Returns False if the transformation can not be expressed as an Exif
+    orientation or the metadata of the file could not be written, in which
+    case the file is left untouched.
+
+    Keyword Arguments:
+    filename -- The file path to the image.
+    matrix -- The transformation matrix to apply on top of the current
+              orientation.
+    """
+    orientation = matrix_to_orientation(orientation_matrix(filename) * matrix)
+    if orientation is None:
+        return False
+
+    metadata = pyexiv2.metadata.ImageMetadata(str(filename))
+    try:
+        metadata.read()
+        metadata['Exif.Image.Orientation'] = orientation
+        metadata.write()
+    except (IOError, KeyError, ValueError):
+        return False
+    finally:
+        # The modification time may not change on file systems with a coarse
+        # resolution, so don't rely on it.
+        METADATA_CACHE.invalidate(filename)
+    return True
+
+# The luminance quantization table of the JPEG standard, which libjpeg scales
+# for every quality.
+STANDARD_LUMINANCE_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99]
+# The quality used when the one of the source is not known.
+DEFAULT_QUALITY = 100
+
+def jpeg_quality(filename):
+    """Return the quality a JPEG file was most likely saved with or None.
+
+    The quality is estimated from the luminance quantization table, assuming
+    it is the standard table scaled like libjpeg does.
+    """
+    try:
+        with open(str(filename), 'rb') as f:
+            if f.read(2) != '\xff\xd8':
+                return None
+            while True:
+                (marker, length) = struct.unpack('>xBH', f.read(4))
+                # The image data comes after the start of scan.
+                if marker == 0xda:
+                    return None
+                segment = f.read(length - 2)
+                if marker != 0xdb:
+                    continue
+                while len(segment) > 0:
+                    (precision, table) = divmod(ord(segment[0]), 16)
+                    size = 128 if precision else 64
+                    values = segment[1:1 + size]
+                    segment = segment[1 + size:]
+                    if table != 0:
+                        continue
+                    if precision:
+                        values = struct.unpack('>64H', values)
+                    else:
+                        values = [ord(x) for x in values]
+                    if max(values) <= 1:
+                        return 100
+                    scale = sum(values) * 100.0 / sum(STANDARD_LUMINANCE_TABLE)
+                    if scale <= 100:
+                        quality = (200 - scale) / 2
+                    else:
+                        quality = 5000 / scale
+                    return max(1, min(100, int(round(quality))))
+    except (IOError, struct.error, IndexError):
+        return None
+
+def save_transformed(filename, matrix=QtGui.QMatrix(), quality=-1):
+    """Apply the Exif orientation and a transformation to the pixels of an
+    image and save it.
+
+    The image is decoded and encoded again, so this works for any
+    transformation but is not lossless for JPEG files. The metadata is copied
+    to the new file with the orientation reset to normal. The file is only
+    replaced once the new one was written. Returns False if the image could
+    not be read or saved.
+
+    Keyword Arguments:
+    filename -- The file path to the image.
+    matrix -- The transformation matrix to apply on top of the current
+              orientation (default is identity)
+    quality -- The quality to encode with, -1 is the quality of the source
+               for JPEG files, which is never lowered, and the default of the
+               format otherwise (default is -1)
+    """
+    filename = str(filename)
+    reader = QtGui.QImageReader(filename)
+    image_format = str(reader.format())
+    if quality == -1 and image_format.lower() in ('jpg', 'jpeg'):
+        quality = jpeg_quality(filename) or DEFAULT_QUALITY
+    image = reader.read()
+    if image.isNull():
+        return False
+    image = rotate_image(image, filename, matrix)
+
+    tmp_path = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        if not image.save(tmp_path, image_format, quality):
+            return False
+        copy_metadata(filename, tmp_path, image.size())
+        os.rename(tmp_path, filename)
+    finally:
+        # Only left if saving failed.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    METADATA_CACHE.invalidate(filename)
+    return True
+
+def copy_metadata(source_path, target_path, size):
+    """Copy the metadata of an image to its transformed copy, with the
+    orientation reset to normal and the new size."""
+    try:
+        source = pyexiv2.metadata.ImageMetadata(source_path)
+        source.read()
+        target = pyexiv2.metadata.ImageMetadata(target_path)
+        target.read()
+        source.copy(target)
+        if 'Exif.Image.Orientation' in target.exif_keys:
+            target['Exif.Image.Orientation'] = 1
+        for (key, value) in (('Exif.Photo.PixelXDimension', size.width()),
+                             ('Exif.Photo.PixelYDimension', size.height())):
+            if key in target.exif_keys:
+                target[key] = value
+        target.write()
+    except (IOError, KeyError, ValueError):
+        # The pixels are right, only the metadata is lost.
+        pass
+
+class ImageLoader(Job):
     """An object used to load an image in a differente thread."""
     def __init__(self, filename, viewport_size, matrix=QtGui.QMatrix()):
-        Thread.__init__(self)
+        Job.__init__(self)
         self.filename = filename
         self.matrix = matrix
         self.maximum_viewport_size = viewport_size
         # These variables are set by run().
-        # If you try to acces the result of a thread before running it,
-        # it's your own fault, but for debugging you can read if the thread
-        # ran in variable self.ran.
+        # If you try to acces the result of a job before it ran, it's your
+        # own fault, but for debugging you can read if the job ran in
+        # variable self.ran.
         self.image = None
         self.image_scaled = None
         self.ran = False
     
     def run(self):
-        self.image = QtGui.QImage(self.filename)
-        self.image_scaled = scale_and_rotate_image(self.image,
-                                                   self.filename,
-                                                   self.maximum_viewport_size,
-                                                   self.matrix)
+        with span('ImageLoader.run', {'path': str(self.filename)}):
+            if DECODE_BACKEND is None:
+                self.load()
+            else:
+                self.image_scaled = DECODE_BACKEND.decode(self)
         self.ran = True
+
+    def load(self):
+        """Decode the scaled image in this thread."""
+        # The previews are stored without the transformations of the user,
+        # these are only used as long as the image was not saved.
+        preview_cache = get_preview_cache()
+        if preview_cache is None or not self.matrix.isIdentity():
+            with span('load_scaled_image'):
+                self.image_scaled = load_scaled_image(
+                    self.filename, self.maximum_viewport_size, self.matrix)
+            return
+
+        with span('PreviewCache.load'):
+            self.image_scaled = preview_cache.load(self.filename,
+                                                   self.maximum_viewport_size)
+        if self.image_scaled is None:
+            with span('load_scaled_image'):
+                self.image_scaled = load_scaled_image(
+                    self.filename, self.maximum_viewport_size)
+            with span('PreviewCache.store'):
+                preview_cache.store(self.filename, self.maximum_viewport_size,
+                                    self.image_scaled)
+
+class StandInJob(Job):
+    """Loads something cheap to show until an image is decoded: its preview
+    from the 'PreviewCache' or else the preview embedded in the file.
+
+    The result is put in 'self.image', None if the image has neither.
+    """
+    def __init__(self, path, viewport_size, matrix=QtGui.QMatrix()):
+        Job.__init__(self)
+        self.path = str(path)
+        self.viewport_size = QtCore.QSize(viewport_size)
+        self.matrix = QtGui.QMatrix(matrix)
+        self.image = None
+
+    def run(self):
+        with span('StandInJob.run', {'path': self.path}):
+            preview_cache = get_preview_cache()
+            # The previews do not have the transformations of the user.
+            if preview_cache is not None and self.matrix.isIdentity():
+                self.image = preview_cache.load(self.path, self.viewport_size)
+            if self.image is None:
+                self.image = load_embedded_preview(
+                    self.path, self.viewport_size, self.matrix)
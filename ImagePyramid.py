@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Image pyramids, so that zooming does not scale the full resolution image.
+
+An 'ImagePyramid' keeps an image at its full resolution and at half, a quarter,
+and so on of it. To show the image at some size the smallest level that is
+still at least that big is scaled, which for a 50MP image shown at a few
+megapixels is a tiny part of the work of scaling the full image. The levels
+only take a third more memory than the full resolution image alone.
+
+The pyramid is built by a 'PyramidJob' in a 'WorkerPool'. The levels are
+QImages, since QPixmaps can not be used outside of the main thread.
+"""
+
+from PyQt4 import QtGui, QtCore
+
+from ImageCache import matrix_key
+from ImageLoader import rotate_image
+from WorkerPool import Job
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+# No level is made smaller than this, in pixels of its longest side.
+MIN_LEVEL_SIZE = 256
+
+def build_levels(image):
+    """Return a list of QImages, 'image' followed by halved versions of it."""
+    levels = [image]
+    while max(image.width(), image.height()) // 2 >= MIN_LEVEL_SIZE:
+        image = image.scaled(image.width() // 2, image.height() // 2,
+                             QtCore.Qt.IgnoreAspectRatio,
+                             QtCore.Qt.SmoothTransformation)
+        levels.append(image)
+    return levels
+
+def pyramid_key(path, matrix):
+    return (str(path), matrix_key(matrix))
+
+class ImagePyramid:
+    """An image at its full resolution and at halved resolutions."""
+    def __init__(self, key, levels):
+        self.key = key
+        self.levels = levels
+
+    def full_size(self):
+        return self.levels[0].size()
+
+    def level_for(self, size):
+        """Return the smallest level that covers 'size' when scaled with
+        KeepAspectRatio."""
+        target = self.full_size()
+        target.scale(size, QtCore.Qt.KeepAspectRatio)
+        for level in reversed(self.levels):
+            if level.width() >= target.width() \
+                   and level.height() >= target.height():
+                return level
+        return self.levels[0]
+
+    def level_for_scale(self, scale):
+        """Return the smallest level that is at least 'scale' times the
+        full resolution."""
+        width = self.full_size().width() * scale
+        for level in reversed(self.levels):
+            if level.width() >= width:
+                return level
+        return self.levels[0]
+
+    def scaled(self, size, smooth=True):
+        """Return a QPixmap of the image scaled to fit 'size'.
+
+        Keyword Arguments:
+        size -- The size to fit the image into.
+        smooth -- If False the fast transformation is used, which is good
+                  enough to show while the user is still zooming
+                  (default is True)
+        """
+        if smooth:
+            mode = QtCore.Qt.SmoothTransformation
+        else:
+            mode = QtCore.Qt.FastTransformation
+        image = self.level_for(size).scaled(size, QtCore.Qt.KeepAspectRatio,
+                                            mode)
+        return QtGui.QPixmap.fromImage(image)
+
+    def size_in_bytes(self):
+        return sum([x.byteCount() for x in self.levels])
+
+class PyramidJob(Job):
+    """Decode an image at full resolution and build its pyramid."""
+    def __init__(self, path, matrix=QtGui.QMatrix()):
+        Job.__init__(self)
+        self.path = str(path)
+        self.matrix = QtGui.QMatrix(matrix)
+        self.key = pyramid_key(path, matrix)
+        self.pyramid = None
+
+    def run(self):
+        image = QtGui.QImage(self.path)
+        if image.isNull():
+            return
+        image = rotate_image(image, self.path, self.matrix)
+        self.pyramid = ImagePyramid(self.key, build_levels(image))
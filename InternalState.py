@@ -3,23 +3,50 @@
 A class to represent the internal state of the program.
 
 The internal state keeps track of:
-- A list will all the loaded images.
+- A list will all the loaded images, stored in an 'ImageCollection' so that
+  even libraries with millions of images are cheap to modify. It is filled in
+  the background by a 'DirectoryScanner', so it grows while the first images
+  are already shown. Afterwards a 'DirectoryWatcher' keeps it up to date with
+  the images that are added to or removed from the directories.
 - The position of the current image being shown in the list.
-- A copy of the current image being shown, untouched.
+- A copy of the current image being shown, untouched. It is only loaded when
+  it is needed (to zoom or to save), browsing only uses the scaled version.
 - A scaled version of the current image.
-- The same for the next image or the previous image, depending on the last
-  operation having been 'next image' or 'previous image'
+- A window of pre-fetched images around the current one. How many images
+  ahead and behind the current one are pre-fetched is configurable.
+- A memory bounded cache of the images that already were decoded, so that
+  going back to them does not read them from disk again.
 - The transformations(rotations) that where performed on the images.
 
+The state of a set of directories can be stored in a session file. When the
+same directories are chosen again the session is restored right away and only
+checked against the file system in the background.
+
 The images are never fetched locally, they are always loaded using
-'ImageLoader'.
+'ImageLoader'. All loaders run in one shared 'WorkerPool'. The current image is
+loaded first, then the next one and then the rest of the window. Loaders of
+images that drop out of the window before they ran are cancelled.
 """
-import os
+
+from collections import deque
 
 from PyQt4 import QtGui, QtCore
 
-from ImageLoader import ImageLoader, scale_and_rotate_image, rotate_image
+from ImageLoader import ImageLoader, StandInJob, load_embedded_preview, \
+     oriented_size
+from DirectoryScanner import DirectoryScanner, scan_images
+from DirectoryWatcher import DirectoryWatcher
+from FileOperations import FileOperationQueue, MoveJob
+from DecisionLog import DecisionLog, decision_log_file
+from Actions import action_from_tuple
+from ImageCache import ImageCache, make_key, matrix_key, image_size_in_bytes
+from ImageCollection import ImageCollection
+from ImagePyramid import PyramidJob, pyramid_key
+from PreviewCache import get_preview_cache
+from Session import read_session, write_session
+from Tracing import span
 from InternalException import InternalException
+from WorkerPool import WorkerPool
 
 __author__ = "Fernando Sanchez Villaamil"
 __copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
@@ -30,33 +57,47 @@ __maintainer__ = "Fernando Sanchez Villaamil"
 __email__ = "nano@moomug.com"
 __status__ = "Just for fun!"
 
+# Priorities used to load the images of the pre-fetch window. Lower numbers
+# are loaded first.
+PRIORITY_CURRENT = 0
+PRIORITY_NEXT = 1
+PRIORITY_REST = 2
+
 class PreFetcher():
-    class RescaleInfo:
-        def __init__(self):
-            self.rescale_path = None
-            self.rescale_viewport_size = None
-            self.rescale_matrix = None
-    
     def __init__(self, filename_image, viewportSize_imageScaled,
-                 matrix=QtGui.QMatrix()):
-
-        # These variables are needed later to handle rescaling.
-        self.rescale_info = PreFetcher.RescaleInfo()
-
-        if isinstance(filename_image, QtGui.QPixmap) \
+                 matrix=QtGui.QMatrix(), pool=None, priority=PRIORITY_REST):
+        # Where the images come from. They are used to build the key under
+        # which the images are stored in the 'ImageCache'.
+        self.path = None
+        self.viewport_size = None
+        self.matrix = QtGui.QMatrix(matrix)
+        # Something to show while the loader did not finish yet.
+        self.stand_in = None
+        # What the loader raised, if it failed.
+        self.error = None
+
+        # The full resolution image may be None, it is loaded lazily.
+        if (filename_image is None
+            or isinstance(filename_image, QtGui.QPixmap)) \
                and isinstance(viewportSize_imageScaled, QtGui.QPixmap):
             self.image = filename_image
             self.image_scaled = viewportSize_imageScaled
             self.from_loader = False
-            self.to_rescale = False
         elif (isinstance(filename_image, QtCore.QString) or \
                  isinstance(filename_image, str)) \
                and isinstance(viewportSize_imageScaled, QtCore.QSize):
+            self.path = str(filename_image)
+            self.viewport_size = QtCore.QSize(viewportSize_imageScaled)
+            if pool is None:
+                raise InternalException('A PreFetcher that loads an image '
+                                        + 'needs a WorkerPool.')
+            self.pool = pool
             self.loader = ImageLoader(filename_image, viewportSize_imageScaled,
                                       matrix)
-            self.loader.start()
+            # Without a priority the loader only runs once it gets one.
+            if priority is not None:
+                self.pool.submit(self.loader, priority)
             self.from_loader = True
-            self.to_rescale = False
         else:
             msg = 'Incorrect PreFetcher contructor: ' + \
                   str(type(filename_image)) + ', ' + \
@@ -65,30 +106,62 @@ class PreFetcher():
 
     def get_images(self):
         if self.from_loader:
-            self.loader.join()
-            self.image = QtGui.QPixmap.fromImage(self.loader.image)
-            self.image_scaled = QtGui.QPixmap.fromImage(self.loader.image_scaled)
+            if not self.loader.is_finished():
+                # Somebody needs the image right now.
+                self.pool.set_priority(self.loader, PRIORITY_CURRENT)
+            with span('PreFetcher.wait'):
+                self.loader.wait()
+            self.image = None
+            self.error = self.loader.error
+            if self.loader.image_scaled is None:
+                # The loader failed, there is nothing to show.
+                self.image_scaled = QtGui.QPixmap()
+            else:
+                with span('QPixmap.fromImage'):
+                    self.image_scaled = QtGui.QPixmap.fromImage(
+                        self.loader.image_scaled)
             self.from_loader = False
-
-        if self.to_rescale:
-            self.image_scaled = scale_and_rotate_image(
-                self.image,
-                self.rescale_info.rescale_path,
-                self.rescale_info.rescale_viewport_size,
-                self.rescale_info.rescale_matrix)
-            self.to_rescale = False
+            self.stand_in = None
 
         return (self.image, self.image_scaled)
 
-    def get_rotated_image(self, path, matrix=QtGui.QMatrix()):
-        (image, _) = self.get_images()
-        return rotate_image(image, path, matrix)
+    def set_stand_in(self, stand_in):
+        self.stand_in = stand_in
+
+    def size_in_bytes(self):
+        images = [self.image, self.stand_in]
+        if self.from_loader:
+            images.append(self.loader.image_scaled)
+        else:
+            images.append(self.image_scaled)
+        return sum([image_size_in_bytes(x) for x in images])
+
+    def is_loaded(self):
+        """Return True if the images can be fetched without waiting."""
+        return not self.from_loader or self.loader.ran \
+               or self.loader.error is not None
+
+    def is_loaded_by(self, loader):
+        return self.from_loader and self.loader is loader
+
+    def set_priority(self, priority):
+        if self.from_loader:
+            self.pool.set_priority(self.loader, priority)
+
+    def cancel(self):
+        """Cancel the loading of the image if it did not start yet."""
+        if self.from_loader:
+            self.pool.cancel(self.loader)
+
+    def set_source(self, path, viewport_size, matrix=QtGui.QMatrix()):
+        self.path = str(path)
+        self.viewport_size = QtCore.QSize(viewport_size)
+        self.matrix = QtGui.QMatrix(matrix)
 
-    def rescale(self, path, viewport_size, matrix=QtGui.QMatrix()):
-        self.to_rescale = True
-        self.rescale_info.rescale_path = path
-        self.rescale_info.rescale_viewport_size = viewport_size
-        self.rescale_info.rescale_matrix = matrix
+    def cache_key(self):
+        if self.path is None:
+            return None
+        return make_key(self.path, self.viewport_size, self.matrix)
 
     def set_image(self, new_image):
         if not self.from_loader:
@@ -98,20 +171,68 @@ class PreFetcher():
         if not self.from_loader:
             self.image_scaled = new_image
 
+
 ALREADY_INSTANTIATED = False #global variable to force singleton.
 class InternalState:
-    def __init__(self):
+    def __init__(self, prefetch_ahead=5, prefetch_behind=2,
+                 cache_size=512 * 1024 * 1024, loader_threads=None,
+                 deferred_discard=False):
         # All these variables should be instantiated by calling self.reset()
         self.images_list = None
-        self.images_list = None
         self.transformations = None
         self.pos = None
-        self.recently_rescaled = None
         self.history = None
         self.forward_history = None
-        self.previous_pic = None
         self.current_pic = None
-        self.next_pic = None
+        # Maps the path of every image in the pre-fetch window to its
+        # PreFetcher.
+        self.window = None
+        # The directories chosen by the user, used to find the session file.
+        self.roots = None
+        # While a restored session is checked against the file system, the
+        # images it contained and the images the scanner found so far.
+        self.session_images = None
+        self.found_images = None
+
+        # How many images after and before the current one are pre-fetched.
+        # 'Ahead' is in the direction the user moves, 1 or -1.
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetch_behind = prefetch_behind
+        self.direction = 1
+        # If the window only follows the position without loading it, see
+        # 'skim()'.
+        self.skimming = False
+        # The decoded images that dropped out of the window end up here.
+        self.image_cache = ImageCache(cache_size)
+        # All the images are loaded by this pool. Its signal
+        # 'jobFinished(PyQt_PyObject)' tells when a loader finished.
+        self.loader_pool = WorkerPool(loader_threads)
+        # Fills 'images_list'. Its signals 'imagesFound(PyQt_PyObject)' and
+        # 'scanFinished()' tell when images were found.
+        self.scanner = DirectoryScanner()
+        # Knows the contents of the scanned directories. Its signals
+        # 'imagesAdded(PyQt_PyObject)' and 'imagesRemoved(PyQt_PyObject)' tell
+        # when they change.
+        self.watcher = DirectoryWatcher()
+        # Moves the discarded images. Its signal
+        # 'operationFinished(PyQt_PyObject)' tells when a move finished.
+        self.file_operations = FileOperationQueue()
+        # If True discarded images are only written into the decision log of
+        # the chosen directories and moved when 'apply_decisions()' is called.
+        self.deferred_discard = deferred_discard
+        self.decision_log = None
+        # The images that are being moved by 'apply_decisions()'.
+        self.applying_decisions = []
+        # The pyramid of the current image is built in its own pool, so that
+        # decoding a full resolution image never delays the loaders. Its
+        # signal 'jobFinished(PyQt_PyObject)' tells when it is ready.
+        self.pyramid_pool = WorkerPool(1)
+        self.pyramid = None
+        self.pyramid_job = None
+        # While skimming the stand-in of the current image is loaded in its
+        # own pool too, the signal of which tells when it is ready.
+        self.stand_in_pool = WorkerPool(1)
+        self.stand_in_job = None
         
         global ALREADY_INSTANTIATED
         if ALREADY_INSTANTIATED:
@@ -123,21 +244,22 @@ class InternalState:
             self.reset()
 
     def reset(self):
-        self.images_list = []
+        self.images_list = ImageCollection()
         self.transformations = {}
         self.pos = -1
-        self.recently_rescaled = False
 
-        self.history = []
-        self.forward_history = []
+        # The most recent action is always the first one.
+        self.history = deque()
+        self.forward_history = deque()
 
         # These should later become pre-fetchers
-        self.previous_pic = None
         self.current_pic = None
-        self.next_pic = None
+        self.window = {}
+        self.skimming = False
 
     def reset_transformation(self, path):
         del self.transformations[path]
+        self.image_cache.invalidate_path(path)
 
     def is_at_last_position(self):
         return self.pos == len(self.images_list) - 1
@@ -151,134 +273,492 @@ class InternalState:
     def get_total_number_images(self):
         return len(self.images_list)
 
-    def make_path_fetcher(self, path, viewport_size):
+    def make_path_fetcher(self, path, viewport_size, priority=PRIORITY_REST):
+        """Return a PreFetcher of an image, from the cache if it is there.
+
+        If 'priority' is None the image is not loaded until the PreFetcher
+        gets a priority or somebody waits for it.
+        """
         if path in self.transformations:
-            return PreFetcher(path, viewport_size, self.transformations[path])
+            matrix = self.transformations[path]
+        else:
+            matrix = QtGui.QMatrix()
+
+        images = self.image_cache.get(make_key(path, viewport_size, matrix))
+        if images is not None:
+            (image, image_scaled) = images
+            fetcher = PreFetcher(image, image_scaled)
+            fetcher.set_source(path, viewport_size, matrix)
+            return fetcher
+
+        return PreFetcher(path, viewport_size, matrix, self.loader_pool,
+                          priority)
+
+    def cache_fetcher(self, fetcher):
+        """Put the images of a PreFetcher in the cache if they are loaded.
+
+        If they are not loaded yet the loading is cancelled.
+        """
+        key = fetcher.cache_key()
+        if not fetcher.is_loaded():
+            fetcher.cancel()
+            return
+        if key is not None:
+            # Only what is needed to browse is kept, the full resolution image
+            # is loaded again if it is needed.
+            (_, image_scaled) = fetcher.get_images()
+            self.image_cache.put(key, (None, image_scaled))
+
+    def resized_fetcher(self, path, fetcher, viewport_size, priority):
+        """Return a PreFetcher that loads an image for another viewport size.
+
+        The old PreFetcher goes to the cache. Until the image is loaded again,
+        the old scaled image is quickly scaled to the new size and shown
+        instead.
+        """
+        if fetcher.is_loaded():
+            (_, old_image) = fetcher.get_images()
+        else:
+            old_image = fetcher.stand_in
+        self.cache_fetcher(fetcher)
+
+        fetcher = self.make_path_fetcher(path, viewport_size, priority)
+        if not fetcher.is_loaded() and old_image is not None \
+               and not old_image.isNull():
+            fetcher.set_stand_in(old_image.scaled(
+                viewport_size, QtCore.Qt.KeepAspectRatio,
+                QtCore.Qt.FastTransformation))
+        return fetcher
+
+    def window_priority(self, pos):
+        if pos == self.pos:
+            return PRIORITY_CURRENT
+        if pos == self.pos + self.direction:
+            return PRIORITY_NEXT
+        distance = (pos - self.pos) * self.direction
+        if distance > 0:
+            return PRIORITY_REST + distance
+        # The images behind come after all the ones ahead.
+        return PRIORITY_REST + self.prefetch_ahead - distance
+
+    def window_positions(self):
+        """Return the positions to pre-fetch, most important first.
+
+        The current image comes first, then the images ahead of it in the
+        direction the user moves and then the ones behind it.
+        """
+        positions = [self.pos]
+        positions.extend([self.pos + self.direction * x
+                          for x in range(1, self.prefetch_ahead + 1)])
+        positions.extend([self.pos - self.direction * x
+                          for x in range(1, self.prefetch_behind + 1)])
+        return [x for x in positions if 0 <= x < len(self.images_list)]
+
+    def update_window(self, viewport_size):
+        """Make the pre-fetch window follow the current position.
+
+        PreFetchers of images that are still in the window are kept, the ones
+        that dropped out of it are handed to the cache.
+        """
+        old_window = self.window
+        self.window = {}
+        self.skimming = False
+
+        for pos in self.window_positions():
+            path = self.current_image_complete_path_pos(pos)
+            if path in self.window:
+                continue
+            priority = self.window_priority(pos)
+            if path in old_window:
+                fetcher = old_window.pop(path)
+                fetcher.set_priority(priority)
+                if fetcher.viewport_size != viewport_size:
+                    fetcher = self.resized_fetcher(path, fetcher,
+                                                   viewport_size, priority)
+            else:
+                fetcher = self.make_path_fetcher(path, viewport_size, priority)
+            self.window[path] = fetcher
+
+        for fetcher in old_window.values():
+            self.cache_fetcher(fetcher)
+
+        if 0 <= self.pos < len(self.images_list):
+            path = self.current_image_complete_path()
+            self.current_pic = self.window[path]
         else:
-            return PreFetcher(path, viewport_size)
+            # currentPic being invalid can only cause problems...
+            self.current_pic = PreFetcher(QtGui.QPixmap(), QtGui.QPixmap())
+
+    def skim(self, steps, viewport_size, lead=1, prefetch=2):
+        """Move 'steps' images away without loading every image passed.
+
+        While the user moves faster than the images can be decoded, the
+        current image is only taken from the cache and its stand-in is shown
+        otherwise. The loaders that did not start yet are cancelled. Only
+        'prefetch' images 'lead' images further in the direction of travel
+        are loaded, that is where the user is likely to be when they are
+        ready. 'update_window()' loads the whole window again once the user
+        slows down.
+        """
+        if not self.image_available() or steps == 0:
+            return
+        self.direction = 1 if steps > 0 else -1
+        self.pos = max(0, min(len(self.images_list) - 1, self.pos + steps))
+        old_window = self.window
+        self.window = {}
+        self.skimming = True
+
+        path = self.current_image_complete_path()
+        fetcher = old_window.pop(path, None)
+        if fetcher is None or fetcher.viewport_size != viewport_size:
+            if fetcher is not None:
+                self.cache_fetcher(fetcher)
+            # Not submitted, it only loads if somebody needs the image.
+            fetcher = self.make_path_fetcher(path, viewport_size, None)
+        self.window[path] = fetcher
+        self.current_pic = fetcher
+
+        for i in range(prefetch):
+            pos = self.pos + self.direction * (lead + i)
+            if not 0 <= pos < len(self.images_list):
+                break
+            path = self.current_image_complete_path_pos(pos)
+            if path in self.window:
+                continue
+            fetcher = old_window.pop(path, None)
+            if fetcher is None or fetcher.viewport_size != viewport_size:
+                if fetcher is not None:
+                    self.cache_fetcher(fetcher)
+                fetcher = self.make_path_fetcher(path, viewport_size,
+                                                 PRIORITY_NEXT + i)
+            else:
+                fetcher.set_priority(PRIORITY_NEXT + i)
+            self.window[path] = fetcher
+
+        for fetcher in old_window.values():
+            self.cache_fetcher(fetcher)
+
+    def move_by(self, steps, viewport_size):
+        """Move 'steps' images away, backwards if it is negative."""
+        if not self.image_available() or steps == 0:
+            return
+        self.direction = 1 if steps > 0 else -1
+        self.pos = max(0, min(len(self.images_list) - 1, self.pos + steps))
+        self.update_window(viewport_size)
 
     def next_image(self, viewport_size):
+        self.direction = 1
         self.pos += 1
 
         if (self.pos >= len(self.images_list)):
             self.pos = len(self.images_list) - 1
             return
 
-        self.previous_pic = self.current_pic
-
-        self.current_pic = self.next_pic
-        if self.recently_rescaled:
-            self.recently_rescaled = False
-            path = self.current_image_complete_path()
-            self.current_pic.rescale(path, viewport_size)
-
-        if self.pos < len(self.images_list) - 1:
-            path = self.current_image_complete_path_pos(self.pos + 1)
-            self.next_pic = self.make_path_fetcher(path, viewport_size)
+        self.update_window(viewport_size)
 
     def previous_image(self, viewport_size):
+        self.direction = -1
         self.pos -= 1
 
         if (self.pos < 0):
             self.pos = 0
             return
 
-        self.next_pic = self.current_pic
-
-        self.current_pic = self.previous_pic
-        if self.recently_rescaled:
-            self.recently_rescaled = False
-            path = self.current_image_complete_path_pos(self.pos + 1)
-            self.current_pic.rescale(path, viewport_size)
+        self.update_window(viewport_size)
 
-        if self.pos > 0:
-            path = self.current_image_complete_path_pos(self.pos - 1)
-            self.previous_pic = self.make_path_fetcher(path, viewport_size)
+    def restore_image(self, path, filename, pos, viewport_size):
+        """Move a discarded image back and put it in the list at 'pos'."""
+        if self.decision_log is not None \
+               and self.decision_log.is_discarded(path, filename):
+            self.decision_log.keep(path, filename)
+        else:
+            self.file_operations.restore(path, filename)
+        self.add_image(path, filename, pos, viewport_size)
+
+    def file_operation_finished(self, job, viewport_size):
+        """Bring the list up to date after the background move 'job'.
+
+        A restored image may have been loaded before it was back in place, so
+        it is loaded again. If a move failed the image is put back into or
+        taken out of the list again, since the file did not move.
+        """
+        image = (job.directory, job.filename)
+        if job.error is None:
+            if job.kind == MoveJob.RESTORE:
+                self.reload_image(job.dst)
+        elif job.kind == MoveJob.DISCARD:
+            self.watcher.add_images([image])
+            self.insert_images([image], viewport_size)
+        else:
+            self.watcher.forget_images([image])
+            self.remove_images([image], viewport_size)
 
     def add_image(self, path, filename, pos, viewport_size):
         self.images_list.insert(pos, (path, filename))
+        self.watcher.add_images([(path, filename)])
         self.jump_to_image(pos, viewport_size)
 
     def jump_to_image(self, new_pos, viewport_size):
         if new_pos < 0 or new_pos >= len(self.images_list):
             return
 
+        if new_pos != self.pos:
+            self.direction = 1 if new_pos > self.pos else -1
         self.pos = new_pos
-
-        if self.pos - 1 >= 0:
-            path = self.current_image_complete_path_pos(self.pos - 1)
-            self.previous_pic = self.make_path_fetcher(path, viewport_size)
-
-        path = self.current_image_complete_path_pos(self.pos)
-        self.current_pic = self.make_path_fetcher(path, viewport_size)
-
-        if self.pos + 1 < len(self.images_list):
-            path = self.current_image_complete_path_pos(self.pos + 1)
-            self.next_pic = self.make_path_fetcher(path, viewport_size)
+        self.update_window(viewport_size)
 
     def image_available(self):
         return not len(self.images_list) == 0
 
-    def current_image(self):
-        if not self.image_available():
-            raise InternalException('There is no image available to be loaded.')
-
-        (res, _) = self.current_pic.get_images()
-        return res
+    def current_image_ready(self):
+        """Return True if the current image can be shown without waiting."""
+        return self.current_pic is not None and self.current_pic.is_loaded()
+
+    def current_image_stand_in(self):
+        """Return something to show until the current image is ready or None.
+
+        While skimming nothing is read from disk for it here, the stand-in is
+        loaded in the 'stand_in_pool' and 'stand_in_loaded()' has to be
+        called once it is ready.
+        """
+        if self.current_pic is None:
+            return None
+        if self.current_pic.stand_in is None and self.skimming:
+            self.request_stand_in()
+            return None
+        if self.current_pic.stand_in is None:
+            self.current_pic.set_stand_in(self.current_image_preview())
+        if self.current_pic.stand_in is None:
+            self.current_pic.set_stand_in(
+                self.current_image_embedded_preview())
+        return self.current_pic.stand_in
+
+    def current_image_preview(self):
+        """Return the preview of the current image from the PreviewCache.
+
+        Returns None if there is no preview.
+        """
+        preview_cache = get_preview_cache()
+        path = self.current_pic.path
+        if preview_cache is None or path is None \
+               or not self.current_pic.matrix.isIdentity():
+            return None
+        image = preview_cache.load(path, self.current_pic.viewport_size)
+        if image is None:
+            return None
+        return QtGui.QPixmap.fromImage(image)
+
+    def current_image_embedded_preview(self):
+        """Return the preview embedded in the current image file or None."""
+        path = self.current_pic.path
+        if path is None:
+            return None
+        image = load_embedded_preview(path, self.current_pic.viewport_size,
+                                      self.current_pic.matrix)
+        if image is None:
+            return None
+        return QtGui.QPixmap.fromImage(image)
+
+    def request_stand_in(self):
+        """Start loading the stand-in of the current image, if necessary.
+
+        Only the stand-in of the current image is loaded, the one of the
+        image that was current before is cancelled.
+        """
+        path = self.current_pic.path
+        if path is None:
+            return
+        if self.stand_in_job is not None:
+            if self.stand_in_job.path == path:
+                return
+            self.stand_in_pool.cancel(self.stand_in_job)
+        self.stand_in_job = StandInJob(path, self.current_pic.viewport_size,
+                                       self.current_pic.matrix)
+        self.stand_in_pool.submit(self.stand_in_job, PRIORITY_CURRENT)
+
+    def stand_in_loaded(self, job):
+        """Keep the stand-in of 'job' if it belongs to the current image.
+
+        Returns True if it does.
+        """
+        if job is not self.stand_in_job:
+            return False
+        self.stand_in_job = None
+        if job.image is None or self.current_pic is None \
+               or self.current_pic.path != job.path \
+               or self.current_pic.stand_in is not None:
+            return False
+        self.current_pic.set_stand_in(QtGui.QPixmap.fromImage(job.image))
+        return True
+
+    def current_image_error(self):
+        """Return what the loader of the current image raised or None."""
+        if self.current_pic is None or not self.current_pic.is_loaded():
+            return None
+        self.current_pic.get_images()
+        return self.current_pic.error
+
+    def is_current_image_loader(self, loader):
+        return self.current_pic is not None \
+               and self.current_pic.is_loaded_by(loader)
 
     def current_image_scaled_and_rotated(self):
         if not self.image_available():
-            raise InternalException('There is no image available to be loaded.')
+            raise InternalException('There is no image available to be '
+                                    'loaded.')
 
         (_, res) = self.current_pic.get_images()
         return res
 
-    def current_image_rotated(self):
-        if not self.image_available():
-            raise InternalException('There is no image available to be loaded.')
+    def set_image(self, new_image):
+        self.current_pic.set_image(new_image)
 
-        path = self.current_image_complete_path()
+    def get_transformation(self, path):
+        """Return the transformation of an image that was not saved or None.
+        """
+        return self.transformations.get(str(path))
+
+    def transformation_saved(self, path, matrix):
+        """Tell that a transformation was written into an image file.
+
+        Only what is left of the pending transformation after 'matrix' stays
+        pending. If the image is in the pre-fetch window it is loaded again,
+        since there is no way to know if its loader read the file before or
+        after it was saved. What was loaded is shown meanwhile.
+
+        Keyword Arguments:
+        path -- The file path to the image.
+        matrix -- The transformation that was saved.
+        """
+        path = str(path)
         if path in self.transformations:
-            return self.current_pic.get_rotated_image(
-                path,
-                self.transformations[path])
-        else:
-            return self.current_pic.get_rotated_image(path)
+            (inverted, _) = matrix.inverted()
+            remaining = inverted * self.transformations[path]
+            if remaining.isIdentity():
+                del self.transformations[path]
+            else:
+                self.transformations[path] = remaining
+        self.image_cache.invalidate_path(path)
+        self.reload_image(path)
 
-    def set_image(self, new_image):
-        self.current_pic.set_image(new_image)
+    def reload_image(self, path):
+        """Load an image of the pre-fetch window again from its file.
+
+        What was loaded before is shown until the new images are ready.
+        """
+        if path not in self.window:
+            return
+        fetcher = self.window[path]
+        is_current = fetcher is self.current_pic
+        if fetcher.is_loaded():
+            (_, stand_in) = fetcher.get_images()
+        else:
+            stand_in = fetcher.stand_in
+            fetcher.cancel()
+        if is_current:
+            priority = PRIORITY_CURRENT
+        else:
+            priority = PRIORITY_REST
+        fetcher = self.make_path_fetcher(path, fetcher.viewport_size, priority)
+        fetcher.set_stand_in(stand_in)
+        self.window[path] = fetcher
+        if is_current:
+            self.current_pic = fetcher
 
     def set_scaled_image(self, new_image):
         self.current_pic.set_scaled_image(new_image)
 
-    def rescale_images(self, viewport_size):
-        if not self.image_available():
+    def current_pyramid_key(self):
+        path = self.current_image_complete_path()
+        matrix = self.transformations.get(path, QtGui.QMatrix())
+        return pyramid_key(path, matrix)
+
+    def current_image_full_size(self):
+        """Return the size of the rotated current image at full resolution.
+        """
+        pyramid = self.current_pyramid()
+        if pyramid is not None:
+            return pyramid.full_size()
+        (path, _) = self.current_pyramid_key()
+        return oriented_size(path, self.transformations.get(path,
+                                                            QtGui.QMatrix()))
+
+    def current_pyramid(self):
+        """Return the ImagePyramid of the current image or None if it is not
+        built yet."""
+        if self.pyramid is None or not self.image_available() \
+               or self.pyramid.key != self.current_pyramid_key():
+            return None
+        return self.pyramid
+
+    def pyramid_bytes(self):
+        if self.pyramid is None:
+            return 0
+        return self.pyramid.size_in_bytes()
+
+    def release_pyramid(self, keep_current=False):
+        """Forget the pyramid, unless 'keep_current' is True and it is the
+        one of the current image."""
+        if keep_current and self.current_pyramid() is not None:
             return
+        self.pyramid = None
 
-        self.recently_rescaled = True
+    def window_bytes(self):
+        """Return how much memory the images of the pre-fetch window use."""
+        return sum([x.size_in_bytes() for x in self.window.values()])
 
-        def rescale(fetcher, pos):
-            path = self.current_image_complete_path_pos(pos)
-            if path in self.transformations:
-                fetcher.rescale(path, viewport_size, self.transformations[path])
-            else:
-                fetcher.rescale(path, viewport_size)
+    def request_pyramid(self):
+        """Start building the pyramid of the current image, if necessary.
 
-        if self.previous_pic is not None and self.pos > 0:
-            rescale(self.previous_pic, self.pos - 1)
+        Only the pyramid of the current image is kept, the one of the image
+        that was current before is dropped.
+        """
+        if not self.image_available():
+            return
+        key = self.current_pyramid_key()
+        if self.pyramid is not None and self.pyramid.key == key:
+            return
+        if self.pyramid_job is not None and self.pyramid_job.key == key:
+            return
+        self.pyramid = None
+        if self.pyramid_job is not None:
+            self.pyramid_pool.cancel(self.pyramid_job)
+        (path, _) = key
+        self.pyramid_job = PyramidJob(
+            path, self.transformations.get(path, QtGui.QMatrix()))
+        self.pyramid_pool.submit(self.pyramid_job, PRIORITY_CURRENT)
+
+    def pyramid_built(self, job):
+        """Keep the pyramid of 'job' if it belongs to the current image.
+
+        Returns True if it does.
+        """
+        if job is not self.pyramid_job:
+            return False
+        self.pyramid_job = None
+        if job.pyramid is None or not self.image_available() \
+               or job.key != self.current_pyramid_key():
+            return False
+        self.pyramid = job.pyramid
+        return True
 
-        if self.current_pic is not None:
-            rescale(self.current_pic, self.pos)
+    def rescale_images(self, viewport_size):
+        """Load the images of the window again for a new viewport size.
 
-        if self.next_pic is not None  and self.pos < len(self.images_list) - 1:
-            rescale(self.next_pic, self.pos + 1)
+        The loading happens in the background, meanwhile the old images are
+        shown quickly scaled to the new size.
+        """
+        if not self.image_available():
+            return
+        self.update_window(viewport_size)
 
     def current_image_complete_path(self):
         return self.current_image_complete_path_pos(self.pos)
 
     def current_image_complete_path_pos(self, pos):
         if not self.image_available():
-            raise InternalException('There is no image available to be loaded.')
+            raise InternalException('There is no image available to be '
+                                    'loaded.')
         (d, f) = self.images_list[pos]
         return d + '/' + f
 
@@ -291,89 +771,304 @@ class InternalState:
         return n
 
     def get_images_list(self, directory):
-        # I got this list from the Qt documentation of QImage:
-        #http://doc.qt.nokia.com/4.7/qimage.html#reading-and-writing-image-files
-        img_extensions = ['.jpg', '.jpeg', '.bmp', '.gif', '.png',
-                          '.ppm', '.pmb', '.pgm', '.xbm', '.xpm']
-
-        directory = str(directory)
-
-        dir_list = os.listdir(directory)
-        dir_list = [directory + '/' + x for x in dir_list]
-        directories = filter(os.path.isdir, dir_list)
-        directories = [x for x in directories if not x.endswith('discarded')]
-        files = filter(os.path.isfile, dir_list)
+        """Add all the images in a directory tree, without using a thread."""
+        self.images_list.extend(scan_images(directory))
+
+    def start(self, dir_list, viewport_size, resume=True):
+        """Start scanning the directories for images in the background.
+
+        The images are added by 'add_scanned_images()' when the scanner finds
+        them. If 'resume' is True and there is a session for these
+        directories, it is restored first and the scan only checks it.
+        Returns True if a session was restored.
+        """
+        self.images_list = ImageCollection()
+        self.pos = -1
+        self.window = {}
+        self.roots = [str(x) for x in dir_list]
+        self.session_images = None
+        self.found_images = None
+        self.watcher.reset()
+        if self.decision_log is not None:
+            self.decision_log.close()
+            self.decision_log = None
+        if self.deferred_discard:
+            self.decision_log = DecisionLog(decision_log_file(self.roots))
+
+        restored = False
+        if resume:
+            data = read_session(self.roots)
+            if data is not None:
+                self.restore_session(data, viewport_size)
+                self.session_images = set(self.images_list)
+                self.found_images = set()
+                restored = True
+
+        self.scanner.scan(dir_list)
+        return restored
+
+    def is_scanning(self):
+        return self.scanner.is_scanning()
+
+    def add_scanned_images(self, images, viewport_size):
+        """Add images found by the scanner at the end of the list."""
+        self.watcher.add_images(images)
+        images = self.undecided_images(images)
+        if self.session_images is not None:
+            # Checking a restored session, only new images are added.
+            self.found_images.update(images)
+            new_images = [x for x in images if x not in self.session_images]
+            if len(new_images) > 0:
+                self.insert_images(new_images, viewport_size)
+            return
 
-        selected = [x for x in files
-                    if any([x.lower().endswith(y) for y in img_extensions])]
-        new_images = map(os.path.split, selected)
-        self.images_list.extend(new_images)
+        old_length = len(self.images_list)
+        self.images_list.extend(images)
 
-        for f in directories:
-            self.get_images_list(f)
+        # Only the window has to change, and only if it was not full.
+        if old_length <= self.pos + self.prefetch_ahead:
+            self.update_window(viewport_size)
 
-    def start(self, dir_list, viewport_size):
-        self.images_list = []
+    def scan_finished(self, viewport_size):
+        """Remove the images of a restored session that do not exist anymore.
+        """
+        if self.session_images is None:
+            return
+        gone = [x for x in self.session_images if x not in self.found_images]
+        self.session_images = None
+        self.found_images = None
+        if len(gone) > 0:
+            self.remove_images(gone, viewport_size)
+
+    def session_data(self):
+        """Return what has to be stored in the session file."""
+        transformations = dict([(path, matrix_key(matrix)) for (path, matrix)
+                                in self.transformations.items()])
+        return {'images': self.images_list.dump(),
+                'pos': self.pos,
+                'transformations': transformations,
+                'history': [x.to_tuple() for x in self.history],
+                'forward_history': [x.to_tuple()
+                                    for x in self.forward_history]}
+
+    def save_session(self):
+        """Store the current state in the session file of the directories."""
+        if self.roots is None:
+            return
+        write_session(self.roots, self.session_data())
+
+    def restore_session(self, data, viewport_size):
+        self.images_list.load(data['images'])
+        self.transformations = dict([(path, QtGui.QMatrix(*m)) for (path, m)
+                                     in data['transformations'].items()])
+        self.history = deque([action_from_tuple(self, x)
+                              for x in data['history']])
+        self.forward_history = deque([action_from_tuple(self, x)
+                                      for x in data['forward_history']])
+        if len(self.images_list) > 0:
+            self.pos = max(0, min(data['pos'], len(self.images_list) - 1))
+            self.update_window(viewport_size)
 
-        for f in dir_list:
-            self.get_images_list(f)
+    def discard_current_image(self, viewport_size):
+        """Move the current image to the discarded directory.
 
-        self.pos = -1
+        The image leaves the list right away, the file is moved in the
+        background. In the deferred discard mode it is only written into the
+        decision log.
+        """
+        self.discard_image_at(self.pos)
 
         if len(self.images_list) == 0:
+            self.reset()
             return
 
-        # currentPic being invalid can only cause problems...
-        self.previous_pic = PreFetcher(QtGui.QPixmap(), QtGui.QPixmap())
-        self.current_pic = PreFetcher(QtGui.QPixmap(), QtGui.QPixmap())
-
-        path = self.current_image_complete_path_pos(0)
-        self.next_pic = self.make_path_fetcher(path, viewport_size)
+        if self.pos >= len(self.images_list):
+            self.pos = len(self.images_list) - 1
 
-    def discard_current_image(self, viewport_size):
-        del self.images_list[self.pos]
+        self.update_window(viewport_size)
+
+    def discard_images(self, images, viewport_size):
+        """Discard several images (directory, filename) at once.
+
+        The current image stays the current one if it is not discarded.
+        Returns a list of tuples (directory, filename, pos) with the images
+        that were discarded, in the order they were taken out of the list.
+        """
+        positions = [self.index_of(d, f) for (d, f) in images]
+        discarded = []
+        # From the back, so that the positions that are left stay valid.
+        for pos in sorted([x for x in positions if x != -1], reverse=True):
+            (d, f) = self.images_list[pos]
+            self.discard_image_at(pos)
+            discarded.append((d, f, pos))
+            if pos < self.pos:
+                self.pos -= 1
 
         if len(self.images_list) == 0:
             self.reset()
+            return discarded
+        if self.pos >= len(self.images_list):
+            self.pos = len(self.images_list) - 1
+        self.update_window(viewport_size)
+        return discarded
+
+    def discard_image_at(self, pos):
+        (directory, filename) = self.images_list[pos]
+        if self.deferred_discard and self.decision_log is not None:
+            # The file stays where it is, so the watcher still knows it.
+            self.decision_log.discard(directory, filename)
+        else:
+            self.file_operations.discard(directory, filename)
+            self.watcher.forget_images([(directory, filename)])
+        self.image_cache.invalidate_path(directory + '/' + filename)
+        del self.images_list[pos]
+
+    def next_different_position(self, group):
+        """Return the first position after the current image whose path is
+        not in 'group' or -1."""
+        group = set(group)
+        pos = self.pos + 1
+        while pos < len(self.images_list):
+            (d, f) = self.images_list[pos]
+            if d + '/' + f not in group:
+                return pos
+            pos += 1
+        return -1
+
+    def undecided_images(self, images):
+        """Leave out the images that are in the decision log."""
+        if self.decision_log is None or self.decision_log.pending_count() == 0:
+            return images
+        return [(d, f) for (d, f) in images
+                if not self.decision_log.is_discarded(d, f)]
+
+    def pending_decisions(self):
+        if self.decision_log is None:
+            return 0
+        return self.decision_log.pending_count()
+
+    def sync_decisions(self):
+        if self.decision_log is not None:
+            self.decision_log.sync()
+
+    def apply_decisions(self):
+        """Move all the images of the decision log in the background.
+
+        'decisions_applied()' has to be called with the images that could not
+        be moved when the moves are done.
+        """
+        if self.decision_log is None:
             return
+        self.decision_log.sync()
+        self.applying_decisions = self.decision_log.discarded()
+        self.file_operations.discard_all(self.applying_decisions)
+
+    def decisions_applied(self, failed):
+        """Only keep the images that could not be moved in the log."""
+        if self.decision_log is None:
+            return
+        # Images discarded while the moves were running stay in the log too.
+        moved = set(self.applying_decisions) - set(failed)
+        self.applying_decisions = []
+        remaining = [x for x in self.decision_log.discarded()
+                     if x not in moved]
+        self.decision_log.compact(remaining)
+        # Images whose discard was undone while they were being moved.
+        if len(moved) > 0:
+            listed = set(self.images_list)
+            for (d, f) in moved & listed:
+                self.file_operations.restore(d, f)
+
+    def index_of(self, directory, filename):
+        """Return the position of an image in the list or -1."""
+        try:
+            return self.images_list.index((directory, filename))
+        except ValueError:
+            return -1
+
+    def insert_images(self, images, viewport_size):
+        """Add images that appeared in the directories while browsing.
+
+        Every image is put after the last image of its directory. The current
+        image stays the same.
+        """
+        for (d, f) in self.undecided_images(images):
+            if self.index_of(d, f) != -1:
+                continue
+            pos = self.images_list.last_index_of_directory(d) + 1
+            if pos == 0:
+                pos = len(self.images_list)
+            self.images_list.insert(pos, (d, f))
+            if pos <= self.pos:
+                self.pos += 1
+
+        if self.pos >= 0:
+            self.update_window(viewport_size)
+
+    def remove_images(self, images, viewport_size):
+        """Remove images that disappeared from the directories while browsing.
+
+        If the current image is removed the next one becomes the current one.
+        """
+        for (d, f) in images:
+            pos = self.index_of(d, f)
+            if pos == -1:
+                continue
+            del self.images_list[pos]
+            self.image_cache.invalidate_path(d + '/' + f)
+            if pos < self.pos:
+                self.pos -= 1
 
         if self.pos >= len(self.images_list):
-            self.previous_image(viewport_size)
+            self.pos = len(self.images_list) - 1
+        if self.pos >= 0:
+            self.update_window(viewport_size)
         else:
-            self.current_pic = self.next_pic
-            if self.pos < len(self.images_list) - 1:
-                path = self.current_image_complete_path_pos(self.pos + 1)
-                self.next_pic = self.make_path_fetcher(path, viewport_size)
+            self.window = {}
+            self.current_pic = None
 
     def rotate_current_image(self, degrees, viewport_size):
         name = self.current_image_complete_path()
         if name in self.transformations:
-            matrix = self.transformations[name]
+            matrix = QtGui.QMatrix(self.transformations[name])
         else:
             matrix = QtGui.QMatrix()
         matrix.rotate(degrees)
-        pix = self.current_image()
-        transformed = pix.transformed(matrix).scaled(viewport_size,
-                                                     QtCore.Qt.KeepAspectRatio)
-
-        self.set_scaled_image(transformed)
         self.transformations[name] = matrix
 
+        # The scaled image is decoded again with the new transformation. Until
+        # that is done, the old scaled image is rotated and shown instead.
+        old_pic = self.current_pic
+        self.current_pic = self.make_path_fetcher(name, viewport_size,
+                                                  PRIORITY_CURRENT)
+        self.window[name] = self.current_pic
+        if not self.current_pic.is_loaded():
+            if old_pic.is_loaded():
+                (_, pix) = old_pic.get_images()
+            else:
+                pix = old_pic.stand_in
+            if pix is not None:
+                rotation = QtGui.QMatrix()
+                rotation.rotate(degrees)
+                pix = pix.transformed(rotation).scaled(
+                    viewport_size, QtCore.Qt.KeepAspectRatio)
+                self.current_pic.set_stand_in(pix)
+        self.cache_fetcher(old_pic)
+
     def add_to_history(self, action):
-        self.history.insert(0, action)
+        self.history.appendleft(action)
 
     def add_to_forward_history(self, action):
-        self.forward_history.insert(0, action)
+        self.forward_history.appendleft(action)
 
     def clear_forward_history(self):
-        self.forward_history = []
+        self.forward_history = deque()
 
     def undo(self, viewport_size):
         if len(self.history) == 0:
             return
 
-        action = self.history[0]
-        del self.history[0]
+        action = self.history.popleft()
         action.undo(viewport_size)
         self.add_to_forward_history(action)
 
@@ -381,7 +1076,6 @@ class InternalState:
         if len(self.forward_history) == 0:
             return
 
-        action = self.forward_history[0]
-        del self.forward_history[0]
+        action = self.forward_history.popleft()
         action.redo(viewport_size)
         self.add_to_history(action)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Keeps the memory used by all the images of the program under a budget.
+
+Every part of the program that keeps images (the image cache, the thumbnails,
+the tiles, the pyramid of the current image, ...) registers itself with the
+'MemoryGovernor' with a function that returns how many bytes it uses and a
+function that frees memory until it uses at most a given number of bytes.
+When the images together use more than the budget, the parts are asked to
+free memory in the order they were registered, so the ones that are cheapest
+to make again are registered first. Optionally the resident memory of the
+process is also limited, on Linux it is read from /proc.
+
+The governor does not watch anything by itself, 'enforce()' has to be called
+when images were added (and from time to time, to be safe).
+"""
+
+import os
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+MEGABYTE = 1024 * 1024
+
+def resident_memory():
+    """Return the resident memory of the process in bytes or None if it can
+    not be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+class MemoryGovernor:
+    """Frees images when the images together use too much memory."""
+    def __init__(self, budget, rss_limit=None):
+        """Keyword Arguments:
+        budget -- How many bytes all the images may use together.
+        rss_limit -- How many bytes of resident memory the process may use,
+                     None means no limit (default is None)
+        """
+        self.budget = budget
+        self.rss_limit = rss_limit
+        # Tuples (name, usage, release) in the order memory is freed.
+        self.consumers = []
+
+    def register(self, name, usage, release=None):
+        """Keyword Arguments:
+        name -- What is shown in the report.
+        usage -- A function that returns how many bytes are used.
+        release -- A function that receives a number of bytes and frees
+                   memory until at most that many bytes are used. None if
+                   the memory can not be freed, it is only reported
+                   (default is None)
+        """
+        self.consumers.append((name, usage, release))
+
+    def usage(self):
+        """Return a list of tuples (name, bytes)."""
+        return [(name, usage()) for (name, usage, _) in self.consumers]
+
+    def total(self):
+        return sum([x for (_, x) in self.usage()])
+
+    def available(self):
+        """Return how many bytes can still be used without going over the
+        budget."""
+        return self.budget - self.total()
+
+    def excess(self):
+        excess = self.total() - self.budget
+        if self.rss_limit is not None:
+            rss = resident_memory()
+            if rss is not None:
+                excess = max(excess, rss - self.rss_limit)
+        return excess
+
+    def enforce(self):
+        """Free memory until the budget is met, return how many bytes were
+        freed."""
+        excess = self.excess()
+        freed = 0
+        for (_, usage, release) in self.consumers:
+            if freed >= excess:
+                break
+            if release is None:
+                continue
+            before = usage()
+            if before == 0:
+                continue
+            release(max(0, before - (excess - freed)))
+            freed += before - usage()
+        return freed
+
+    def report(self):
+        """Return a line with the memory used, for the user."""
+        parts = ['%s %d' % (name, used // MEGABYTE)
+                 for (name, used) in self.usage() if used > 0]
+        text = 'Memory: %d of %d MB' % (self.total() // MEGABYTE,
+                                        self.budget // MEGABYTE)
+        if len(parts) > 0:
+            text += ' (' + ', '.join(parts) + ')'
+        rss = resident_memory()
+        if rss is not None:
+            text += ', resident %d MB' % (rss // MEGABYTE)
+        return text
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+A cache for the Exif metadata of the images.
+
+Reading the metadata of a file with pyexiv2 means opening and parsing it, which
+on a network share is a full round-trip every time. The metadata the program
+needs is read once per file and kept here. An entry is only valid as long as
+the modification time and the size of the file did not change, so files that
+were modified (e.g. by saving a rotation) are read again.
+
+The cache is shared by all the threads of the program, use 'get_metadata()' to
+access it.
+"""
+
+import os
+from threading import Lock
+
+import pyexiv2
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+class ImageMetadata:
+    """The metadata of one image file that the program uses."""
+    def __init__(self, mtime, size):
+        # Used to know if the file changed since it was read.
+        self.mtime = mtime
+        self.size = size
+        # The value of 'Exif.Image.Orientation', None if there is none.
+        self.orientation = None
+        # The value of 'Exif.Photo.DateTimeOriginal', None if there is none.
+        self.date_time = None
+        # The dimensions of the image as reported by the metadata.
+        self.dimensions = None
+        # How many embedded previews the file carries.
+        self.num_previews = 0
+
+    def is_valid_for(self, mtime, size):
+        return self.mtime == mtime and self.size == size
+
+def read_metadata(path, stat=None):
+    """Read the metadata of an image file, bypassing the cache.
+
+    Files whose format is not supported by exiv2 get an empty ImageMetadata.
+
+    Keyword Arguments:
+    path -- The file path to the image.
+    stat -- The result of os.stat(path) if it is already known.
+    """
+    if stat is None:
+        stat = os.stat(path)
+    result = ImageMetadata(stat.st_mtime, stat.st_size)
+
+    metadata = pyexiv2.metadata.ImageMetadata(str(path))
+    try:
+        metadata.read()
+    except IOError:
+        return result
+
+    if 'Exif.Image.Orientation' in metadata.exif_keys:
+        result.orientation = int(metadata['Exif.Image.Orientation'].raw_value)
+    if 'Exif.Photo.DateTimeOriginal' in metadata.exif_keys:
+        result.date_time = metadata['Exif.Photo.DateTimeOriginal'].raw_value
+    result.dimensions = metadata.dimensions
+    result.num_previews = len(metadata.previews)
+
+    return result
+
+class MetadataCache:
+    """Maps file paths to their ImageMetadata."""
+    def __init__(self):
+        self.entries = {}
+        self.lock = Lock()
+
+    def get(self, path):
+        """Return the ImageMetadata of 'path', reading it if necessary."""
+        path = str(path)
+        stat = os.stat(path)
+
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry.is_valid_for(stat.st_mtime,
+                                                    stat.st_size):
+            return entry
+
+        entry = read_metadata(path, stat)
+        with self.lock:
+            self.entries[path] = entry
+        return entry
+
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(str(path), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+METADATA_CACHE = MetadataCache()
+
+def get_metadata(path):
+    """Return the ImageMetadata of 'path' from the shared cache."""
+    return METADATA_CACHE.get(path)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Follows how fast and in which direction the user moves through the images.
+
+Holding a key down moves through the images at the rate of the key repeat,
+which is faster than the images can be decoded. The 'NavigationTracker' is
+told about every step and knows the rate of the last steps, so that the
+program can tell browsing from skimming. While skimming nobody looks at the
+images that are passed, they are only shown if they are cheap to get and the
+images are only loaded where the user is likely to stop.
+"""
+
+import time
+from collections import deque
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+class NavigationTracker:
+    """The direction and rate of the last steps through the images."""
+    def __init__(self, fast_rate=8.0, window=0.5):
+        """Keyword Arguments:
+        fast_rate -- From how many images per second on the user is skimming
+                     (default is 8)
+        window -- Over how many seconds the rate is measured (default is 0.5)
+        """
+        self.fast_rate = fast_rate
+        self.window = window
+        # Tuples (time, number of images) of the steps within the window.
+        self.steps = deque()
+        # 1 forwards, -1 backwards.
+        self.direction = 1
+
+    def step(self, count, now=None):
+        """Tell about a move of 'count' images, negative ones go backwards."""
+        if count == 0:
+            return
+        if now is None:
+            now = time.time()
+        direction = 1 if count > 0 else -1
+        if direction != self.direction:
+            # Turning around starts from zero.
+            self.steps.clear()
+            self.direction = direction
+        self.steps.append((now, abs(count)))
+        self.expire(now)
+
+    def expire(self, now):
+        while len(self.steps) > 0 and self.steps[0][0] < now - self.window:
+            self.steps.popleft()
+
+    def rate(self, now=None):
+        """Return how many images per second were passed lately."""
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        return sum([x[1] for x in self.steps]) / self.window
+
+    def is_fast(self, now=None):
+        return self.rate(now) >= self.fast_rate
+
+    def lead(self, seconds, now=None):
+        """Return how many images further the user will be in 'seconds' at
+        the current rate, at least one."""
+        return max(1, int(round(self.rate(now) * seconds)))
+
+    def reset(self):
+        self.steps.clear()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Perceptual hashes to find near-duplicate images and bursts.
+
+The hash of an image is the DCT hash (pHash): the image is reduced to 32x32
+gray pixels, the discrete cosine transform of that is computed with NumPy and
+the 8x8 lowest frequencies are compared to their median, which gives 64 bits.
+Images that look alike have hashes that differ only in a few bits, so the
+hamming distance between two hashes tells how similar the images are.
+
+'HashIndex' computes the hashes in a background 'WorkerPool' and keeps them in
+a BK-tree, so that the images close to a given one are found without comparing
+it to every other image. The hashes are computed from the small scaled images
+the loaders produce when they are available, otherwise the image is decoded at
+a small size. They are stored in the cache directory of the user and are only
+computed again if the modification time or the size of the file changes. The
+hashes of files that do not exist anymore are dropped.
+
+NumPy is optional. Without it 'numpy' is None and no 'HashIndex' is created.
+"""
+
+import os
+import zlib
+import cPickle as pickle
+
+from PyQt4 import QtGui, QtCore
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ImageLoader import load_scaled_image
+from PreviewCache import default_cache_directory
+from WorkerPool import Job, WorkerPool
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+HASH_IMAGE_SIZE = 32
+HASH_FREQUENCIES = 8
+# Images are decoded at this size when there is no scaled image to hash.
+DECODE_SIZE = QtCore.QSize(128, 128)
+
+DCT_MATRIX = None
+BIT_VALUES = None
+if numpy is not None:
+    n = numpy.arange(HASH_IMAGE_SIZE)
+    DCT_MATRIX = numpy.sqrt(2.0 / HASH_IMAGE_SIZE) * numpy.cos(
+        numpy.pi * numpy.outer(n, 2 * n + 1) / (2.0 * HASH_IMAGE_SIZE))
+    DCT_MATRIX[0] /= numpy.sqrt(2.0)
+    BIT_VALUES = 2 ** numpy.arange(HASH_FREQUENCIES ** 2, dtype=numpy.uint64)
+    del n
+
+def gray_pixels(image):
+    """Return an image reduced to a HASH_IMAGE_SIZE square of gray values."""
+    small = image.scaled(HASH_IMAGE_SIZE, HASH_IMAGE_SIZE,
+                         QtCore.Qt.IgnoreAspectRatio,
+                         QtCore.Qt.SmoothTransformation)
+    small = small.convertToFormat(QtGui.QImage.Format_RGB32)
+    data = small.bits().asstring(small.byteCount())
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8)
+    pixels = pixels.reshape(HASH_IMAGE_SIZE, small.bytesPerLine())
+    pixels = pixels[:, :HASH_IMAGE_SIZE * 4].reshape(HASH_IMAGE_SIZE,
+                                                     HASH_IMAGE_SIZE, 4)
+    # Format_RGB32 is stored as 0xffRRGGBB, i.e. B, G, R, A in memory on a
+    # little endian machine.
+    return 0.114 * pixels[:, :, 0] + 0.587 * pixels[:, :, 1] \
+           + 0.299 * pixels[:, :, 2]
+
+def image_hash(image):
+    """Return the 64 bit perceptual hash of a QImage or None if it is null."""
+    if image is None or image.isNull():
+        return None
+    dct = numpy.dot(numpy.dot(DCT_MATRIX, gray_pixels(image)), DCT_MATRIX.T)
+    low = dct[:HASH_FREQUENCIES, :HASH_FREQUENCIES].flatten()
+    # The first coefficient is the average brightness, it says nothing about
+    # the structure of the image.
+    bits = low > numpy.median(low[1:])
+    return int(numpy.dot(bits.astype(numpy.uint64), BIT_VALUES))
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """A BK-tree of hashes under the hamming distance.
+
+    Every node has children indexed by their distance to it. The triangle
+    inequality allows a search to skip every child whose distance is too far
+    from the distance between the node and the wanted hash.
+    """
+    def __init__(self):
+        # Every node is a list [hash, items, children].
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Return a list of tuples (distance, item) close to 'value'."""
+        result = []
+        if self.root is None:
+            return result
+        pending = [self.root]
+        while len(pending) > 0:
+            node = pending.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                result.extend([(distance, x) for x in node[1]])
+            for (child_distance, child) in node[2].items():
+                if distance - max_distance <= child_distance \
+                       <= distance + max_distance:
+                    pending.append(child)
+        return result
+
+class HashJob(Job):
+    """Compute the perceptual hash of an image file.
+
+    If 'image' is given it is hashed instead of reading the file. If 'known'
+    is given, a tuple (mtime, size, hash) of an earlier hash of the file, the
+    hash is only computed again if the file changed since then.
+    """
+    def __init__(self, path, image=None, known=None):
+        Job.__init__(self)
+        self.path = path
+        self.image = image
+        self.known = known
+        self.mtime = None
+        self.size = None
+        self.hash = None
+        # Set if the file does not exist anymore.
+        self.missing = False
+
+    def run(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.missing = True
+            self.image = None
+            return
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        if self.known is not None \
+               and self.known[:2] == (self.mtime, self.size):
+            self.hash = self.known[2]
+            self.image = None
+            return
+        if self.image is None:
+            self.image = load_scaled_image(self.path, DECODE_SIZE)
+        self.hash = image_hash(self.image)
+        # The image is not needed anymore, do not keep it in memory.
+        self.image = None
+
+class HashIndex(QtCore.QObject):
+    """The perceptual hashes of the images, searchable by similarity.
+
+    All the methods have to be called from the main thread. The signal
+    'pendingChanged(int)' tells how many images still have to be hashed.
+    """
+    # Priorities in the pool. The images the user already looked at come
+    # first.
+    PRIORITY_LOADED = 0
+    PRIORITY_SCANNED = 1
+
+    def __init__(self, path, num_workers=1, parent=None):
+        """Keyword Arguments:
+        path -- The file where the hashes are stored.
+        num_workers -- How many threads compute hashes (default is 1)
+        """
+        QtCore.QObject.__init__(self, parent)
+        self.path = path
+        # Maps every path to a tuple (mtime, size, hash).
+        self.hashes = {}
+        self.tree = BKTree()
+        self.dirty = False
+        # Maps the paths that are being hashed to their HashJob.
+        self.jobs = {}
+        # Groups that were already computed, emptied when a hash is added.
+        self.groups = {}
+        # Grows every time the groups change, so that callers can tell if
+        # what they computed from them is up to date.
+        self.version = 0
+
+        self.pool = WorkerPool(num_workers)
+        self.connect(self.pool, QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                     self.job_finished)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.hashes = pickle.loads(zlib.decompress(f.read()))
+        except (IOError, zlib.error, pickle.UnpicklingError, EOFError,
+                ValueError):
+            self.hashes = {}
+        for (path, (_, _, value)) in self.hashes.items():
+            self.tree.add(value, path)
+
+    def save(self, prune_roots=None):
+        """Write the hashes if they changed.
+
+        With 'prune_roots' the hashes of the files under these directories
+        that do not exist anymore are dropped first, which stats every one of
+        them. The hashes of other directories are kept as they are, their
+        disks may just not be mounted.
+        """
+        if prune_roots:
+            self.prune(prune_roots)
+        if not self.dirty:
+            return
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(self.hashes, 2), 1))
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def prune(self, roots):
+        prefixes = tuple([x.rstrip('/') + '/' for x in roots])
+        for path in self.hashes.keys():
+            if path.startswith(prefixes) and path not in self.jobs \
+                   and not os.path.exists(path):
+                self.remove(path)
+
+    def remove(self, path):
+        """Forget the hash of a file. The BK-tree keeps it, searches skip the
+        paths without a hash."""
+        if self.hashes.pop(path, None) is not None:
+            self.dirty = True
+            self.groups = {}
+            self.version += 1
+
+    def pending_count(self):
+        return len(self.jobs)
+
+    def index_images(self, images):
+        """Hash in the background the images (directory, filename) that do
+        not have a hash yet or changed since they were hashed."""
+        for (d, f) in images:
+            path = d + '/' + f
+            if path not in self.jobs:
+                self.submit(HashJob(path, known=self.hashes.get(path)),
+                            self.PRIORITY_SCANNED)
+        self.emit(QtCore.SIGNAL('pendingChanged(int)'), len(self.jobs))
+
+    def add_loaded(self, path, image):
+        """Hash the scaled image a loader produced, if the image has no hash
+        or the file changed since it was hashed.
+
+        The image must not carry any transformation of the user.
+        """
+        path = str(path)
+        if image is None:
+            return
+        job = self.jobs.get(path)
+        if job is not None:
+            if job.taken:
+                return
+            self.pool.cancel(job)
+        self.submit(HashJob(path, image, self.hashes.get(path)),
+                    self.PRIORITY_LOADED)
+
+    def submit(self, job, priority):
+        self.jobs[job.path] = job
+        self.pool.submit(job, priority)
+
+    def job_finished(self, job):
+        if self.jobs.get(job.path) is not job:
+            return
+        del self.jobs[job.path]
+        self.emit(QtCore.SIGNAL('pendingChanged(int)'), len(self.jobs))
+        if job.missing:
+            self.remove(job.path)
+            return
+        if job.hash is None:
+            return
+        old = self.hashes.get(job.path)
+        if old == (job.mtime, job.size, job.hash):
+            return
+        self.hashes[job.path] = (job.mtime, job.size, job.hash)
+        self.dirty = True
+        if old is None or old[2] != job.hash:
+            self.tree.add(job.hash, job.path)
+            self.groups = {}
+            self.version += 1
+
+    def similar(self, path, max_distance):
+        """Return the paths of the images that are close to 'path'.
+
+        Only the direct neighbours of 'path' are found. Closeness is not
+        transitive, otherwise chains of pairs would join unrelated images of a
+        big library into one group. The result includes 'path' and is empty if
+        the image has no hash yet.
+        """
+        path = str(path)
+        key = (path, max_distance)
+        if key in self.groups:
+            return self.groups[key]
+        if path not in self.hashes:
+            return []
+
+        group = set([path])
+        value = self.hashes[path][2]
+        for (_, other) in self.tree.search(value, max_distance):
+            # The tree keeps the old hashes of changed and removed files.
+            if other in self.hashes \
+                   and hamming_distance(self.hashes[other][2], value) \
+                   <= max_distance:
+                group.add(other)
+        group = sorted(group)
+        self.groups[key] = group
+        return group
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+HASH_INDEX = None
+
+def enable_hash_index(path=None, num_workers=1):
+    """Create the shared HashIndex, if NumPy is available.
+
+    Keyword Arguments:
+    path -- The file where the hashes are stored (default is in the user
+            cache directory)
+    num_workers -- How many threads compute hashes (default is 1)
+    """
+    global HASH_INDEX
+    if numpy is None:
+        return None
+    if path is None:
+        path = os.path.join(default_cache_directory(), 'hashes')
+    HASH_INDEX = HashIndex(path, num_workers)
+    return HASH_INDEX
+
+def get_hash_index():
+    """Return the shared HashIndex or None if it is disabled."""
+    return HASH_INDEX
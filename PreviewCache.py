@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""
+A persistent cache of viewport sized previews shared across sessions.
+
+Every image that 'ImageLoader' decodes is also stored here, already rotated as
+its Exif metadata says and scaled to the size of the viewport. The previews are
+kept as small JPEG files under the cache directory of the user, so the second
+time a set of images is browsed they are read from here instead of being
+decoded from the originals.
+
+A preview is identified by the path of the original, its modification time, its
+size, its Exif orientation and the resolution of the preview. If the original
+changes, the old preview is simply never found again and eventually evicted.
+The total size of the cache is capped, the least recently used previews are
+deleted first.
+
+The index of the previews on disk, which knows their sizes and when they were
+used, is built by reading the directory in a background thread the first time
+the cache is used, nobody waits for the directory to be read. A preview that
+is not in the index is looked up on disk, it may have been stored before the
+directory was read or by another process sharing the cache.
+
+The cache is shared by all the threads of the program. It is disabled until
+'enable_preview_cache()' is called, use 'get_preview_cache()' to access it.
+"""
+
+import os
+import time
+import hashlib
+from threading import Lock, Thread, current_thread
+
+from PyQt4 import QtGui
+
+from MetadataCache import get_metadata
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+PREVIEW_FORMAT = 'JPG'
+PREVIEW_QUALITY = 85
+
+def default_cache_directory():
+    """Return the directory where photoChooser keeps its caches."""
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'photoChooser')
+
+class PreviewCache:
+    """Previews stored on disk with a size cap and LRU eviction."""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        # Maps the file name of every preview to a list [last use, size].
+        # Until the directory was read it only has the previews stored since.
+        self.index = {}
+        self.used_bytes = 0
+        self.indexed = False
+        # Set while a thread reads the directory.
+        self.trimming = False
+
+    def start_indexing(self):
+        """Read the directory in the background, once. Must hold
+        self.lock."""
+        if not self.indexed and not self.trimming:
+            self.start_trim()
+
+    def read_directory(self):
+        """Return an index of the previews on disk."""
+        index = {}
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for (dirpath, _, filenames) in os.walk(self.directory):
+            for f in filenames:
+                # Previews that are being written, or whose writer died.
+                if f.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, f))
+                except OSError:
+                    continue
+                index[f] = [stat.st_mtime, stat.st_size]
+        return index
+
+    def preview_name(self, path, viewport_size, stat=None):
+        """Return the file name of the preview of an image.
+
+        The Exif orientation is part of the name, because rewriting it may
+        change neither the modification time nor the size of the file.
+        """
+        if stat is None:
+            stat = os.stat(path)
+        orientation = get_metadata(path).orientation
+        key = '%s|%r|%d|%r|%dx%d' % (os.path.abspath(str(path)),
+                                     stat.st_mtime, stat.st_size, orientation,
+                                     viewport_size.width(),
+                                     viewport_size.height())
+        return hashlib.sha1(key).hexdigest() + '.' + PREVIEW_FORMAT.lower()
+
+    def preview_path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+    def contains(self, path, viewport_size):
+        """Return True if there is a preview of an image, without reading
+        it."""
+        try:
+            name = self.preview_name(path, viewport_size)
+        except OSError:
+            return False
+        with self.lock:
+            if name in self.index:
+                return True
+        return os.path.exists(self.preview_path(name))
+
+    def load(self, path, viewport_size):
+        """Return the preview of an image as a QImage or None."""
+        try:
+            name = self.preview_name(path, viewport_size)
+        except OSError:
+            return None
+
+        preview_path = self.preview_path(name)
+        with self.lock:
+            self.start_indexing()
+            indexed = name in self.index
+        if not indexed and not os.path.exists(preview_path):
+            return None
+
+        image = QtGui.QImage(preview_path)
+        if image.isNull():
+            self.remove(name)
+            return None
+
+        with self.lock:
+            if name in self.index:
+                self.index[name][0] = self.touch(name)
+                evicted = []
+            else:
+                evicted = self.add(name)
+        self.delete(evicted)
+        return image
+
+    def store(self, path, viewport_size, image):
+        """Store the preview of an image, evicting old ones if necessary."""
+        try:
+            name = self.preview_name(path, viewport_size)
+        except OSError:
+            return
+
+        preview_path = self.preview_path(name)
+        with self.lock:
+            self.start_indexing()
+            if name in self.index or os.path.exists(preview_path):
+                return
+            if not os.path.isdir(os.path.dirname(preview_path)):
+                os.makedirs(os.path.dirname(preview_path))
+
+        # Write to a temporary file first, so that nobody reads a half
+        # written preview. Several processes may share the cache.
+        tmp_path = '%s.%d.%s.tmp' % (preview_path, os.getpid(),
+                                     current_thread().ident)
+        try:
+            if not image.save(tmp_path, PREVIEW_FORMAT, PREVIEW_QUALITY):
+                return
+            os.rename(tmp_path, preview_path)
+        finally:
+            # Only left if saving failed.
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock:
+            if name in self.index:
+                return
+            evicted = self.add(name)
+        self.delete(evicted)
+
+    def add(self, name):
+        """Add a preview on disk to the index and return the names of the
+        previews that were evicted for it, for 'delete()'. Must hold
+        self.lock."""
+        try:
+            size = os.path.getsize(self.preview_path(name))
+        except OSError:
+            return []
+        self.index[name] = [self.touch(name), size]
+        self.used_bytes += size
+        return self.evict()
+
+    def trim(self):
+        """Read the previews on disk again and evict until the cache fits
+        its size, e.g. after other processes stored previews in it.
+
+        The lock is not held while the directory is read, the cache can be
+        used meanwhile.
+        """
+        start = time.time()
+        try:
+            index = self.read_directory()
+        except OSError:
+            with self.lock:
+                self.trimming = False
+            return
+        with self.lock:
+            for (name, entry) in self.index.items():
+                # Stored or used while the directory was read. The times of
+                # the file system may be coarse.
+                if name not in index and entry[0] >= start - 2:
+                    index[name] = entry
+            self.index = index
+            self.used_bytes = sum([x[1] for x in index.values()])
+            self.indexed = True
+            self.trimming = False
+            evicted = self.evict()
+        self.delete(evicted)
+
+    def start_trim(self):
+        """Run 'trim()' in a background thread, unless it runs already.
+        Must hold self.lock."""
+        if self.trimming:
+            return
+        self.trimming = True
+        thread = Thread(target=self.trim)
+        thread.daemon = True
+        thread.start()
+
+    def trim_in_background(self):
+        with self.lock:
+            self.start_trim()
+
+    def touch(self, name):
+        """Mark a preview as used now and return the time of use."""
+        preview_path = self.preview_path(name)
+        try:
+            os.utime(preview_path, None)
+            return os.path.getmtime(preview_path)
+        except OSError:
+            return 0
+
+    def remove(self, name):
+        with self.lock:
+            if name in self.index:
+                (_, size) = self.index.pop(name)
+                self.used_bytes -= size
+        self.delete([name])
+
+    def evict(self):
+        """Drop the least recently used previews from the index and return
+        their names, for 'delete()'. Must hold self.lock."""
+        # Without the whole index the size of the cache is not known.
+        if not self.indexed or self.used_bytes <= self.max_bytes:
+            return []
+        evicted = []
+        # Evict a bit more than necessary, so that this does not happen
+        # again with every new preview.
+        target = self.max_bytes * 0.9
+        by_use = sorted(self.index.items(), key=lambda x: x[1][0])
+        for (name, (_, size)) in by_use:
+            if self.used_bytes <= target:
+                break
+            del self.index[name]
+            self.used_bytes -= size
+            evicted.append(name)
+        return evicted
+
+    def delete(self, names):
+        """Delete the files of evicted previews, without holding the
+        lock."""
+        for name in names:
+            try:
+                os.remove(self.preview_path(name))
+            except OSError:
+                pass
+
+PREVIEW_CACHE = None
+
+def enable_preview_cache(max_bytes, directory=None):
+    """Create the shared PreviewCache.
+
+    Keyword Arguments:
+    max_bytes -- The maximum size of all the previews together.
+    directory -- Where to store the previews (default is the user cache
+                 directory)
+    """
+    global PREVIEW_CACHE
+    if directory is None:
+        directory = os.path.join(default_cache_directory(), 'previews')
+    PREVIEW_CACHE = PreviewCache(directory, max_bytes)
+    return PREVIEW_CACHE
+
+def get_preview_cache():
+    """Return the shared PreviewCache or None if it is disabled."""
+    return PREVIEW_CACHE
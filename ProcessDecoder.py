@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Decodes the images of the loaders in worker processes.
+
+The 'ImageLoader' decodes, reads the Exif metadata and scales the images in
+threads, which only run at the same time while they are inside of Qt or
+pyexiv2. The 'ProcessDecoder' does the same work in a pool of worker
+processes, which have a GIL each. It is a decode backend of the ImageLoader
+('set_decode_backend()'), so the loaders are still submitted to the same
+'WorkerPool' and nobody else knows where the pixels were decoded: the thread
+of the loader hands the image to a worker process and waits for it.
+
+The pixels come back through shared memory. The worker writes them into a
+file in /dev/shm and the loader maps the file and wraps the mapping into a
+QImage, so they are not pickled and sent through a pipe. The pixels are then
+copied into a QImage of Qt's own in the thread of the loader and the mapping
+is closed right away, see 'map_shared_image()' for why they are not used in
+place.
+
+If a worker fails the exception is raised in the thread of the loader, so it
+ends up in the 'error' of the loader like the errors of the threads. A worker
+that does not answer within DECODE_TIMEOUT seconds (e.g. because it crashed)
+raises an InternalException.
+
+Every worker process evicts previews from the 'PreviewCache' only as far as
+it knows about them, so the cache directory could grow to a multiple of its
+size. Every PREVIEW_TRIM_INTERVAL decoded images the decoder has the cache of
+the main process read the directory again and evict with all the previews in
+view, in a background thread. Whatever is left over when the program quits is
+evicted the next time the cache reads its directory.
+
+The worker processes are forked when the decoder is created. This has to
+happen before any thread is started and before the QApplication is created,
+the workers only get a QCoreApplication of their own.
+"""
+
+import os
+import mmap
+import ctypes
+import tempfile
+import itertools
+import multiprocessing
+from threading import Lock
+
+from PyQt4 import QtGui, QtCore
+import sip
+
+from Headless import init_worker_process
+from ImageLoader import ImageLoader, set_decode_backend
+from InternalException import InternalException
+from PreviewCache import enable_preview_cache, get_preview_cache
+from Tracing import span
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+SHARED_MEMORY_PREFIX = 'photoChooser-decode-'
+# After how many decoded images the preview cache is trimmed.
+PREVIEW_TRIM_INTERVAL = 256
+# How many seconds a loader waits for a worker. A worker that crashed never
+# answers.
+DECODE_TIMEOUT = 60
+# The formats the pixels are handed over in, all with 4 bytes per pixel.
+SHARED_FORMATS = (QtGui.QImage.Format_RGB32, QtGui.QImage.Format_ARGB32,
+                  QtGui.QImage.Format_ARGB32_Premultiplied)
+
+def shared_memory_directory():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+# Numbers the files a worker process writes.
+BUFFER_NUMBERS = None
+
+def init_worker(preview_cache_size, preview_cache_directory):
+    global BUFFER_NUMBERS
+    init_worker_process('photoChooser-decoder')
+    BUFFER_NUMBERS = itertools.count()
+    if preview_cache_size is not None:
+        enable_preview_cache(preview_cache_size, preview_cache_directory)
+
+def decode_to_shared_memory(filename, width, height, matrix, directory):
+    """Decode an image like the ImageLoader does and write its pixels into a
+    new file in 'directory'.
+
+    Runs in a worker process. Returns a tuple (path, width, height,
+    bytes per line, format) or None if the image could not be decoded.
+    """
+    loader = ImageLoader(filename, QtCore.QSize(width, height),
+                         QtGui.QMatrix(*matrix))
+    loader.load()
+    image = loader.image_scaled
+    if image is None or image.isNull():
+        return None
+    if image.format() not in SHARED_FORMATS:
+        image = image.convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+
+    # The parent process is in the name, so that it can delete what it did
+    # not get to map.
+    path = os.path.join(directory, '%s%d-%d-%d' % (
+            SHARED_MEMORY_PREFIX, os.getppid(), os.getpid(),
+            next(BUFFER_NUMBERS)))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(image.constBits().asstring(image.byteCount()))
+    return (path, image.width(), image.height(), image.bytesPerLine(),
+            int(image.format()))
+
+def map_shared_image(path, width, height, bytes_per_line, image_format):
+    """Return a QImage with the pixels a worker wrote and delete the
+    file.
+
+    The pixels are copied out of the mapping. Using the mapping in place would
+    save that copy, but the QImage would not own its pixels and nothing
+    could keep the mapping alive as long as Qt uses them: QPixmap.fromImage()
+    may share the pixels of an image that already has the format of the
+    screen instead of copying them, and the pixmaps outlive the loaders in
+    the image cache. The copy of a viewport sized image is cheap next to
+    decoding it.
+    """
+    fd = os.open(path, os.O_RDWR)
+    try:
+        pixels = mmap.mmap(fd, bytes_per_line * height)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    try:
+        address = ctypes.addressof(ctypes.c_char.from_buffer(pixels))
+        shared = QtGui.QImage(sip.voidptr(address), width, height,
+                              bytes_per_line,
+                              QtGui.QImage.Format(image_format))
+        # The shared image does not own the pixels, the copy does.
+        image = shared.copy()
+        del shared
+    finally:
+        pixels.close()
+    return image
+
+class ProcessDecoder:
+    """A decode backend of the ImageLoader that uses worker processes."""
+    def __init__(self, num_processes=None, preview_cache_size=None,
+                 preview_cache_directory=None):
+        """Keyword Arguments:
+        num_processes -- How many worker processes decode, None means one per
+                         core (default is None)
+        preview_cache_size -- The maximum size of the 'PreviewCache' the
+                              workers use, None if they use none (default is
+                              None)
+        preview_cache_directory -- Where the previews are stored (default is
+                                   the user cache directory)
+        """
+        self.directory = shared_memory_directory()
+        self.preview_cache_size = preview_cache_size
+        # How many images were decoded, to know when to trim the previews.
+        self.decoded = 0
+        self.lock = Lock()
+        self.pool = multiprocessing.Pool(
+            num_processes, init_worker,
+            (preview_cache_size, preview_cache_directory))
+
+    def decode(self, loader):
+        """Return the scaled image of an ImageLoader, a null QImage if it
+        could not be decoded.
+
+        Called from the thread the loader runs in. What the worker raised is
+        raised here."""
+        matrix = loader.matrix
+        arguments = (str(loader.filename),
+                     loader.maximum_viewport_size.width(),
+                     loader.maximum_viewport_size.height(),
+                     (matrix.m11(), matrix.m12(), matrix.m21(), matrix.m22(),
+                      matrix.dx(), matrix.dy()),
+                     self.directory)
+        with span('ProcessDecoder.decode'):
+            try:
+                result = self.pool.apply_async(
+                    decode_to_shared_memory, arguments).get(DECODE_TIMEOUT)
+            except multiprocessing.TimeoutError:
+                raise InternalException(
+                    'No worker process decoded %s within %d seconds.'
+                    % (arguments[0], DECODE_TIMEOUT))
+        with self.lock:
+            self.decoded += 1
+            trim = self.decoded % PREVIEW_TRIM_INTERVAL == 0
+        if trim:
+            self.trim_previews()
+        if result is None:
+            return QtGui.QImage()
+        with span('ProcessDecoder.map'):
+            return map_shared_image(*result)
+
+    def trim_previews(self):
+        """Evict the previews the workers stored beyond the size of the
+        cache, in the background."""
+        preview_cache = get_preview_cache()
+        if self.preview_cache_size is not None and preview_cache is not None:
+            preview_cache.trim_in_background()
+
+    def shutdown(self):
+        """Stop the workers and delete the pixels nobody mapped."""
+        self.pool.terminate()
+        self.pool.join()
+        prefix = '%s%d-' % (SHARED_MEMORY_PREFIX, os.getpid())
+        for f in os.listdir(self.directory):
+            if f.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.directory, f))
+                except OSError:
+                    pass
+
+def enable_process_decoding(num_processes=None, preview_cache_size=None,
+                            preview_cache_directory=None):
+    """Create a ProcessDecoder and make the loaders use it.
+
+    Must be called before any thread is started. The arguments are the ones
+    of 'ProcessDecoder'.
+    """
+    decoder = ProcessDecoder(num_processes, preview_cache_size,
+                             preview_cache_directory)
+    set_decode_backend(decoder)
+    return decoder
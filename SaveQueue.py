@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+A queue that saves the transformations of the images in the background.
+
+Saving the rotation of an image is not done right away. The path of the image
+is only marked as dirty and after a short delay all the dirty images are saved
+by a 'WorkerPool'. Rotating an image three times in a row therefore writes it
+only once, with the net transformation of the three rotations.
+
+The queue does not keep the transformations itself. When an image is saved the
+transformation is asked for with the function given in the constructor
+(normally the pending transformation in 'InternalState'). Only one save per
+image runs at a time, if the image is rotated again while it is being saved it
+is saved again afterwards.
+
+When a save finishes the queue emits 'saveFinished(PyQt_PyObject)' with the
+'SaveJob' as argument and if it failed also 'saveFailed(QString)' with a
+message that can be shown to the user.
+"""
+
+from PyQt4 import QtGui, QtCore
+
+from ImageLoader import save_orientation, save_transformed
+from WorkerPool import Job, WorkerPool
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+class SaveJob(Job):
+    """Save a transformation into an image file."""
+    def __init__(self, path, matrix, lossless=True):
+        Job.__init__(self)
+        self.path = path
+        self.matrix = QtGui.QMatrix(matrix)
+        self.lossless = lossless
+        # Set by run().
+        self.success = False
+
+    def run(self):
+        if self.lossless and save_orientation(self.path, self.matrix):
+            self.success = True
+            return
+
+        self.success = save_transformed(self.path, self.matrix)
+
+class SaveQueue(QtCore.QObject):
+    """Saves the transformations of the images coalesced and in the
+    background."""
+    def __init__(self, get_transformation, lossless=True, delay=1000,
+                 num_workers=None, parent=None):
+        """Keyword Arguments:
+        get_transformation -- A function that receives the path of an image
+                              and returns its pending transformation or None.
+        lossless -- Save by rewriting the Exif orientation when possible
+                    (default is True)
+        delay -- How many milliseconds to wait for more changes before
+                 saving (default is 1000)
+        num_workers -- How many images can be saved at the same time (default
+                       is one per core)
+        """
+        QtCore.QObject.__init__(self, parent)
+        self.get_transformation = get_transformation
+        self.lossless = lossless
+
+        # Paths that have to be saved, in the order they were scheduled.
+        self.dirty = []
+        # Maps the paths being saved right now to their SaveJob.
+        self.in_flight = {}
+
+        self.pool = WorkerPool(num_workers)
+        self.connect(self.pool, QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                     self.job_finished)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.connect(self.timer, QtCore.SIGNAL('timeout()'), self.submit_dirty)
+
+    def schedule(self, path):
+        """Mark an image to be saved after the delay."""
+        path = str(path)
+        if path not in self.dirty:
+            self.dirty.append(path)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def schedule_now(self, paths):
+        """Save some images right away, without waiting for the delay."""
+        for path in paths:
+            path = str(path)
+            if path not in self.dirty:
+                self.dirty.append(path)
+        self.submit_dirty()
+
+    def pending_count(self):
+        return len(self.dirty) + len(self.in_flight)
+
+    def submit_dirty(self):
+        """Start saving all the dirty images that are not being saved."""
+        still_dirty = []
+        for path in self.dirty:
+            if path in self.in_flight:
+                still_dirty.append(path)
+                continue
+            matrix = self.get_transformation(path)
+            if matrix is None or matrix.isIdentity():
+                continue
+            job = SaveJob(path, matrix, self.lossless)
+            self.in_flight[path] = job
+            self.pool.submit(job, 0)
+        self.dirty = still_dirty
+
+    def job_finished(self, job):
+        if self.in_flight.get(job.path) is not job:
+            # Already handled by flush().
+            return
+        del self.in_flight[job.path]
+
+        self.emit(QtCore.SIGNAL('saveFinished(PyQt_PyObject)'), job)
+        if not job.success:
+            self.emit(QtCore.SIGNAL('saveFailed(QString)'),
+                      'It was not possible to save the changes to '
+                      + job.path + '!')
+
+        # The image was changed again while it was being saved.
+        if job.path in self.dirty and not self.timer.isActive():
+            self.submit_dirty()
+
+    def flush(self):
+        """Save everything that is pending and wait until it is done."""
+        self.timer.stop()
+        while len(self.dirty) > 0 or len(self.in_flight) > 0:
+            self.submit_dirty()
+            for job in self.in_flight.values():
+                job.wait()
+                self.job_finished(job)
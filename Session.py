@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Session files, so that a set of directories can be resumed where it was left.
+
+A session stores everything 'InternalState' needs to continue browsing a set of
+directories without scanning them: the list of images, the position of the
+current image, the transformations that were not saved yet and the history of
+actions. There is one session file per set of root directories, stored in the
+cache directory of the user. The file is a compressed pickle of plain python
+types, the list of images in the compact form of 'ImageCollection.dump()'.
+"""
+
+import os
+import hashlib
+import zlib
+import cPickle as pickle
+
+from PreviewCache import default_cache_directory
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+# Session files written with another version are ignored.
+SESSION_VERSION = 1
+
+def normalize_roots(roots):
+    return sorted([os.path.abspath(str(x)) for x in roots])
+
+def session_file(roots, directory=None):
+    """Return the path of the session file of a set of root directories.
+
+    Keyword Arguments:
+    roots -- The directories that were chosen by the user.
+    directory -- Where the sessions are stored (default is the user cache
+                 directory)
+    """
+    if directory is None:
+        directory = os.path.join(default_cache_directory(), 'sessions')
+    key = '\0'.join(normalize_roots(roots))
+    return os.path.join(directory, hashlib.sha1(key).hexdigest() + '.session')
+
+def write_session(roots, data, directory=None):
+    """Write a session to disk.
+
+    Keyword Arguments:
+    roots -- The directories that were chosen by the user.
+    data -- A dictionary with the state to store, made of plain python types.
+    directory -- Where the sessions are stored (default is the user cache
+                 directory)
+    """
+    path = session_file(roots, directory)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    contents = {'version': SESSION_VERSION,
+                'roots': normalize_roots(roots),
+                'data': data}
+    compressed = zlib.compress(pickle.dumps(contents, 2), 1)
+
+    # Write to a temporary file first, so that a crash never leaves a broken
+    # session behind.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(compressed)
+    os.rename(tmp_path, path)
+
+def read_session(roots, directory=None):
+    """Return the data stored for a set of root directories or None.
+
+    Keyword Arguments:
+    roots -- The directories that were chosen by the user.
+    directory -- Where the sessions are stored (default is the user cache
+                 directory)
+    """
+    path = session_file(roots, directory)
+    try:
+        with open(path, 'rb') as f:
+            contents = pickle.loads(zlib.decompress(f.read()))
+    except (IOError, zlib.error, pickle.UnpicklingError, EOFError,
+            ValueError):
+        return None
+
+    if contents.get('version') != SESSION_VERSION \
+           or contents.get('roots') != normalize_roots(roots):
+        return None
+    return contents['data']
+
+def delete_session(roots, directory=None):
+    try:
+        os.remove(session_file(roots, directory))
+    except OSError:
+        pass
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+A widget that shows a zoomed image in tiles, for big zoom levels.
+
+Zooming into a big image by scaling it into a single pixmap needs a pixmap of
+the size of the zoomed image, which for a panorama at 100% is hundreds of
+megabytes. 'TiledImageView' is as big as the zoomed image, but it only
+renders the tiles of it that are visible in the scroll area. The tiles are
+rendered by 'TileJob's in a 'WorkerPool' and kept in an 'ImageCache' keyed by
+the image, the zoom level and the position of the tile, so panning back and
+forth only renders the tiles that were never seen at that zoom level.
+
+A tile is cut from the pyramid of the image when it is available. Otherwise
+only the region of the tile is decoded from the file, if the format supports
+it (JPEG does). Until a tile is ready the scaled image of the window is blown
+up in its place.
+"""
+
+import math
+
+from PyQt4 import QtGui, QtCore
+
+from ImageCache import ImageCache, matrix_key
+from ImageLoader import orientation_matrix
+from WorkerPool import Job, WorkerPool
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+TILE_SIZE = 256
+
+def render_region(image, source, size):
+    """Return the part 'source' (a QRectF) of 'image' scaled to 'size'."""
+    result = QtGui.QImage(size, QtGui.QImage.Format_RGB32)
+    result.fill(0)
+    painter = QtGui.QPainter(result)
+    painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+    painter.drawImage(QtCore.QRectF(0, 0, size.width(), size.height()),
+                      image, source)
+    painter.end()
+    return result
+
+def tile_from_pyramid(pyramid, scale, rect):
+    """Render the tile 'rect' of an image zoomed by 'scale' from its pyramid.
+    """
+    level = pyramid.level_for_scale(scale)
+    factor = float(level.width()) / pyramid.full_size().width() / scale
+    source = QtCore.QRectF(rect.x() * factor, rect.y() * factor,
+                           rect.width() * factor, rect.height() * factor)
+    return render_region(level, source, rect.size())
+
+def tile_from_file(path, matrix, scale, rect):
+    """Render the tile 'rect' of an image zoomed by 'scale' decoding only the
+    region of the file it shows.
+
+    Returns None if the image can not be read.
+    """
+    reader = QtGui.QImageReader(path)
+    raw_size = reader.size()
+    if not raw_size.isValid():
+        return None
+    transform = orientation_matrix(path) * matrix
+    true_matrix = QtGui.QImage.trueMatrix(transform, raw_size.width(),
+                                          raw_size.height())
+    (inverted, _) = true_matrix.inverted()
+
+    # The tile in the coordinates of the rotated full resolution image and of
+    # the file.
+    source = QtCore.QRectF(rect.x() / scale, rect.y() / scale,
+                           rect.width() / scale, rect.height() / scale)
+    raw_rect = inverted.mapRect(source).toAlignedRect().intersected(
+        QtCore.QRect(QtCore.QPoint(0, 0), raw_size))
+    if raw_rect.isEmpty():
+        return None
+
+    reader.setClipRect(raw_rect)
+    if scale < 1:
+        reader.setScaledSize(QtCore.QSize(
+            max(1, int(math.ceil(raw_rect.width() * scale))),
+            max(1, int(math.ceil(raw_rect.height() * scale)))))
+    image = reader.read()
+    if image.isNull():
+        return None
+    if not transform.isIdentity():
+        image = image.transformed(transform)
+
+    # Where the tile is in what was decoded.
+    decoded = true_matrix.mapRect(QtCore.QRectF(raw_rect))
+    factor = image.width() / decoded.width()
+    return render_region(image, QtCore.QRectF(
+        (source.x() - decoded.x()) * factor,
+        (source.y() - decoded.y()) * factor,
+        source.width() * factor, source.height() * factor), rect.size())
+
+class TileJob(Job):
+    """Render a tile of a zoomed image in a background thread."""
+    def __init__(self, key, path, matrix, scale, rect, pyramid=None):
+        Job.__init__(self)
+        self.key = key
+        self.path = path
+        self.matrix = matrix
+        self.scale = scale
+        self.rect = rect
+        self.pyramid = pyramid
+        self.image = None
+
+    def run(self):
+        if self.pyramid is not None:
+            self.image = tile_from_pyramid(self.pyramid, self.scale,
+                                           self.rect)
+        else:
+            self.image = tile_from_file(self.path, self.matrix, self.scale,
+                                        self.rect)
+        self.pyramid = None
+
+class TiledImageView(QtGui.QWidget):
+    """Shows an image zoomed by some factor, rendering only visible tiles."""
+    def __init__(self, cache_size=128 * 1024 * 1024, num_workers=None,
+                 parent=None):
+        """Keyword Arguments:
+        cache_size -- How many bytes of tiles are kept in memory
+                      (default is 128MB)
+        num_workers -- How many threads render tiles (default is one per
+                       core)
+        """
+        QtGui.QWidget.__init__(self, parent)
+        self.cache = ImageCache(cache_size)
+        self.pool = WorkerPool(num_workers)
+        self.connect(self.pool, QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                     self.tile_finished)
+        # Maps the key of every tile that is being rendered to its job.
+        self.pending = {}
+
+        self.path = None
+        self.matrix = QtGui.QMatrix()
+        self.scale = 1.0
+        # The size of the rotated image at full resolution.
+        self.full_size = QtCore.QSize()
+        self.stand_in = None
+        self.pyramid = None
+        # If the format of the file can decode a region of the image.
+        self.clip_supported = False
+
+    def show_image(self, path, matrix, full_size, scale, stand_in,
+                   pyramid=None):
+        """Show an image zoomed by 'scale'.
+
+        Keyword Arguments:
+        path -- The file path to the image.
+        matrix -- The transformation of the user, on top of the orientation.
+        full_size -- The size of the rotated image at full resolution.
+        scale -- The zoom factor, 1 is full resolution.
+        stand_in -- A pixmap of the whole image to show until the tiles are
+                    ready.
+        pyramid -- The ImagePyramid of the image if it is built
+                   (default is None)
+        """
+        if path != self.path:
+            reader = QtGui.QImageReader(path)
+            self.clip_supported = reader.supportsOption(
+                QtGui.QImageIOHandler.ClipRect)
+        self.path = str(path)
+        self.matrix = QtGui.QMatrix(matrix)
+        self.full_size = QtCore.QSize(full_size)
+        self.scale = scale
+        self.stand_in = stand_in
+        self.pyramid = pyramid
+        self.cancel_pending(set())
+        self.resize(self.scaled_size())
+        self.update()
+
+    def set_pyramid(self, pyramid):
+        self.pyramid = pyramid
+        self.update()
+
+    def scaled_size(self):
+        return QtCore.QSize(
+            max(1, int(round(self.full_size.width() * self.scale))),
+            max(1, int(round(self.full_size.height() * self.scale))))
+
+    def sizeHint(self):
+        return self.scaled_size()
+
+    def tile_key(self, column, row):
+        return (self.path, matrix_key(self.matrix), round(self.scale, 6),
+                column, row)
+
+    def tile_rect(self, column, row):
+        return QtCore.QRect(column * TILE_SIZE, row * TILE_SIZE, TILE_SIZE,
+                            TILE_SIZE).intersected(
+            QtCore.QRect(QtCore.QPoint(0, 0), self.scaled_size()))
+
+    def tiles_in(self, rect):
+        """Return a list of tuples (column, row) of the tiles that 'rect'
+        touches."""
+        return [(column, row)
+                for row in range(rect.top() // TILE_SIZE,
+                                 rect.bottom() // TILE_SIZE + 1)
+                for column in range(rect.left() // TILE_SIZE,
+                                    rect.right() // TILE_SIZE + 1)]
+
+    def paintEvent(self, event):
+        if self.path is None:
+            return
+        painter = QtGui.QPainter(self)
+        size = self.scaled_size()
+
+        # Tiles that were scrolled away are not rendered anymore.
+        visible = self.visibleRegion().boundingRect()
+        wanted = set([self.tile_key(c, r)
+                      for (c, r) in self.tiles_in(visible)])
+        self.cancel_pending(wanted)
+
+        for (column, row) in self.tiles_in(event.rect()):
+            rect = self.tile_rect(column, row)
+            if rect.isEmpty():
+                continue
+            key = self.tile_key(column, row)
+            images = self.cache.get(key)
+            if images is not None:
+                painter.drawPixmap(rect.topLeft(), images[0])
+                continue
+            if self.stand_in is not None:
+                factor_x = float(self.stand_in.width()) / size.width()
+                factor_y = float(self.stand_in.height()) / size.height()
+                painter.drawPixmap(QtCore.QRectF(rect), self.stand_in,
+                                   QtCore.QRectF(rect.x() * factor_x,
+                                                 rect.y() * factor_y,
+                                                 rect.width() * factor_x,
+                                                 rect.height() * factor_y))
+            if key in wanted:
+                self.request(key, rect)
+        painter.end()
+
+    def request(self, key, rect):
+        if key in self.pending:
+            return
+        # Without a pyramid and without decoding regions every tile would
+        # decode the whole file. The stand-in stays until the pyramid is
+        # ready.
+        if self.pyramid is None and not self.clip_supported:
+            return
+        job = TileJob(key, self.path, self.matrix, self.scale, rect,
+                      self.pyramid)
+        self.pending[key] = job
+        self.pool.submit(job, 0)
+
+    def cancel_pending(self, wanted):
+        for (key, job) in self.pending.items():
+            if key not in wanted and not job.taken:
+                self.pool.cancel(job)
+                del self.pending[key]
+
+    def tile_finished(self, job):
+        if self.pending.get(job.key) is not job:
+            return
+        del self.pending[job.key]
+        if job.image is None:
+            return
+        self.cache.put(job.key, (QtGui.QPixmap.fromImage(job.image),))
+        if job.key[:3] == self.tile_key(0, 0)[:3]:
+            self.update(job.rect)
+
+    def invalidate_path(self, path):
+        """Forget the tiles of an image, e.g. because it was saved."""
+        self.cache.invalidate_path(path)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Low overhead tracing of the hot paths.
+
+The code that may be slow is wrapped in spans:
+
+    with span('ImageLoader.run'):
+        ...
+
+When tracing is disabled 'span()' returns a span that does nothing, so the
+instrumented code costs one function call. Once 'enable_tracing()' was called
+every span records when it started and how long it took, from any thread. The
+last spans are kept in a ring buffer that 'Tracer.export()' writes in the
+trace event format of Chrome (chrome://tracing, Perfetto), to be attached to
+bug reports. The durations of the last spans of every name are also kept in a
+'RollingHistogram', for the percentiles shown in the performance overlay.
+
+The latency the user feels when changing the image is measured from the
+keypress ('input_received()') until the image is painted ('painted()'), as
+long as the image was ready by then ('image_shown()'). It is recorded like a
+span named 'keypress_to_paint'.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+KEYPRESS_TO_PAINT = 'keypress_to_paint'
+
+class RollingHistogram:
+    """The last durations of something, to compute percentiles of them."""
+    def __init__(self, size=512):
+        self.samples = deque(maxlen=size)
+        self.total = 0
+
+    def add(self, duration):
+        self.samples.append(duration)
+        self.total += 1
+
+    def percentile(self, p):
+        """Return the percentile 'p' of the durations or None if there are
+        none."""
+        samples = sorted(self.samples)
+        if len(samples) == 0:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+class Span(object):
+    """Records how long the code in a 'with' block takes."""
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.name, self.start, time.time() - self.start,
+                           self.args)
+        return False
+
+class NullSpan(object):
+    """The span of a disabled tracer."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Tracer:
+    """Keeps the last spans and a histogram of the durations of every
+    name."""
+    def __init__(self, max_events=20000, histogram_size=512):
+        """Keyword Arguments:
+        max_events -- How many spans are kept for the export (default is
+                      20000)
+        histogram_size -- How many durations of every name are kept for the
+                          percentiles (default is 512)
+        """
+        self.lock = threading.Lock()
+        # Tuples (name, thread, start, duration, args).
+        self.events = deque(maxlen=max_events)
+        self.histogram_size = histogram_size
+        self.histograms = {}
+        self.start = time.time()
+        # When the last key that changes the image was pressed, and if the
+        # image it asked for is shown.
+        self.input_time = None
+        self.input_shown = False
+
+    def record(self, name, start, duration, args=None):
+        ident = threading.current_thread().ident
+        with self.lock:
+            self.events.append((name, ident, start, duration, args))
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = RollingHistogram(self.histogram_size)
+                self.histograms[name] = histogram
+            histogram.add(duration)
+
+    def percentile(self, name, p):
+        """Return the percentile 'p' of the last durations of a span in
+        seconds, or None."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                return None
+            return histogram.percentile(p)
+
+    def input_received(self):
+        self.input_time = time.time()
+        self.input_shown = False
+
+    def image_shown(self):
+        if self.input_time is not None:
+            self.input_shown = True
+
+    def painted(self):
+        if self.input_time is None or not self.input_shown:
+            return
+        self.record(KEYPRESS_TO_PAINT, self.input_time,
+                    time.time() - self.input_time)
+        self.input_time = None
+
+    def summary(self):
+        """Return a dictionary with the percentiles of every span in
+        milliseconds."""
+        with self.lock:
+            items = self.histograms.items()
+            result = {}
+            for (name, histogram) in items:
+                result[name] = {'count': histogram.total}
+                for p in (50, 95, 99):
+                    result[name]['p%d' % p] = histogram.percentile(p) * 1000
+        return result
+
+    def export(self, path):
+        """Write the kept spans as a Chrome trace event file."""
+        with self.lock:
+            events = list(self.events)
+        names = dict([(x.ident, x.name) for x in threading.enumerate()])
+        pid = os.getpid()
+
+        trace = []
+        for ident in set([x[1] for x in events]):
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                          'tid': ident,
+                          'args': {'name': names.get(ident, str(ident))}})
+        for (name, ident, start, duration, args) in events:
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': ident,
+                     'ts': int((start - self.start) * 1e6),
+                     'dur': int(duration * 1e6)}
+            if args is not None:
+                event['args'] = args
+            trace.append(event)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms',
+                       'otherData': {'summary': self.summary()}}, f)
+        os.rename(tmp_path, path)
+
+TRACER = None
+
+def enable_tracing(max_events=20000, histogram_size=512):
+    """Create the shared Tracer.
+
+    Keyword Arguments:
+    max_events -- How many spans are kept for the export (default is 20000)
+    histogram_size -- How many durations of every name are kept for the
+                      percentiles (default is 512)
+    """
+    global TRACER
+    TRACER = Tracer(max_events, histogram_size)
+    return TRACER
+
+def get_tracer():
+    """Return the shared Tracer or None if tracing is disabled."""
+    return TRACER
+
+def span(name, args=None):
+    """Return a span for a 'with' block, which does nothing if tracing is
+    disabled.
+
+    Keyword Arguments:
+    name -- What is being timed.
+    args -- A dictionary that is shown with the span in the trace, e.g. the
+            path of the image (default is None)
+    """
+    if TRACER is None:
+        return NULL_SPAN
+    return Span(TRACER, name, args)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+A bounded pool of worker threads with a priority queue.
+
+Jobs are objects derived from 'Job'. They are queued with a priority (lower
+numbers run first) and executed by a fixed number of threads, which by default
+is the number of cores of the machine. The priority of a job that is still
+waiting in the queue can be changed and the job can be cancelled, in which case
+it will never run.
+
+When a job finished running the pool emits the signal
+'jobFinished(PyQt_PyObject)' with the job as argument. Since the job runs in a
+worker thread the signal is delivered through the event loop of the thread the
+receiver lives in, normally the main thread.
+"""
+
+import heapq
+import itertools
+import multiprocessing
+from threading import Thread, Lock, Condition, Event
+
+from PyQt4 import QtCore
+
+__author__ = "Fernando Sanchez Villaamil"
+__copyright__ = "Copyright 2010, Fernando Sanchez Villaamil"
+__credits__ = ["Fernando Sanchez Villaamil"]
+__license__ = "MIT"
+__version__ = "1.0beta"
+__maintainer__ = "Fernando Sanchez Villaamil"
+__email__ = "nano@moomug.com"
+__status__ = "Just for fun!"
+
+class Job(object):
+    """Something that can be run by a 'WorkerPool'.
+
+    Subclasses only override 'run()'.
+    """
+    def __init__(self):
+        self.priority = None
+        self.cancelled = False
+        # Set once a worker took the job out of the queue.
+        self.taken = False
+        # If run() raised, the exception is kept here.
+        self.error = None
+        self.finished = Event()
+
+    def run(self):
+        """Do the work of the job in a worker thread. Subclasses override it,
+        the job itself does nothing."""
+        pass
+
+    def is_finished(self):
+        return self.finished.is_set()
+
+    def wait(self):
+        """Block until the job finished running or was cancelled."""
+        self.finished.wait()
+
+class WorkerPool(QtCore.QObject):
+    """A fixed number of threads that run 'Job's ordered by priority."""
+    def __init__(self, num_workers=None, parent=None):
+        QtCore.QObject.__init__(self, parent)
+
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        # The queue holds tuples (priority, sequence number, job). The
+        # sequence number keeps jobs with the same priority in FIFO order.
+        # When the priority of a job changes a new entry is pushed and the
+        # old one is skipped when it comes out of the queue.
+        self.queue = []
+        self.counter = itertools.count()
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.running = True
+
+        self.workers = []
+        for _ in range(num_workers):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job, priority):
+        with self.lock:
+            job.priority = priority
+            heapq.heappush(self.queue, (priority, next(self.counter), job))
+            self.not_empty.notify()
+
+    def set_priority(self, job, priority):
+        """Change the priority of a job that has not started running yet."""
+        with self.lock:
+            if job.taken or job.cancelled or job.priority == priority:
+                return
+            job.priority = priority
+            heapq.heappush(self.queue, (priority, next(self.counter), job))
+            self.not_empty.notify()
+
+    def cancel(self, job):
+        """Make sure a job never runs. Jobs already running are not stopped."""
+        with self.lock:
+            if job.taken:
+                return
+            job.cancelled = True
+        job.finished.set()
+
+    def queue_depth(self):
+        with self.lock:
+            return len([x for x in self.queue
+                        if not x[2].taken and not x[2].cancelled
+                        and x[0] == x[2].priority])
+
+    def shutdown(self):
+        """Stop the workers once they finish the job they are running."""
+        with self.lock:
+            self.running = False
+            self.not_empty.notify_all()
+
+    def next_job(self):
+        with self.lock:
+            while self.running:
+                while len(self.queue) == 0 and self.running:
+                    self.not_empty.wait()
+                if not self.running:
+                    break
+                (priority, _, job) = heapq.heappop(self.queue)
+                if job.taken or job.cancelled or job.priority != priority:
+                    continue
+                job.taken = True
+                return job
+            return None
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            try:
+                job.run()
+            except Exception as e:
+                job.error = e
+            job.finished.set()
+            self.emit(QtCore.SIGNAL('jobFinished(PyQt_PyObject)'), job)
@@ -13,14 +13,20 @@ shortcuts and the program is started by calling the qt main loop.
 """
 
 import sys
-import os
-import shutil
 
 from PyQt4 import QtGui, QtCore
 from PyQt4 import uic
 
-from InternalException import InternalException
 from InternalState import InternalState
+from MemoryGovernor import MemoryGovernor
+from Navigation import NavigationTracker
+from PreviewCache import enable_preview_cache
+from ProcessDecoder import enable_process_decoding
+from PerceptualHash import enable_hash_index
+from Tracing import enable_tracing, span
+from Filmstrip import ThumbnailModel, Filmstrip
+from TiledImageView import TiledImageView
+from SaveQueue import SaveQueue
 import Actions
 from Shortcuts import ShortcutsHandler
 
@@ -37,8 +43,89 @@ __status__ = "Just for fun!"
 ROTATION_IN_HISTORY = True
 DISCARDING_IN_HISTORY = True
 AUTOMATICALLY_SAVE_ROTATIONS = True
+# Save rotations by rewriting the Exif orientation instead of re-encoding the
+# image. Images that can not carry Exif metadata are still re-encoded.
+LOSSLESS_ROTATION_SAVE = True
+# Rotations are saved after this many milliseconds, so that several rotations
+# of the same image are written only once.
+SAVE_DELAY = 1000
+SAVE_THREADS = None # None means one per core.
+# Only write discarded images into a log instead of moving them right away.
+# They are all moved at once with 'Apply Discards'.
+DEFERRED_DISCARD = False
+DECISION_LOG_SYNC_INTERVAL = 2000 # In milliseconds.
+# Group near-duplicate images by their perceptual hash. Needs NumPy.
+SIMILARITY_ENABLED = True
+SIMILARITY_THREADS = 1
+# Up to how many of the 64 bits of the hashes of two images may differ for
+# them to be considered similar.
+SIMILARITY_DISTANCE = 8
+# 'Discard Similar' asks before it discards more than this many images.
+SIMILARITY_CONFIRM_COUNT = 3
+# A strip of thumbnails under the image. With FILMSTRIP_GRID the thumbnails
+# wrap into a grid.
+FILMSTRIP_ENABLED = True
+FILMSTRIP_GRID = False
+THUMBNAIL_SIZE = 96 # In pixels.
+THUMBNAIL_CACHE_SIZE = 64 * 1024 * 1024 # In bytes.
+THUMBNAIL_THREADS = 1
+# Build a pyramid of the current image after it was shown, so that zooming
+# does not wait for the full resolution image. Otherwise it is built on the
+# first zoom, which spares decoding the full resolution of every image that is
+# only looked at.
+PYRAMID_PREBUILD = False
+# After this many milliseconds without zooming the zoomed image is smoothed.
+ZOOM_REFINE_DELAY = 150
+# From this zoom factor on (1 is full resolution) only the visible tiles of
+# the image are rendered, instead of scaling the whole image.
+TILED_ZOOM_ENABLED = True
+TILED_ZOOM_THRESHOLD = 0.5
+TILE_CACHE_SIZE = 128 * 1024 * 1024 # In bytes.
+TILE_THREADS = None # None means one per core.
+# The images are loaded again for a new window size after the window was not
+# resized for this many milliseconds.
+RESIZE_DELAY = 200
+# Holding a key down skims through the images. From this rate on only what is
+# cheap to show is shown and only the images where the user is likely to
+# stop are loaded, until no key was pressed for a while.
+NAVIGATION_FAST_RATE = 8.0 # In images per second.
+NAVIGATION_SETTLE_DELAY = 150 # In milliseconds.
+# About how long an image takes to load, in seconds. While skimming the
+# images that are passed in this time are skipped by the pre-fetching.
+SKIM_LEAD_TIME = 0.15
+SKIM_PREFETCH = 2
+# Resume the previous session when the same directories are chosen again.
+RESUME_SESSIONS = True
+SESSION_SAVE_INTERVAL = 60000 # In milliseconds.
 ZOOM_POSITIVE_FACTOR = 1.25
 ZOOM_NEGATIVE_FACTOR = 0.8
+PREFETCH_AHEAD = 5
+PREFETCH_BEHIND = 2
+IMAGE_CACHE_SIZE = 512 * 1024 * 1024 # In bytes.
+LOADER_THREADS = None # None means one per core.
+# Where the loaders decode: 'threads' in the loader threads or 'processes' in
+# worker processes, which are not held back by the GIL. The pixels come back
+# through shared memory.
+DECODE_BACKEND = 'threads'
+DECODE_PROCESSES = None # None means one per core.
+PREVIEW_CACHE_ENABLED = True
+PREVIEW_CACHE_SIZE = 2 * 1024 * 1024 * 1024 # In bytes.
+# All the images in memory together, the caches are shrunk to stay under it.
+# Only what is needed to browse is kept, full resolution images only for
+# zooming.
+MEMORY_BUDGET = 1024 * 1024 * 1024 # In bytes.
+MEMORY_RSS_LIMIT = None # In bytes, None means no limit.
+MEMORY_CHECK_INTERVAL = 1000 # In milliseconds.
+# With PYRAMID_PREBUILD the pyramid is built before the user zooms only if it
+# takes at most this part of the budget.
+PYRAMID_PREBUILD_SHARE = 0.5
+# Time the hot paths from the start, for the performance overlay
+# (Ctrl+Shift+P) and the trace export. Otherwise the tracing only starts when
+# the overlay is shown for the first time.
+TRACING_ENABLED = False
+TRACE_MAX_EVENTS = 20000
+TRACE_HISTOGRAM_SIZE = 512
+PERFORMANCE_OVERLAY_INTERVAL = 500 # In milliseconds.
 
 # Global variables to contain the different parts of the GUI
 ACTION_CHOOSE_FOLDER = None
@@ -49,46 +136,379 @@ ACTION_ZOOM_OUT = None
 ACTION_ROTATE_RIGHT = None
 ACTION_ROTATE_LEFT = None
 ACTION_SAVE = None
+ACTION_APPLY_ROTATIONS = None
+ACTION_APPLY_DISCARDS = None
+ACTION_DISCARD_SIMILAR = None
+ACTION_SKIP_SIMILAR = None
+ACTION_SHOW_FILMSTRIP = None
+ACTION_PERFORMANCE_OVERLAY = None
+ACTION_EXPORT_TRACE = None
+ACTION_ACTUAL_SIZE = None
 SCROLL_AREA = None
 IMAGE_AREA = None
 STATUS_BAR = None
 STATUS_BAR_LABEL = None
 FILE_DIALOG = None
 LIST_VIEW = None
+FILMSTRIP = None
+FILMSTRIP_MODEL = None
 
 # Shortcuts container
 SHORTCUTS = None
 
+# Saves the rotations in the background.
+SAVE_QUEUE = None
+
+# Finds similar images, None if it is disabled.
+HASH_INDEX = None
+# A tuple (key, count) with the last number of similar images shown.
+SIMILAR_COUNT = None
+
+# The size the image is zoomed to, None if it fits the window.
+ZOOM_SIZE = None
+ZOOM_REFINE_TIMER = None
+# Takes the place of the contents of the scroll area at big zoom factors.
+TILED_VIEW = None
+TILED_MODE = False
+SCROLL_CONTENTS = None
+
+# Coalesces the resize events of the window.
+RESIZE_TIMER = None
+# What was shown when the resizing started.
+RESIZE_SOURCE = None
+
+# The direction and rate of the navigation, the steps that were not done yet
+# and the timers that do them and notice when the user slows down.
+NAVIGATION = None
+PENDING_STEPS = 0
+NAVIGATION_TIMER = None
+SETTLE_TIMER = None
+
+# Keeps the images in memory under MEMORY_BUDGET.
+MEMORY_GOVERNOR = None
+
+# Times the hot paths, None if tracing is disabled.
+TRACER = None
+PERFORMANCE_OVERLAY = None
+PERFORMANCE_TIMER = None
+
+# The worker processes that decode, None if the loader threads decode.
+DECODER = None
+
 ### Define some function that make up the actions that the program can
 ### perform.
-def show_image():
+def show_status():
+    update_filmstrip()
     if not INTERNAL_STATE.image_available():
+        if INTERNAL_STATE.is_scanning():
+            STATUS_BAR_LABEL.setText('Scanning...')
         return
-    image = INTERNAL_STATE.current_image_scaled_and_rotated()
-    IMAGE_AREA.setPixmap(image)
     text = "" + INTERNAL_STATE.current_image_complete_path()
     pos = INTERNAL_STATE.get_current_image_number()
     total = INTERNAL_STATE.get_total_number_images()
-    text += '  [' + str(pos) + '/' + str(total) + ']'
+    text += '  [' + str(pos) + '/' + str(total)
+    if INTERNAL_STATE.is_scanning():
+        text += ', scanning...'
+    text += ']'
+    moving = INTERNAL_STATE.file_operations.pending_count()
+    if moving > 0:
+        text += '  (moving ' + str(moving) + ' files...)'
+    decisions = INTERNAL_STATE.pending_decisions()
+    if decisions > 0:
+        text += '  (' + str(decisions) + ' to discard)'
+    similar = similar_count()
+    if similar > 0:
+        text += '  (' + str(similar) + ' similar)'
     STATUS_BAR_LABEL.setText(text)
 
-def fit_image():
+def show_image():
+    with span('show_image'):
+        show_current_image()
+
+def show_current_image():
+    global ZOOM_SIZE
     if not INTERNAL_STATE.image_available():
         return
-    pix = INTERNAL_STATE.current_image()
-    IMAGE_AREA.setPixmap(pix.scaled(SCROLL_AREA.maximumViewportSize(),
-                                   QtCore.Qt.KeepAspectRatio))
+    show_status()
+    ZOOM_SIZE = None
+    ZOOM_REFINE_TIMER.stop()
+    leave_tiled_view()
+
+    # Don't wait for the loader, 'image_loaded()' will show the image once it
+    # is ready.
+    if not INTERNAL_STATE.current_image_ready():
+        stand_in = INTERNAL_STATE.current_image_stand_in()
+        if stand_in is not None:
+            IMAGE_AREA.setPixmap(stand_in)
+        else:
+            IMAGE_AREA.setText('Loading...')
+        return
+    image = INTERNAL_STATE.current_image_scaled_and_rotated()
+    if image.isNull():
+        error = INTERNAL_STATE.current_image_error()
+        IMAGE_AREA.setText('The image could not be loaded.')
+        if error is not None:
+            STATUS_BAR_LABEL.setText(
+                INTERNAL_STATE.current_image_complete_path() + '  (error: '
+                + str(error) + ')')
+        return
+    IMAGE_AREA.setPixmap(image)
+    if TRACER is not None:
+        TRACER.image_shown()
+    # No full resolution image is decoded for the images that are skimmed.
+    if PYRAMID_PREBUILD and not INTERNAL_STATE.skimming \
+           and pyramid_affordable():
+        INTERNAL_STATE.request_pyramid()
+
+def pyramid_affordable():
+    """Return True if the pyramid of the current image may be built before
+    the user zooms."""
+    if MEMORY_GOVERNOR is None:
+        return True
+    size = INTERNAL_STATE.current_image_full_size()
+    if not size.isValid():
+        return False
+    # Four bytes per pixel and a third more for the smaller levels.
+    pyramid_bytes = size.width() * size.height() * 4 * 4 // 3
+    return pyramid_bytes <= MEMORY_GOVERNOR.budget * PYRAMID_PREBUILD_SHARE
+
+def is_zoomed():
+    return ZOOM_SIZE is not None or TILED_MODE
+
+def enforce_memory_budget():
+    if MEMORY_GOVERNOR is not None:
+        MEMORY_GOVERNOR.enforce()
+
+def image_loaded(loader):
+    if HASH_INDEX is not None and loader.matrix.isIdentity():
+        HASH_INDEX.add_loaded(loader.filename, loader.image_scaled)
+    enforce_memory_budget()
+    if INTERNAL_STATE.is_current_image_loader(loader):
+        show_image()
+
+def similar_images():
+    """Return the paths of the images similar to the current one, without
+    the current one."""
+    if HASH_INDEX is None or not INTERNAL_STATE.image_available():
+        return []
+    path = INTERNAL_STATE.current_image_complete_path()
+    # The hashes of discarded images are kept, they may come back.
+    return [x for x in HASH_INDEX.similar(path, SIMILARITY_DISTANCE)
+            if x != path and INTERNAL_STATE.index_of(*x.rsplit('/', 1)) != -1]
+
+def similar_count():
+    """Return how many images are similar to the current one. It is only
+    counted again when the current image, the hashes or the list changed."""
+    global SIMILAR_COUNT
+    if HASH_INDEX is None or not INTERNAL_STATE.image_available():
+        return 0
+    key = (INTERNAL_STATE.current_image_complete_path(), HASH_INDEX.version,
+           INTERNAL_STATE.images_list.modifications)
+    if SIMILAR_COUNT is None or SIMILAR_COUNT[0] != key:
+        SIMILAR_COUNT = (key, len(similar_images()))
+    return SIMILAR_COUNT[1]
+
+def discard_similar_images():
+    similar = similar_images()
+    if len(similar) == 0:
+        return
+    if len(similar) > SIMILARITY_CONFIRM_COUNT:
+        answer = QtGui.QMessageBox.question(
+            MAIN_WINDOW, 'Discard Similar',
+            'Discard the ' + str(len(similar)) + ' images similar to this '
+            'one?', QtGui.QMessageBox.Yes | QtGui.QMessageBox.No,
+            QtGui.QMessageBox.No)
+        if answer != QtGui.QMessageBox.Yes:
+            return
+    images = [tuple(x.rsplit('/', 1)) for x in similar]
+    deletions = INTERNAL_STATE.discard_images(
+        images, SCROLL_AREA.maximumViewportSize())
+
+    if DISCARDING_IN_HISTORY and len(deletions) > 0:
+        action = Actions.GroupDeletionAction(INTERNAL_STATE, deletions,
+                                             INTERNAL_STATE.pos)
+        INTERNAL_STATE.add_to_history(action)
+
+    if INTERNAL_STATE.image_available():
+        show_image()
+    else:
+        clear()
+
+def skip_similar_images():
+    if HASH_INDEX is None or not INTERNAL_STATE.image_available():
+        return
+    group = HASH_INDEX.similar(INTERNAL_STATE.current_image_complete_path(),
+                               SIMILARITY_DISTANCE)
+    pos = INTERNAL_STATE.next_different_position(group)
+    if pos == -1:
+        return
+    INTERNAL_STATE.jump_to_image(pos, SCROLL_AREA.maximumViewportSize())
+    show_image()
+
+def fit_image():
+    # The scaled image already fits the window.
+    show_image()
+
+def current_zoom_scale(full_size):
+    """Return how big the shown image is compared to its full resolution."""
+    if TILED_MODE:
+        return TILED_VIEW.scale
+    pix = IMAGE_AREA.pixmap()
+    if pix is None or pix.isNull() or not full_size.isValid():
+        return None
+    return float(pix.width()) / full_size.width()
 
 def zoom(scale_factor):
     if not INTERNAL_STATE.image_available():
         return
-    pix = INTERNAL_STATE.current_image()
-    new_size = IMAGE_AREA.size() * scale_factor
-    IMAGE_AREA.setPixmap(pix.scaled(new_size, QtCore.Qt.KeepAspectRatio))
-    new_size = IMAGE_AREA.pixmap().size()
-    SCROLL_AREA.ensureVisible(new_size.width()/2.0, new_size.height()/2.0,
-                             SCROLL_AREA.maximumViewportSize().width()/2.0,
-                             SCROLL_AREA.maximumViewportSize().height()/2.0)
+    full_size = INTERNAL_STATE.current_image_full_size()
+    scale = current_zoom_scale(full_size)
+    if scale is None:
+        zoom_to_size(IMAGE_AREA.size() * scale_factor)
+    else:
+        zoom_to(full_size, scale * scale_factor)
+
+def zoom_to(full_size, scale):
+    """Show the current image 'scale' times its full resolution."""
+    if TILED_VIEW is not None and scale >= TILED_ZOOM_THRESHOLD:
+        show_tiled(full_size, scale)
+    else:
+        zoom_to_size(QtCore.QSize(int(round(full_size.width() * scale)),
+                                  int(round(full_size.height() * scale))))
+
+def zoom_actual_size():
+    if not INTERNAL_STATE.image_available():
+        return
+    full_size = INTERNAL_STATE.current_image_full_size()
+    if full_size.isValid():
+        zoom_to(full_size, 1.0)
+
+def zoom_to_size(size):
+    global ZOOM_SIZE
+    center = scroll_center()
+    leave_tiled_view()
+    ZOOM_SIZE = size
+    pyramid = INTERNAL_STATE.current_pyramid()
+    if pyramid is not None:
+        # A fast version first, the smooth one once the user stops zooming.
+        IMAGE_AREA.setPixmap(pyramid.scaled(ZOOM_SIZE, False))
+        ZOOM_REFINE_TIMER.start()
+    else:
+        # The scaled image is blown up until the pyramid is ready.
+        INTERNAL_STATE.request_pyramid()
+        if INTERNAL_STATE.current_image_ready():
+            pix = INTERNAL_STATE.current_image_scaled_and_rotated()
+        else:
+            pix = INTERNAL_STATE.current_image_stand_in()
+        if pix is None:
+            return
+        IMAGE_AREA.setPixmap(pix.scaled(ZOOM_SIZE, QtCore.Qt.KeepAspectRatio))
+    set_scroll_center(center)
+
+def show_tiled(full_size, scale):
+    """Show the current image zoomed in the TiledImageView."""
+    global TILED_MODE, ZOOM_SIZE
+    center = scroll_center()
+    ZOOM_SIZE = None
+    ZOOM_REFINE_TIMER.stop()
+    if not TILED_MODE:
+        SCROLL_AREA.takeWidget()
+        SCROLL_AREA.setWidgetResizable(False)
+        SCROLL_AREA.setWidget(TILED_VIEW)
+        TILED_MODE = True
+
+    if INTERNAL_STATE.current_image_ready():
+        stand_in = INTERNAL_STATE.current_image_scaled_and_rotated()
+    else:
+        stand_in = INTERNAL_STATE.current_image_stand_in()
+    path = INTERNAL_STATE.current_image_complete_path()
+    matrix = INTERNAL_STATE.get_transformation(path)
+    if matrix is None:
+        matrix = QtGui.QMatrix()
+    TILED_VIEW.show_image(path, matrix, full_size, scale, stand_in,
+                          INTERNAL_STATE.current_pyramid())
+    # The tiles of a format that decodes regions are decoded from the file,
+    # the full resolution image is only needed for the others.
+    if not TILED_VIEW.clip_supported:
+        INTERNAL_STATE.request_pyramid()
+    set_scroll_center(center)
+
+def leave_tiled_view():
+    global TILED_MODE
+    if not TILED_MODE:
+        return
+    SCROLL_AREA.takeWidget()
+    SCROLL_AREA.setWidgetResizable(True)
+    SCROLL_AREA.setWidget(SCROLL_CONTENTS)
+    TILED_MODE = False
+
+def scroll_center():
+    """Return the middle of the scroll area, relative to the size of what it
+    shows."""
+    horizontal = SCROLL_AREA.horizontalScrollBar()
+    vertical = SCROLL_AREA.verticalScrollBar()
+    width = horizontal.maximum() + horizontal.pageStep()
+    height = vertical.maximum() + vertical.pageStep()
+    return ((horizontal.value() + horizontal.pageStep() / 2.0) / max(1, width),
+            (vertical.value() + vertical.pageStep() / 2.0) / max(1, height))
+
+def set_scroll_center(center):
+    # The scroll bars only know the new size after the layout was updated.
+    QtCore.QTimer.singleShot(0, lambda: apply_scroll_center(center))
+
+def apply_scroll_center(center):
+    horizontal = SCROLL_AREA.horizontalScrollBar()
+    vertical = SCROLL_AREA.verticalScrollBar()
+    width = horizontal.maximum() + horizontal.pageStep()
+    height = vertical.maximum() + vertical.pageStep()
+    horizontal.setValue(int(center[0] * width - horizontal.pageStep() / 2.0))
+    vertical.setValue(int(center[1] * height - vertical.pageStep() / 2.0))
+
+def refine_zoom():
+    if ZOOM_SIZE is None:
+        return
+    pyramid = INTERNAL_STATE.current_pyramid()
+    if pyramid is not None:
+        IMAGE_AREA.setPixmap(pyramid.scaled(ZOOM_SIZE))
+
+def stand_in_loaded(job):
+    if not INTERNAL_STATE.stand_in_loaded(job):
+        return
+    if not INTERNAL_STATE.current_image_ready() and not is_zoomed():
+        IMAGE_AREA.setPixmap(INTERNAL_STATE.current_image_stand_in())
+
+def pyramid_built(job):
+    if not INTERNAL_STATE.pyramid_built(job):
+        return
+    enforce_memory_budget()
+    if TILED_MODE:
+        TILED_VIEW.set_pyramid(INTERNAL_STATE.current_pyramid())
+    refine_zoom()
+
+def resizing():
+    """Show the image quickly scaled to the new size of the window."""
+    global RESIZE_SOURCE
+    RESIZE_TIMER.start()
+    if ZOOM_SIZE is not None or TILED_MODE \
+           or not INTERNAL_STATE.image_available():
+        return
+    # Always scale what was shown before the resizing started, scaling the
+    # result of a fast scaling again looks worse every time.
+    if RESIZE_SOURCE is None:
+        pix = IMAGE_AREA.pixmap()
+        if pix is None or pix.isNull():
+            return
+        RESIZE_SOURCE = QtGui.QPixmap(pix)
+    IMAGE_AREA.setPixmap(RESIZE_SOURCE.scaled(
+        SCROLL_AREA.maximumViewportSize(), QtCore.Qt.KeepAspectRatio,
+        QtCore.Qt.FastTransformation))
+
+def resize_finished():
+    global RESIZE_SOURCE
+    RESIZE_SOURCE = None
+    INTERNAL_STATE.rescale_images(SCROLL_AREA.maximumViewportSize())
+    if ZOOM_SIZE is None and not TILED_MODE:
+        show_image()
 
 def zoom_in():
     zoom(ZOOM_POSITIVE_FACTOR)
@@ -96,6 +516,15 @@ def zoom_in():
 def zoom_out():
     zoom(ZOOM_NEGATIVE_FACTOR)
 
+def input_received():
+    """Start timing a key that changes the image until it is painted."""
+    if TRACER is not None:
+        TRACER.input_received()
+
+def image_painted():
+    if TRACER is not None:
+        TRACER.painted()
+
 def show_next_image():
     INTERNAL_STATE.next_image(SCROLL_AREA.maximumViewportSize())
     show_image()
@@ -104,21 +533,52 @@ def show_previous_image():
     INTERNAL_STATE.previous_image(SCROLL_AREA.maximumViewportSize())
     show_image()
 
+def step_forward():
+    navigate(1)
+
+def step_backward():
+    navigate(-1)
+
+def navigate(steps):
+    """Move 'steps' images away once the events that are queued are handled,
+    so that the key repeats that piled up meanwhile make a single move."""
+    global PENDING_STEPS
+    input_received()
+    PENDING_STEPS += steps
+    NAVIGATION_TIMER.start()
+
+def apply_navigation():
+    global PENDING_STEPS
+    steps = PENDING_STEPS
+    PENDING_STEPS = 0
+    if steps == 0 or not INTERNAL_STATE.image_available():
+        return
+    NAVIGATION.step(steps)
+    viewport_size = SCROLL_AREA.maximumViewportSize()
+    if NAVIGATION.is_fast():
+        INTERNAL_STATE.skim(steps, viewport_size,
+                            NAVIGATION.lead(SKIM_LEAD_TIME), SKIM_PREFETCH)
+        SETTLE_TIMER.start()
+    else:
+        INTERNAL_STATE.move_by(steps, viewport_size)
+    show_image()
+
+def navigation_settled():
+    """Load the whole window once the user stopped skimming."""
+    if not INTERNAL_STATE.skimming or not INTERNAL_STATE.image_available():
+        return
+    INTERNAL_STATE.update_window(SCROLL_AREA.maximumViewportSize())
+    show_image()
+
 def discard_image():
     if not INTERNAL_STATE.image_available():
         return
+    input_received()
     
     current_directory = INTERNAL_STATE.current_directory()
-    if not os.path.exists(current_directory + '/discarded'):
-        os.mkdir(current_directory + '/discarded')
-    if not os.path.isdir(current_directory + '/discarded'):
-        raise InternalException('A file named discarded was found. ' +
-                                'A folder of that name to move the photos' +
-                                'to could not be created.')
     filename = INTERNAL_STATE.current_image_name()
     position = INTERNAL_STATE.pos
-    shutil.move(INTERNAL_STATE.current_image_complete_path(),
-                current_directory + '/discarded/' + filename)
+    # The file is moved in the background, the next image is shown right away.
     INTERNAL_STATE.discard_current_image(SCROLL_AREA.maximumViewportSize())
 
     if DISCARDING_IN_HISTORY:
@@ -131,10 +591,77 @@ def discard_image():
     else:
         clear()
 
+def update_performance_overlay():
+    if TRACER is None or not PERFORMANCE_OVERLAY.isVisible():
+        return
+    def milliseconds(p):
+        value = TRACER.percentile('keypress_to_paint', p)
+        if value is None:
+            return '-'
+        return '%.0f ms' % (value * 1000)
+    cache = INTERNAL_STATE.image_cache
+    lookups = cache.hits + cache.misses
+    if lookups > 0:
+        hit_rate = '%.0f%%' % (100.0 * cache.hits / lookups)
+    else:
+        hit_rate = '-'
+    PERFORMANCE_OVERLAY.setText(
+        'Keypress to paint: p50 ' + milliseconds(50) + ', p95 '
+        + milliseconds(95) + '\nCache hit rate: ' + hit_rate
+        + '\nLoader queue: ' + str(INTERNAL_STATE.loader_pool.queue_depth())
+        + '\n' + MEMORY_GOVERNOR.report())
+    PERFORMANCE_OVERLAY.adjustSize()
+
+def show_performance_overlay(show):
+    global TRACER
+    if show:
+        # The tracing goes on once started, for the trace export.
+        if TRACER is None:
+            TRACER = enable_tracing(TRACE_MAX_EVENTS, TRACE_HISTOGRAM_SIZE)
+        PERFORMANCE_OVERLAY.show()
+        update_performance_overlay()
+        PERFORMANCE_TIMER.start(PERFORMANCE_OVERLAY_INTERVAL)
+    else:
+        PERFORMANCE_OVERLAY.hide()
+        PERFORMANCE_TIMER.stop()
+
+def export_trace():
+    if TRACER is None:
+        STATUS_BAR.showMessage('Nothing was traced yet, the tracing starts '
+                               'with the performance overlay.', 5000)
+        return
+    path = QtGui.QFileDialog.getSaveFileName(MAIN_WINDOW, 'Export Trace',
+                                             'trace.json',
+                                             'Traces (*.json)')
+    if path.isEmpty():
+        return
+    try:
+        TRACER.export(str(path))
+    except (IOError, OSError), e:
+        STATUS_BAR.showMessage('The trace could not be written: ' + str(e),
+                               5000)
+        return
+    STATUS_BAR.showMessage('Trace written to ' + str(path), 5000)
+
 def clear():
+    leave_tiled_view()
     IMAGE_AREA.clear()
     STATUS_BAR_LABEL.clear()
     IMAGE_AREA.setText('No images loaded...')
+    update_filmstrip()
+
+def update_filmstrip():
+    if FILMSTRIP is None:
+        return
+    FILMSTRIP_MODEL.update()
+    FILMSTRIP.set_current(INTERNAL_STATE.pos)
+
+def image_activated(pos):
+    if pos == INTERNAL_STATE.pos:
+        return
+    input_received()
+    INTERNAL_STATE.jump_to_image(pos, SCROLL_AREA.maximumViewportSize())
+    show_image()
 
 def rotate_image(degrees):
     INTERNAL_STATE.rotate_current_image(degrees,
@@ -146,8 +673,7 @@ def rotate_image(degrees):
         INTERNAL_STATE.add_to_history(action)
 
     if AUTOMATICALLY_SAVE_ROTATIONS:
-        save_image(False)
-
+        SAVE_QUEUE.schedule(INTERNAL_STATE.current_image_complete_path())
 
 def rotate_image_right():
     rotate_image(90)
@@ -155,44 +681,160 @@ def rotate_image_right():
 def rotate_image_left():
     rotate_image(-90)
 
-def save_image(warn=True):
+def save_image():
     if not INTERNAL_STATE.image_available():
         return
+    SAVE_QUEUE.schedule_now([INTERNAL_STATE.current_image_complete_path()])
+
+def apply_all_rotations():
+    SAVE_QUEUE.schedule_now(INTERNAL_STATE.transformations.keys())
 
-    image = INTERNAL_STATE.current_image_rotated()
+def schedule_current_rotation():
+    if not AUTOMATICALLY_SAVE_ROTATIONS \
+           or not INTERNAL_STATE.image_available():
+        return
     path = INTERNAL_STATE.current_image_complete_path()
-    res = image.save(path)
+    if INTERNAL_STATE.get_transformation(path) is not None:
+        SAVE_QUEUE.schedule(path)
 
-    if res == 0:
-        if not warn:
-            print Exception('It is not possible to save changes to the images!')
-        else:
-            QtGui.QMessageBox.critical(MAIN_WINDOW, 'Error saving image',
-                                       'It was not possible to save ' + \
-                                       'the changes to the image(s)!')
+def image_saved(job):
+    if not job.success:
+        return
+    INTERNAL_STATE.transformation_saved(job.path, job.matrix)
+    if FILMSTRIP_MODEL is not None:
+        FILMSTRIP_MODEL.invalidate_path(job.path)
+    if TILED_VIEW is not None:
+        TILED_VIEW.invalidate_path(job.path)
+    if INTERNAL_STATE.image_available() \
+           and job.path == INTERNAL_STATE.current_image_complete_path():
+        show_image()
+
+def save_failed(message):
+    STATUS_BAR.showMessage(message, 5000)
+
+def file_operation_finished(job):
+    INTERNAL_STATE.file_operation_finished(job,
+                                           SCROLL_AREA.maximumViewportSize())
+    if INTERNAL_STATE.image_available():
+        show_image()
     else:
-        INTERNAL_STATE.set_image(image)
-        INTERNAL_STATE.reset_transformation(path)
+        clear()
+
+def file_operation_failed(message):
+    STATUS_BAR.showMessage(message, 5000)
+
+def apply_discards():
+    if INTERNAL_STATE.file_operations.is_applying():
+        return
+    INTERNAL_STATE.apply_decisions()
+
+def discards_progress(done, total):
+    STATUS_BAR.showMessage('Discarding images... ' + str(done) + '/'
+                           + str(total))
+
+def discards_applied(failed):
+    INTERNAL_STATE.decisions_applied(failed)
+    if len(failed) > 0:
+        STATUS_BAR.showMessage(str(len(failed)) + ' images could not be '
+                               + 'moved, they stay marked as discarded.',
+                               5000)
+    else:
+        STATUS_BAR.clearMessage()
+    show_status()
 
 # Ask the user to select a directory and save it in 'INTERNAL_STATE.directory'.
 def choose_images_to_keep():
+    global SIMILAR_COUNT
     if not FILE_DIALOG.exec_():
         return
 
     res = FILE_DIALOG.selectedFiles()
-    INTERNAL_STATE.start(res, SCROLL_AREA.maximumViewportSize())
-    show_next_image()
+    INTERNAL_STATE.save_session()
+    restored = INTERNAL_STATE.start(res, SCROLL_AREA.maximumViewportSize(),
+                                    RESUME_SESSIONS)
+    # The count belongs to the old list.
+    SIMILAR_COUNT = None
+    clear()
+    if restored and INTERNAL_STATE.image_available():
+        show_image()
+    else:
+        IMAGE_AREA.setText('Scanning...')
+        show_status()
+
+def images_found(images):
+    INTERNAL_STATE.add_scanned_images(images,
+                                      SCROLL_AREA.maximumViewportSize())
+    if HASH_INDEX is not None:
+        HASH_INDEX.index_images(images)
+    # The first image is shown as soon as it is found.
+    if INTERNAL_STATE.pos == -1:
+        show_next_image()
+    else:
+        show_status()
+
+def images_added(images):
+    was_empty = not INTERNAL_STATE.image_available()
+    INTERNAL_STATE.insert_images(images, SCROLL_AREA.maximumViewportSize())
+    if HASH_INDEX is not None:
+        HASH_INDEX.index_images(images)
+    if was_empty:
+        show_next_image()
+    else:
+        show_status()
+
+def images_removed(images):
+    INTERNAL_STATE.remove_images(images, SCROLL_AREA.maximumViewportSize())
+    if INTERNAL_STATE.image_available():
+        show_image()
+    else:
+        clear()
+
+def scan_finished():
+    INTERNAL_STATE.scan_finished(SCROLL_AREA.maximumViewportSize())
+    if INTERNAL_STATE.image_available():
+        show_image()
+    else:
+        clear()
+
+def about_to_quit():
+    SAVE_QUEUE.flush()
+    INTERNAL_STATE.file_operations.flush()
+    INTERNAL_STATE.file_operations.flush_bulk()
+    INTERNAL_STATE.sync_decisions()
+    INTERNAL_STATE.save_session()
+    save_hashes(prune=True)
+    if DECODER is not None:
+        DECODER.shutdown()
+
+def save_hashes(prune=False):
+    """Write the hashes. With 'prune' the hashes of the files that are gone
+    from the chosen directories are dropped."""
+    if HASH_INDEX is None:
+        return
+    if prune and INTERNAL_STATE.roots is not None:
+        HASH_INDEX.save(INTERNAL_STATE.roots)
+    else:
+        HASH_INDEX.save()
 
 def undo():
     INTERNAL_STATE.undo(SCROLL_AREA.maximumViewportSize())
     show_image()
+    schedule_current_rotation()
 
 def redo():
     INTERNAL_STATE.redo(SCROLL_AREA.maximumViewportSize())
     show_image()
+    schedule_current_rotation()
 
 # This next block is pretty much an internal configuration file.
 if __name__ == '__main__':
+    # The worker processes are forked before Qt or anything else starts a
+    # thread.
+    if DECODE_BACKEND == 'processes':
+        DECODER = enable_process_decoding(
+            DECODE_PROCESSES,
+            PREVIEW_CACHE_SIZE if PREVIEW_CACHE_ENABLED else None)
+
     ### Load the main window object created with QtDesigner.
     APP = QtGui.QApplication(sys.argv)
     MAIN_WINDOW = uic.loadUi('./qt/mainWindow.ui')
@@ -214,31 +856,200 @@ if __name__ == '__main__':
     ACTION_ROTATE_RIGHT = MAIN_WINDOW.action_Rotate_Right
     ACTION_ROTATE_LEFT = MAIN_WINDOW.action_Rotate_Left
     ACTION_SAVE = MAIN_WINDOW.actionSave
+    ACTION_APPLY_ROTATIONS = QtGui.QAction('&Apply All Rotations',
+                                           MAIN_WINDOW)
+    ACTION_APPLY_ROTATIONS.setShortcut(QtGui.QKeySequence('Ctrl+Shift+S'))
+    MAIN_WINDOW.menuImage.addAction(ACTION_APPLY_ROTATIONS)
+    ACTION_APPLY_DISCARDS = QtGui.QAction('Apply &Discards', MAIN_WINDOW)
+    ACTION_APPLY_DISCARDS.setShortcut(QtGui.QKeySequence('Ctrl+Shift+D'))
+    MAIN_WINDOW.menuImage.addAction(ACTION_APPLY_DISCARDS)
+    ACTION_ACTUAL_SIZE = QtGui.QAction('&Actual Size', MAIN_WINDOW)
+    ACTION_ACTUAL_SIZE.setShortcut(QtGui.QKeySequence('Ctrl+1'))
+    MAIN_WINDOW.menuImage.addAction(ACTION_ACTUAL_SIZE)
+    ACTION_DISCARD_SIMILAR = QtGui.QAction('Discard Si&milar', MAIN_WINDOW)
+    ACTION_DISCARD_SIMILAR.setShortcut(QtGui.QKeySequence('Ctrl+Shift+M'))
+    MAIN_WINDOW.menuImage.addAction(ACTION_DISCARD_SIMILAR)
+    ACTION_SKIP_SIMILAR = QtGui.QAction('S&kip Similar', MAIN_WINDOW)
+    ACTION_SKIP_SIMILAR.setShortcut(QtGui.QKeySequence('Ctrl+Shift+K'))
+    MAIN_WINDOW.menuImage.addAction(ACTION_SKIP_SIMILAR)
     SCROLL_AREA = MAIN_WINDOW.scrollArea
+    SCROLL_CONTENTS = SCROLL_AREA.widget()
     IMAGE_AREA = MAIN_WINDOW.imageLabel
     STATUS_BAR = MAIN_WINDOW.statusBar()
     STATUS_BAR_LABEL = QtGui.QLabel('')
     STATUS_BAR.addWidget(STATUS_BAR_LABEL)
 
+    if PREVIEW_CACHE_ENABLED:
+        enable_preview_cache(PREVIEW_CACHE_SIZE)
+    if TRACING_ENABLED:
+        TRACER = enable_tracing(TRACE_MAX_EVENTS, TRACE_HISTOGRAM_SIZE)
+    ACTION_PERFORMANCE_OVERLAY = QtGui.QAction('&Performance Overlay',
+                                               MAIN_WINDOW)
+    ACTION_PERFORMANCE_OVERLAY.setShortcut(QtGui.QKeySequence('Ctrl+Shift+P'))
+    ACTION_PERFORMANCE_OVERLAY.setCheckable(True)
+    MAIN_WINDOW.menuImage.addAction(ACTION_PERFORMANCE_OVERLAY)
+    ACTION_EXPORT_TRACE = QtGui.QAction('Export &Trace...', MAIN_WINDOW)
+    MAIN_WINDOW.menuImage.addAction(ACTION_EXPORT_TRACE)
+    if SIMILARITY_ENABLED:
+        HASH_INDEX = enable_hash_index(num_workers=SIMILARITY_THREADS)
+
     # Initialize the main object that is manipulated by the function of the
     # program.
-    INTERNAL_STATE = InternalState()
+    INTERNAL_STATE = InternalState(PREFETCH_AHEAD, PREFETCH_BEHIND,
+                                   IMAGE_CACHE_SIZE, LOADER_THREADS,
+                                   DEFERRED_DISCARD)
+    LOADER_POOL = INTERNAL_STATE.loader_pool
+    LOADER_POOL.connect(LOADER_POOL,
+                        QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                        image_loaded)
+
+    SCANNER = INTERNAL_STATE.scanner
+    SCANNER.connect(SCANNER, QtCore.SIGNAL('imagesFound(PyQt_PyObject)'),
+                    images_found)
+    SCANNER.connect(SCANNER, QtCore.SIGNAL('scanFinished()'), scan_finished)
+    WATCHER = INTERNAL_STATE.watcher
+    SCANNER.connect(SCANNER, QtCore.SIGNAL('directoriesFound(PyQt_PyObject)'),
+                    WATCHER.add_directories)
+    WATCHER.connect(WATCHER, QtCore.SIGNAL('imagesAdded(PyQt_PyObject)'),
+                    images_added)
+    WATCHER.connect(WATCHER, QtCore.SIGNAL('imagesRemoved(PyQt_PyObject)'),
+                    images_removed)
+
+    FILE_OPERATIONS = INTERNAL_STATE.file_operations
+    FILE_OPERATIONS.connect(FILE_OPERATIONS,
+                            QtCore.SIGNAL('operationFinished(PyQt_PyObject)'),
+                            file_operation_finished)
+    FILE_OPERATIONS.connect(FILE_OPERATIONS,
+                            QtCore.SIGNAL('operationFailed(QString)'),
+                            file_operation_failed)
+    FILE_OPERATIONS.connect(FILE_OPERATIONS,
+                            QtCore.SIGNAL('pendingChanged(int)'),
+                            lambda pending: show_status())
+    FILE_OPERATIONS.connect(FILE_OPERATIONS,
+                            QtCore.SIGNAL('bulkProgress(int, int)'),
+                            discards_progress)
+    FILE_OPERATIONS.connect(FILE_OPERATIONS,
+                            QtCore.SIGNAL('bulkFinished(PyQt_PyObject)'),
+                            discards_applied)
+
+    if FILMSTRIP_ENABLED:
+        FILMSTRIP_MODEL = ThumbnailModel(
+            INTERNAL_STATE, QtCore.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+            THUMBNAIL_CACHE_SIZE, THUMBNAIL_THREADS)
+        FILMSTRIP = Filmstrip(FILMSTRIP_MODEL, FILMSTRIP_GRID)
+        FILMSTRIP.connect(FILMSTRIP, QtCore.SIGNAL('imageActivated(int)'),
+                          image_activated)
+        FILMSTRIP_DOCK = QtGui.QDockWidget('Filmstrip', MAIN_WINDOW)
+        FILMSTRIP_DOCK.setWidget(FILMSTRIP)
+        MAIN_WINDOW.addDockWidget(QtCore.Qt.BottomDockWidgetArea,
+                                  FILMSTRIP_DOCK)
+        ACTION_SHOW_FILMSTRIP = FILMSTRIP_DOCK.toggleViewAction()
+        ACTION_SHOW_FILMSTRIP.setShortcut(QtGui.QKeySequence('Ctrl+Shift+F'))
+        MAIN_WINDOW.menuImage.addAction(ACTION_SHOW_FILMSTRIP)
+
+    PYRAMID_POOL = INTERNAL_STATE.pyramid_pool
+    PYRAMID_POOL.connect(PYRAMID_POOL,
+                         QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                         pyramid_built)
+    STAND_IN_POOL = INTERNAL_STATE.stand_in_pool
+    STAND_IN_POOL.connect(STAND_IN_POOL,
+                          QtCore.SIGNAL('jobFinished(PyQt_PyObject)'),
+                          stand_in_loaded)
+    if TILED_ZOOM_ENABLED:
+        TILED_VIEW = TiledImageView(TILE_CACHE_SIZE, TILE_THREADS)
+
+    # What is cheapest to make again is freed first. The pyramid is kept
+    # while the user zooms. The scaled images of the window are needed to
+    # browse, they are only counted.
+    MEMORY_GOVERNOR = MemoryGovernor(MEMORY_BUDGET, MEMORY_RSS_LIMIT)
+    if TILED_VIEW is not None:
+        MEMORY_GOVERNOR.register('tiles', lambda: TILED_VIEW.cache.used_bytes,
+                                 TILED_VIEW.cache.shrink)
+    if FILMSTRIP_MODEL is not None:
+        MEMORY_GOVERNOR.register(
+            'thumbnails', lambda: FILMSTRIP_MODEL.cache.used_bytes,
+            FILMSTRIP_MODEL.cache.shrink)
+    MEMORY_GOVERNOR.register('cache',
+                             lambda: INTERNAL_STATE.image_cache.used_bytes,
+                             INTERNAL_STATE.image_cache.shrink)
+    MEMORY_GOVERNOR.register(
+        'pyramid', INTERNAL_STATE.pyramid_bytes,
+        lambda max_bytes: INTERNAL_STATE.release_pyramid(is_zoomed()))
+    MEMORY_GOVERNOR.register('window', INTERNAL_STATE.window_bytes)
+    MEMORY_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    MEMORY_TIMER.connect(MEMORY_TIMER, QtCore.SIGNAL('timeout()'),
+                         enforce_memory_budget)
+    MEMORY_TIMER.start(MEMORY_CHECK_INTERVAL)
+
+    ZOOM_REFINE_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    ZOOM_REFINE_TIMER.setSingleShot(True)
+    ZOOM_REFINE_TIMER.setInterval(ZOOM_REFINE_DELAY)
+    ZOOM_REFINE_TIMER.connect(ZOOM_REFINE_TIMER, QtCore.SIGNAL('timeout()'),
+                              refine_zoom)
+
+    SAVE_QUEUE = SaveQueue(INTERNAL_STATE.get_transformation,
+                           LOSSLESS_ROTATION_SAVE, SAVE_DELAY, SAVE_THREADS)
+    SAVE_QUEUE.connect(SAVE_QUEUE,
+                       QtCore.SIGNAL('saveFinished(PyQt_PyObject)'),
+                       image_saved)
+    SAVE_QUEUE.connect(SAVE_QUEUE, QtCore.SIGNAL('saveFailed(QString)'),
+                       save_failed)
+
+    # Key repeats are coalesced, see 'navigate()'.
+    NAVIGATION = NavigationTracker(NAVIGATION_FAST_RATE)
+    NAVIGATION_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    NAVIGATION_TIMER.setSingleShot(True)
+    NAVIGATION_TIMER.setInterval(0)
+    NAVIGATION_TIMER.connect(NAVIGATION_TIMER, QtCore.SIGNAL('timeout()'),
+                             apply_navigation)
+    SETTLE_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    SETTLE_TIMER.setSingleShot(True)
+    SETTLE_TIMER.setInterval(NAVIGATION_SETTLE_DELAY)
+    SETTLE_TIMER.connect(SETTLE_TIMER, QtCore.SIGNAL('timeout()'),
+                         navigation_settled)
 
     # Change the resize event so that the preloaded images are
-    # resized.
+    # resized. The images are loaded again only once the resizing stopped,
+    # meanwhile the shown image is scaled quickly.
+    RESIZE_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    RESIZE_TIMER.setSingleShot(True)
+    RESIZE_TIMER.setInterval(RESIZE_DELAY)
+    RESIZE_TIMER.connect(RESIZE_TIMER, QtCore.SIGNAL('timeout()'),
+                         resize_finished)
     ORIGINAL_RESIZE_EVENT = SCROLL_AREA.resizeEvent
     def func(event):
         ORIGINAL_RESIZE_EVENT(event)
-        viewport_size = SCROLL_AREA.maximumViewportSize()
-        INTERNAL_STATE.rescale_images(viewport_size)
+        resizing()
     SCROLL_AREA.resizeEvent = func
 
+    # The keypress to paint latency ends when the image is painted.
+    ORIGINAL_PAINT_EVENT = IMAGE_AREA.paintEvent
+    def paint_event(event):
+        ORIGINAL_PAINT_EVENT(event)
+        image_painted()
+    IMAGE_AREA.paintEvent = paint_event
+
     # TODO: Find a nice icon that I'm allowed to use.
     # MAIN_WINDOW.setWindowIcon(QtGui.QIcon('./img/camera.jpg'))
 
     # Here signal-slot connections are added manually.
     ACTION_QUIT.connect(ACTION_QUIT, QtCore.SIGNAL('triggered()'),
                         QtGui.qApp, QtCore.SLOT('quit()'))
+    APP.connect(APP, QtCore.SIGNAL('aboutToQuit()'), about_to_quit)
+
+    # Save the session from time to time, in case the program crashes.
+    SESSION_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    SESSION_TIMER.connect(SESSION_TIMER, QtCore.SIGNAL('timeout()'),
+                          INTERNAL_STATE.save_session)
+    SESSION_TIMER.connect(SESSION_TIMER, QtCore.SIGNAL('timeout()'),
+                          save_hashes)
+    SESSION_TIMER.start(SESSION_SAVE_INTERVAL)
+
+    # Write the discard decisions to disk in batches.
+    DECISION_LOG_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    DECISION_LOG_TIMER.connect(DECISION_LOG_TIMER, QtCore.SIGNAL('timeout()'),
+                               INTERNAL_STATE.sync_decisions)
+    DECISION_LOG_TIMER.start(DECISION_LOG_SYNC_INTERVAL)
 
     ACTION_LIST = []
     def connect_slot(action, action_description, action_func):
@@ -249,13 +1060,28 @@ if __name__ == '__main__':
     connect_slot(ACTION_FIT, 'Fit Image', fit_image)
     connect_slot(ACTION_ZOOM_IN, 'Zoom In', zoom_in)
     connect_slot(ACTION_ZOOM_OUT, 'Zoom Out', zoom_out)
+    connect_slot(ACTION_ACTUAL_SIZE, 'Actual Size', zoom_actual_size)
     connect_slot(ACTION_ROTATE_RIGHT, 'Rotate Right', rotate_image_right)
     connect_slot(ACTION_ROTATE_LEFT, 'Rotate Left', rotate_image_left)
     connect_slot(ACTION_SAVE, 'Save', save_image)
+    connect_slot(ACTION_APPLY_ROTATIONS, 'Apply All Rotations',
+                 apply_all_rotations)
+    connect_slot(ACTION_APPLY_DISCARDS, 'Apply Discards', apply_discards)
+    connect_slot(ACTION_DISCARD_SIMILAR, 'Discard Similar',
+                 discard_similar_images)
+    connect_slot(ACTION_SKIP_SIMILAR, 'Skip Similar', skip_similar_images)
+    if ACTION_SHOW_FILMSTRIP is not None:
+        ACTION_LIST.append((ACTION_SHOW_FILMSTRIP, 'Filmstrip'))
+    ACTION_PERFORMANCE_OVERLAY.connect(ACTION_PERFORMANCE_OVERLAY,
+                                       QtCore.SIGNAL('toggled(bool)'),
+                                       show_performance_overlay)
+    ACTION_LIST.append((ACTION_PERFORMANCE_OVERLAY, 'Performance'))
+    ACTION_EXPORT_TRACE.connect(ACTION_EXPORT_TRACE,
+                                QtCore.SIGNAL('triggered()'), export_trace)
 
     # Make shortcuts work.
     SHORTCUTS = ShortcutsHandler(MAIN_WINDOW, ACTION_LIST)
-    SHORTCUTS.set_shortcuts(show_next_image, show_previous_image,
+    SHORTCUTS.set_shortcuts(step_forward, step_backward,
                             discard_image, undo, redo)
 
     def get_overlay_element(label):
@@ -293,6 +1119,18 @@ if __name__ == '__main__':
     for i in all_overlays:
         i.hide()
 
+    PERFORMANCE_OVERLAY = QtGui.QLabel(SCROLL_AREA)
+    PERFORMANCE_OVERLAY.setStyleSheet(
+        'QLabel { background-color: rgba(211,211,211,80%); \
+                  border: 1px solid black; \
+                  border-radius: 7px; \
+                  padding: 5px; }')
+    PERFORMANCE_OVERLAY.move(15, 15)
+    PERFORMANCE_OVERLAY.hide()
+    PERFORMANCE_TIMER = QtCore.QTimer(MAIN_WINDOW)
+    PERFORMANCE_TIMER.connect(PERFORMANCE_TIMER, QtCore.SIGNAL('timeout()'),
+                              update_performance_overlay)
+
     def f1(event):
         if event.key() == QtCore.Qt.Key_Control:
             for i in all_overlays: